@@ -45,6 +45,9 @@ db = None
 # stores ItemInfo objects so we can quickly fetch them
 item_info_cache = None
 
+# optional SQLite FTS index for item searches (see ftsindex.py)
+item_fts_index = None
+
 # command line arguments for thumbnailer (linux)
 movie_data_program_info = None
 
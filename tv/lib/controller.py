@@ -42,6 +42,7 @@ from zipfile import ZipFile
 from miro import app
 from miro import downloader
 from miro import eventloop
+from miro import feedparserpool
 from miro.gtcache import gettext as _
 from miro import httpauth
 from miro import httpclient
@@ -50,6 +51,7 @@ from miro import messages
 from miro import moviedata
 from miro import prefs
 from miro import signals
+from miro import util
 from miro import conversions
 from miro.plat.utils import exit_miro
 
@@ -70,6 +72,8 @@ class Controller:
         downloader.shutdown_downloader(self.downloader_shutdown)
 
     def downloader_shutdown(self):
+        logging.info("Shutting down feed parser processes")
+        feedparserpool.shutdown()
         logging.info("Shutting down libCURL thread")
         httpclient.stop_thread()
         httpclient.cleanup_libcurl()
@@ -77,11 +81,21 @@ class Controller:
         httpauth.write_to_file()
         logging.info("Shutting down event loop thread")
         eventloop.shutdown()
-        logging.info("Saving cached ItemInfo objects")
+        if app.item_fts_index is not None:
+            logging.info("Saving FTS search index")
+            app.item_fts_index.shutdown()
+            app.item_fts_index = None
+        # commit before shutting down the item info cache, otherwise we
+        # would hold the write lock that its writer thread needs.
         logging.info("Commiting DB changes")
         app.db.finish_transaction()
         if app.item_info_cache is not None:
-            app.item_info_cache.save()
+            logging.info("Saving cached ItemInfo objects")
+            app.item_info_cache.shutdown()
+        logging.info("Stripped HTML cache stats: %s",
+                util.stripped_html_cache.get_stats())
+        logging.info("Timeout scheduler stats: %s",
+                eventloop.get_scheduler_stats())
         logging.info("Closing Database...")
         if app.db is not None:
             app.db.close()
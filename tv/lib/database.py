@@ -33,6 +33,7 @@ import threading
 
 from miro import app
 from miro import signals
+from miro import viewpredicate
 
 class DatabaseException(Exception):
     """Superclass for classes that subclass Exception and are all
@@ -223,6 +224,78 @@ class ViewTrackerManager(object):
         self.table_to_tracker = {}
         # maps joined tables to trackers
         self.joined_table_to_tracker = {}
+        # maps (table_name, where, joins) to ViewPredicates
+        self.predicate_cache = {}
+        # maps table name -> columns that trackers on other tables depend
+        # on through joins
+        self.joined_columns = {}
+        # increases by one for each call to update_view_trackers()
+        self.change_serial = 0
+        # maps object id -> {column: change_serial} for changes to columns
+        # in joined_columns
+        self.joined_changes = {}
+        # maps object id -> change_serial of the last time we ran
+        # update_view_trackers() for it
+        self.last_checked = {}
+        # maps (table_name, key_column, where, joins) to CountTrackers
+        self.count_trackers = {}
+        # maps table_name to CountTrackers for that table
+        self.table_to_count_tracker = {}
+        # maps joined tables to CountTrackers that join on their key
+        # column
+        self.key_table_to_count_tracker = {}
+
+    def get_predicate(self, table_name, where, joins):
+        """Get a ViewPredicate for a view.
+
+        Returns None if the where clause can't be evaluated in memory.
+        """
+        if joins is not None:
+            key = (table_name, where, tuple(sorted(joins.items())))
+        else:
+            key = (table_name, where, None)
+        try:
+            return self.predicate_cache[key]
+        except KeyError:
+            predicate = viewpredicate.compile_predicate(table_name, where,
+                    joins)
+            if predicate is None:
+                logging.debug("can't compile view predicate: %s (%s)",
+                        where, joins)
+            self.predicate_cache[key] = predicate
+            return predicate
+
+    def get_count_tracker(self, table_name, key_column, where, joins):
+        """Get a CountTracker for a view.  Trackers are shared between all
+        callers that count the same view.
+        """
+        if joins is not None:
+            key = (table_name, key_column, where,
+                    tuple(sorted(joins.items())))
+        else:
+            key = (table_name, key_column, where, None)
+        try:
+            return self.count_trackers[key]
+        except KeyError:
+            tracker = CountTracker(table_name, key_column, where, joins)
+            self.count_trackers[key] = tracker
+            self.table_to_count_tracker.setdefault(table_name,
+                    set()).add(tracker)
+            for key_table in tracker.key_tables:
+                self.key_table_to_count_tracker.setdefault(key_table,
+                        set()).add(tracker)
+            return tracker
+
+    def check_count_trackers(self):
+        """Compare the counts in our CountTrackers with SQL.
+
+        :returns: True if all counts were correct.
+        """
+        all_correct = True
+        for tracker in self.count_trackers.values():
+            if not tracker.check_counts():
+                all_correct = False
+        return all_correct
 
     def trackers_for_table(self, table_name):
         try:
@@ -234,27 +307,165 @@ class ViewTrackerManager(object):
     def trackers_for_ddb_class(self, klass):
         return self.trackers_for_table(app.db.table_name(klass))
 
-    def update_view_trackers(self, obj):
-        """Update view trackers based on an object change."""
+    def add_joined_columns(self, table_name, columns):
+        """Register columns that a tracker depends on through a join.
 
-        for tracker in self.trackers_for_ddb_class(obj.__class__):
-            tracker.object_changed(obj)
+        Changes to these columns get recorded in joined_changes, so that
+        trackers know that they need to re-check objects that join to the
+        changed object.
+        """
+        self.joined_columns.setdefault(table_name, set()).update(columns)
+
+    def update_view_trackers(self, obj, changed_columns=None):
+        """Update view trackers based on an object change.
+
+        :param changed_columns: set of columns that changed for obj, or
+        None if we don't know which columns changed.
+        """
 
-    def bulk_update_view_trackers(self, table_name):
+        self.change_serial += 1
+        table_name = app.db.table_name(obj.__class__)
+        self._record_joined_changes(obj, table_name, changed_columns)
+        last_checked = self.last_checked.get(obj.id)
         for tracker in self.trackers_for_table(table_name):
-            tracker.check_all_objects()
+            if tracker.needs_check(obj, changed_columns, last_checked):
+                tracker.object_changed(obj)
+            else:
+                tracker.object_unaffected(obj)
+        for tracker in self.table_to_count_tracker.get(table_name, ()):
+            tracker.object_changed(obj, changed_columns, last_checked)
+        for tracker in self.key_table_to_count_tracker.get(table_name, ()):
+            tracker.key_object_changed(obj, table_name, changed_columns)
+        self.last_checked[obj.id] = self.change_serial
+
+    def _record_joined_changes(self, obj, table_name, changed_columns):
+        try:
+            joined_columns = self.joined_columns[table_name]
+        except KeyError:
+            return
+        if changed_columns is not None:
+            joined_columns = joined_columns.intersection(changed_columns)
+        if joined_columns:
+            changes = self.joined_changes.setdefault(obj.id, {})
+            for column in joined_columns:
+                changes[column] = self.change_serial
+
+    def joined_object_changed_since(self, table_name, id_, columns, serial):
+        """Check if an object changed any of columns since serial."""
+        try:
+            changes = self.joined_changes[id_]
+        except KeyError:
+            return False
+        for column in columns:
+            if changes.get(column, 0) > serial:
+                return True
+        return False
+
+    def bulk_update_view_trackers(self, table_name, objects):
+        """Update view trackers after BulkSQLManager.commit().
+
+        :param objects: objects from table_name that were inserted or
+            changed
+        """
+        self.change_serial += 1
+        for obj in objects:
+            self._record_joined_changes(obj, table_name, None)
+            self.last_checked[obj.id] = self.change_serial
+        for tracker in self.trackers_for_table(table_name):
+            tracker.check_objects(objects)
+        for tracker in self.table_to_count_tracker.get(table_name, ()):
+            for obj in objects:
+                tracker.object_changed(obj, None, None)
+        for tracker in self.key_table_to_count_tracker.get(table_name, ()):
+            for obj in objects:
+                tracker.forget_key(obj.id)
 
     def bulk_remove_from_view_trackers(self, table_name, objects):
+        for obj in objects:
+            self.last_checked.pop(obj.id, None)
+            self.joined_changes.pop(obj.id, None)
         for tracker in self.trackers_for_table(table_name):
             tracker.remove_objects(objects)
+        for tracker in self.table_to_count_tracker.get(table_name, ()):
+            tracker.remove_objects(objects)
+        for tracker in self.key_table_to_count_tracker.get(table_name, ()):
+            for obj in objects:
+                tracker.forget_key(obj.id)
 
     def remove_from_view_trackers(self, obj):
         """Update view trackers based on an object change."""
 
+        self.last_checked.pop(obj.id, None)
+        self.joined_changes.pop(obj.id, None)
         for tracker in self.trackers_for_ddb_class(obj.__class__):
             tracker.remove_object(obj)
+        table_name = app.db.table_name(obj.__class__)
+        for tracker in self.table_to_count_tracker.get(table_name, ()):
+            tracker.remove_objects([obj])
+        for tracker in self.key_table_to_count_tracker.get(table_name, ()):
+            tracker.forget_key(obj.id)
+
+class PredicateTracker(object):
+    """Base class for objects that keep track of which objects match a
+    where clause.
+
+    Subclasses must set table_name, where and joins, then call
+    setup_predicate().
+    """
 
-class ViewTracker(signals.SignalEmitter):
+    def setup_predicate(self):
+        vt_manager = app.view_tracker_manager
+        self.predicate = vt_manager.get_predicate(self.table_name,
+                self.where, self.joins)
+        self._calc_dependencies()
+        for table_name, columns in self.joined_dependencies.items():
+            vt_manager.add_joined_columns(table_name, columns)
+
+    def _calc_dependencies(self):
+        """Figure out which columns our where clause depends on.
+
+        Sets dependencies to the columns from our table and
+        joined_dependencies to a dict mapping joined tables to their
+        columns.  If we can't compile the where clause, dependencies is set
+        to None, which means that any change could affect us.
+        """
+        self.joined_dependencies = {}
+        if self.predicate is None:
+            self.dependencies = None
+            return
+        self.dependencies = set()
+        for table_name, column in self.predicate.columns:
+            if table_name == self.table_name:
+                self.dependencies.add(column)
+            else:
+                self.joined_dependencies.setdefault(table_name,
+                        set()).add(column)
+
+    def needs_check(self, obj, changed_columns, last_checked):
+        """Check if a change could have moved obj in or out of our view.
+
+        :param changed_columns: columns that changed in obj, or None
+        :param last_checked: change_serial from the last time obj was
+            checked, or None
+        """
+        if (self.dependencies is None or changed_columns is None or
+                last_checked is None):
+            return True
+        if not self.dependencies.isdisjoint(changed_columns):
+            return True
+        if self.joined_dependencies:
+            # obj didn't change, but maybe one of the objects that we join
+            # to did.
+            vt_manager = app.view_tracker_manager
+            for table_name, id_ in self.predicate.joined_ids(obj):
+                columns = self.joined_dependencies.get(table_name)
+                if (columns and id_ is not None and
+                        vt_manager.joined_object_changed_since(table_name,
+                            id_, columns, last_checked)):
+                    return True
+        return False
+
+class ViewTracker(PredicateTracker, signals.SignalEmitter):
     def __init__(self, fetcher, where, values, joins):
         signals.SignalEmitter.__init__(self, 'added', 'removed', 'changed',
                 'bulk-added', 'bulk-removed', 'bulk-changed')
@@ -267,8 +478,8 @@ class ViewTracker(signals.SignalEmitter):
         self.joins = joins
         self.bulk_mode = False
         self.current_ids = self._view_object_ids()
-        vt_manager = app.view_tracker_manager
-        vt_manager.trackers_for_table(self.table_name).add(self)
+        self.setup_predicate()
+        app.view_tracker_manager.trackers_for_table(self.table_name).add(self)
 
     def unlink(self):
         vt_manager = app.view_tracker_manager
@@ -285,6 +496,15 @@ class ViewTracker(signals.SignalEmitter):
 
     def _obj_in_view(self, obj):
         """Check if a single object is in our view."""
+        if self.predicate is not None:
+            try:
+                return self.predicate.evaluate(obj, self.values)
+            except viewpredicate.NotInMemory:
+                pass
+        return self._obj_in_view_sql(obj)
+
+    def _obj_in_view_sql(self, obj):
+        """Check if a single object is in our view using SQL."""
         where = '%s.id = ?' % (self.table_name,)
         if self.where:
             where += ' AND (%s)' % (self.where,)
@@ -301,6 +521,13 @@ class ViewTracker(signals.SignalEmitter):
     def object_changed(self, obj):
         self.check_object(obj)
 
+    def object_unaffected(self, obj):
+        """Called when obj changed, but not in a way that affects our
+        view.
+        """
+        if obj.id in self.current_ids:
+            self.emit('changed', self.fetcher.fetch_obj_for_ddb_object(obj))
+
     def remove_object(self, obj):
         if obj.id in self.current_ids:
             self.current_ids.remove(obj.id)
@@ -330,6 +557,44 @@ class ViewTracker(signals.SignalEmitter):
             for obj in objects:
                 self.emit(signal, obj)
 
+    def check_objects(self, objects):
+        """Check a list of objects that were inserted or changed.
+
+        This is used after BulkSQLManager.commit().  Unlike
+        check_all_objects(), we only emit signals for objects in the list.
+        """
+        if self.predicate is None:
+            # Checking each object would mean running a query for each
+            # one.  Run our query once instead.  Since our where clause can
+            # depend on other rows, any object can move in or out of the
+            # view, not just the ones in the list.
+            old_ids = self.current_ids
+            self._update_current_ids(self._view_object_ids())
+            changed = [obj for obj in objects
+                    if obj.id in old_ids and obj.id in self.current_ids]
+            self._emit_for_objects('changed',
+                    [self.fetcher.fetch_obj_for_ddb_object(obj)
+                        for obj in changed])
+            return
+        added = []
+        removed = []
+        changed = []
+        for obj in objects:
+            before = (obj.id in self.current_ids)
+            now = self._obj_in_view(obj)
+            if before and not now:
+                self.current_ids.remove(obj.id)
+                removed.append(obj)
+            elif now and not before:
+                self.current_ids.add(obj.id)
+                added.append(obj)
+            elif before and now:
+                changed.append(obj)
+        fetch = self.fetcher.fetch_obj_for_ddb_object
+        self._emit_for_objects('added', [fetch(obj) for obj in added])
+        self._emit_for_objects('removed', [fetch(obj) for obj in removed])
+        self._emit_for_objects('changed', [fetch(obj) for obj in changed])
+
     def check_all_objects(self):
         old_ids = self.current_ids
         self._update_current_ids(self._view_object_ids())
@@ -359,11 +624,211 @@ class ViewTracker(signals.SignalEmitter):
         return len(self.current_ids)
 
 
+class CountTracker(PredicateTracker):
+    """Keeps track of how many objects match a where clause, for each value
+    of a key column.
+
+    where must have exactly one parameter, which gets the key value (for
+    example "feed_id=? AND NOT seen").  The first time count() is called
+    for a key, we query the matching ids.  After that ViewTrackerManager
+    tells us about changes and we keep the ids up to date, the same way
+    ViewTracker does.  This makes count() O(1) for keys that we've seen
+    before.
+
+    Like ViewTracker, we only notice changes to joined objects when
+    signal_change() gets called for the objects in our table.  The
+    exception is tables that we join to using key_column (for example the
+    feed table for "item.feed_id=feed.id").  If one of those objects
+    changes, we throw away the ids for that key.
+
+    Keys can also be collected into groups (for example the feeds in a
+    folder).  group_count() sums the counts for the keys in a group once,
+    then we adjust the total as ids get added and removed, so it's O(1)
+    too.  Call forget_group() when the keys in a group change.
+
+    If the where clause can't be evaluated in memory, we just run a COUNT
+    query each time.
+    """
+
+    def __init__(self, table_name, key_column, where, joins):
+        self.table_name = table_name
+        self.key_column = key_column
+        self.where = where
+        self.joins = joins
+        # maps key -> set of object ids that match for that key
+        self.ids = {}
+        # maps object id -> key for the objects in self.ids
+        self.id_to_key = {}
+        # maps group -> total count for the keys in that group
+        self.group_totals = {}
+        # maps key -> group for the keys in self.group_totals
+        self.key_to_group = {}
+        self.setup_predicate()
+        self.key_tables = set()
+        if self.predicate is not None:
+            for table_name, column in self.predicate.join_columns():
+                if column == key_column:
+                    self.key_tables.add(table_name)
+
+    def count(self, key):
+        if self.predicate is None:
+            return app.db.query_count(self.table_name, self.where, (key,),
+                    self.joins)
+        try:
+            return len(self.ids[key])
+        except KeyError:
+            ids = self._query_ids(key)
+            self.ids[key] = ids
+            for id_ in ids:
+                self.id_to_key[id_] = key
+            return len(ids)
+
+    def group_count(self, group, get_keys):
+        """Get the total count for a group of keys.
+
+        get_keys is called to find the keys in the group the first time we
+        see it, or after forget_group() was called.
+        """
+        try:
+            return self.group_totals[group]
+        except KeyError:
+            pass
+        keys = get_keys()
+        total = sum(self.count(key) for key in keys)
+        if self.predicate is None:
+            return total
+        for key in keys:
+            old_group = self.key_to_group.get(key)
+            if old_group is not None and old_group != group:
+                self.forget_group(old_group)
+            self.key_to_group[key] = group
+        self.group_totals[group] = total
+        return total
+
+    def forget_group(self, group):
+        """Throw away the total for group.  It will be re-calculated the
+        next time group_count() is called.
+        """
+        if self.group_totals.pop(group, None) is None:
+            return
+        for key, key_group in self.key_to_group.items():
+            if key_group == group:
+                del self.key_to_group[key]
+
+    def _adjust_group_total(self, key, delta):
+        group = self.key_to_group.get(key)
+        if group is not None:
+            self.group_totals[group] += delta
+
+    def _query_ids(self, key):
+        return set(app.db.query_ids(self.table_name, self.where, (key,),
+            joins=self.joins))
+
+    def _obj_matches(self, obj, key):
+        try:
+            return self.predicate.evaluate(obj, (key,))
+        except viewpredicate.NotInMemory:
+            where = '%s.id = ? AND (%s)' % (self.table_name, self.where)
+            return app.db.query_count(self.table_name, where, (obj.id, key),
+                    self.joins) > 0
+
+    def _remove_id(self, id_):
+        key = self.id_to_key.pop(id_, None)
+        if key is not None and id_ in self.ids[key]:
+            self.ids[key].remove(id_)
+            self._adjust_group_total(key, -1)
+
+    def _add_id(self, id_, key):
+        ids = self.ids[key]
+        if id_ not in ids:
+            ids.add(id_)
+            self.id_to_key[id_] = key
+            self._adjust_group_total(key, 1)
+
+    def object_changed(self, obj, changed_columns, last_checked):
+        if not self.ids:
+            return
+        new_key = getattr(obj, self.key_column)
+        if self.id_to_key.get(obj.id, new_key) != new_key:
+            self._remove_id(obj.id)
+        if (new_key not in self.ids or
+                not self.needs_check(obj, changed_columns, last_checked)):
+            return
+        if self._obj_matches(obj, new_key):
+            self._add_id(obj.id, new_key)
+        elif obj.id in self.ids[new_key]:
+            self._remove_id(obj.id)
+
+    def key_object_changed(self, obj, table_name, changed_columns):
+        """Called when an object that we join to using key_column
+        changes.
+        """
+        if obj.id not in self.ids:
+            return
+        columns = self.joined_dependencies.get(table_name)
+        if (changed_columns is None or
+                (columns and not columns.isdisjoint(changed_columns))):
+            self.forget_key(obj.id)
+
+    def remove_objects(self, objects):
+        for obj in objects:
+            self._remove_id(obj.id)
+
+    def forget_key(self, key):
+        """Throw away our ids for key.  They'll be re-calculated the next
+        time count() is called.
+        """
+        if key in self.key_to_group:
+            self.forget_group(self.key_to_group[key])
+        for id_ in self.ids.pop(key, ()):
+            self.id_to_key.pop(id_, None)
+
+    def reset(self):
+        self.ids = {}
+        self.id_to_key = {}
+        self.group_totals = {}
+        self.key_to_group = {}
+
+    def check_counts(self):
+        """Check our ids against the database.
+
+        If they're out of sync, we log a warning and use the ids from the
+        database.
+
+        :returns: True if the ids were correct
+        """
+        all_correct = True
+        for key in self.ids.keys():
+            correct_ids = self._query_ids(key)
+            if correct_ids != self.ids[key]:
+                logging.warn("CountTracker out of sync: %s (%s) "
+                        "key: %s count: %s correct count: %s",
+                        self.where, self.joins, key, len(self.ids[key]),
+                        len(correct_ids))
+                self.forget_key(key)
+                all_correct = False
+        group_counts = {}
+        for key, group in self.key_to_group.items():
+            group_counts[group] = (group_counts.get(group, 0) +
+                    len(self.ids[key]))
+        for group, total in self.group_totals.items():
+            if total != group_counts.get(group, 0):
+                logging.warn("CountTracker out of sync: %s (%s) "
+                        "group: %s count: %s correct count: %s",
+                        self.where, self.joins, group, total,
+                        group_counts.get(group, 0))
+                self.forget_group(group)
+                all_correct = False
+        return all_correct
+
 class BulkSQLManager(object):
     def __init__(self):
         self.active = False
         self.to_insert = {}
         self.to_remove = {}
+        # maps table_name -> {id: object} for objects that changed while
+        # we were active
+        self.to_update = {}
         self.pending_inserts = set()
 
         self.last_call = None
@@ -390,11 +855,14 @@ class BulkSQLManager(object):
         for x in range(100):
             to_insert = self.to_insert
             to_remove = self.to_remove
+            to_update = self.to_update
             self.to_insert = {}
             self.to_remove = {}
+            self.to_update = {}
             self._commit_sql(to_insert, to_remove)
-            self._update_view_trackers(to_insert, to_remove)
-            if len(self.to_insert) == len(self.to_remove) == 0:
+            self._update_view_trackers(to_insert, to_remove, to_update)
+            if (len(self.to_insert) == len(self.to_remove) ==
+                    len(self.to_update) == 0):
                 break
             # inside _commit_sql() or _update_view_trackers(), we were
             # asked to insert or remove more items, repeat the
@@ -404,12 +872,16 @@ class BulkSQLManager(object):
                     "have items to commit.  Are we in a circular loop?")
         self.to_insert = {}
         self.to_remove = {}
+        self.to_update = {}
         self.pending_inserts = set()
 
     def _commit_sql(self, to_insert, to_remove):
         for table_name, objects in to_insert.items():
             logging.debug('bulk insert: %s %s', table_name, len(objects))
             app.db.bulk_insert(objects)
+            # The objects are in the DB now, changes from here on are
+            # handled like changes to any other object.
+            self.pending_inserts.difference_update(objects)
             for obj in objects:
                 obj.inserted_into_db()
 
@@ -419,14 +891,17 @@ class BulkSQLManager(object):
             for obj in objects:
                 obj.removed_from_db()
 
-    def _update_view_trackers(self, to_insert, to_remove):
-        for table_name in to_insert:
-            app.view_tracker_manager.bulk_update_view_trackers(table_name)
+    def _update_view_trackers(self, to_insert, to_remove, to_update):
+        for table_name in set(to_insert).union(to_update):
+            objects = list(to_insert.get(table_name, []))
+            inserted_ids = set(obj.id for obj in objects)
+            for obj in to_update.get(table_name, {}).values():
+                if obj.id not in inserted_ids:
+                    objects.append(obj)
+            app.view_tracker_manager.bulk_update_view_trackers(table_name,
+                    objects)
 
         for table_name, objects in to_remove.items():
-            if table_name in to_insert:
-                # already updated the view above
-                continue
             app.view_tracker_manager.bulk_remove_from_view_trackers(
                 table_name, objects)
 
@@ -443,8 +918,18 @@ class BulkSQLManager(object):
     def will_insert(self, obj):
         return obj in self.pending_inserts
 
+    def add_update(self, obj):
+        """Remember that obj changed, so that we update the view trackers
+        for it when we commit.
+        """
+        table_name = app.db.table_name(obj.__class__)
+        self.to_update.setdefault(table_name, {})[obj.id] = obj
+
     def add_remove(self, obj):
         table_name = app.db.table_name(obj.__class__)
+        updates_for_table = self.to_update.get(table_name)
+        if updates_for_table is not None:
+            updates_for_table.pop(obj.id, None)
         if self.will_insert(obj):
             self.to_insert[table_name].remove(obj)
             self.pending_inserts.remove(obj)
@@ -456,42 +941,76 @@ class BulkSQLManager(object):
             self.to_remove[table_name] = removes_for_table
         removes_for_table.append(obj)
 
+# Placeholder for attributes that haven't been set yet in a DDBObject's
+# field values list.
+_UNSET = object()
+
 class AttributeUpdateTracker(object):
-    """Used by DDBObject to track changes to attributes."""
+    """Used by DDBObject to track changes to attributes.
 
-    def __init__(self, name):
+    Values are stored in the _field_values list of each instance, rather
+    than its __dict__.  layout is the list of tracked attribute names for
+    the class and index is our position in it.
+    """
+
+    def __init__(self, name, index, layout):
         self.name = name
+        self.index = index
+        self.layout = layout
 
     # Simple implementation of the python descriptor protocol.  We
     # just want to update changed_attributes when attributes are set.
 
     def __get__(self, instance, owner):
+        if instance is None:
+            raise AttributeError(
+                "Can't access '%s' as a class attribute" % self.name)
         try:
-            return instance.__dict__[self.name]
-        except KeyError:
+            value = instance._field_values[self.index]
+        except IndexError:
             raise AttributeError(self.name)
-        except AttributeError:
-            if instance is None:
-                raise AttributeError(
-                    "Can't access '%s' as a class attribute" % self.name)
-            else:
-                raise
+        if value is _UNSET:
+            raise AttributeError(self.name)
+        return value
 
     def __set__(self, instance, value):
-        if instance.__dict__.get(self.name, "BOGUS VALUE FOO") != value:
-            instance.changed_attributes.add(self.name)
-        instance.__dict__[self.name] = value
+        values = instance._field_values
+        if self.index >= len(values):
+            size = max(len(self.layout), self.index + 1)
+            values = list(values) + [_UNSET] * (size - len(values))
+            instance._field_values = values
+        if values[self.index] is _UNSET or values[self.index] != value:
+            changed = instance.changed_attributes
+            if changed:
+                changed.add(self.name)
+            else:
+                instance.changed_attributes = set([self.name])
+        values[self.index] = value
 
-class DDBObject(signals.SignalEmitter):
+class DDBObject(signals.LazySignalEmitter):
     """Dynamic Database object
+
+    DDBObjects are designed to be cheap to keep in memory, since we can
+    have 100k+ items loaded at once.  Tracked attributes are stored in a
+    list using the per-class layout created by track_attribute_changes(),
+    rather than in __dict__.  The signal callback maps and the
+    changed_attributes set only get created when they're actually needed.
     """
     #The last ID used in this class
     lastID = 0
 
+    SIGNAL_NAMES = ('removed',)
+
+    # These get set on the instance when they change from the defaults
+    in_db_init = False
+    changed_attributes = frozenset()
+    _field_values = ()
+    # These get set on the class by track_attribute_changes()
+    _field_layout = ()
+    _field_index = {}
+
     def __init__(self, *args, **kwargs):
         self.in_db_init = True
-        signals.SignalEmitter.__init__(self, 'removed')
-        self.changed_attributes = set()
 
         if len(args) == 0 and kwargs.keys() == ['restored_data']:
             restoring = True
@@ -499,7 +1018,7 @@ class DDBObject(signals.SignalEmitter):
             restoring = False
 
         if restoring:
-            self.__dict__.update(kwargs['restored_data'])
+            self._restore_fields(kwargs['restored_data'])
             app.db.remember_object(self)
             self.setup_restored()
             # handle setup_restored() calling remove()
@@ -516,11 +1035,26 @@ class DDBObject(signals.SignalEmitter):
             if not self.id_exists():
                 return
 
-        self.in_db_init = False
+        del self.in_db_init
 
         if not restoring:
             self._insert_into_db()
 
+    def _restore_fields(self, restored_data):
+        if restored_data.viewkeys() == self._field_index.viewkeys():
+            self._field_values = [restored_data[name]
+                    for name in self._field_layout]
+        else:
+            # restored_data doesn't match our layout (for example the
+            # class doesn't track any attributes).  Set things one at a time.
+            values = [_UNSET] * len(self._field_layout)
+            for name, value in restored_data.iteritems():
+                try:
+                    values[self._field_index[name]] = value
+                except KeyError:
+                    self.__dict__[name] = value
+            self._field_values = values
+
     def _insert_into_db(self):
         if not app.bulk_sql_manager.active:
             app.db.insert_obj(self)
@@ -561,6 +1095,14 @@ class DDBObject(signals.SignalEmitter):
     def select(cls, columns, where=None, values=None, convert=True):
         return app.db.select(cls, columns, where, values, convert=convert)
 
+    @classmethod
+    def select_async(cls, columns, where, values, callback, errback=None):
+        """Like select(), but runs the query in a worker thread.  See
+        LiveStorage.query_async() for details.
+        """
+        return app.db.select_async(cls, columns, where, values, callback,
+                errback)
+
     def setup_new(self):
         """Initialize a newly created object."""
         pass
@@ -599,11 +1141,23 @@ class DDBObject(signals.SignalEmitter):
         >>> print obj.changed_attributes
         set(['foo', 'bar'])
         """
+        if '_field_layout' not in cls.__dict__:
+            # each class gets its own layout, we don't share our parent's
+            cls._field_layout = []
+            cls._field_index = {}
+        try:
+            index = cls._field_index[name]
+        except KeyError:
+            index = len(cls._field_layout)
+            cls._field_layout.append(name)
+            cls._field_index[name] = index
         # The AttributeUpdateTracker class does all the work
-        setattr(cls, name, AttributeUpdateTracker(name))
+        setattr(cls, name, AttributeUpdateTracker(name, index,
+            cls._field_layout))
 
     def reset_changed_attributes(self):
-        self.changed_attributes = set()
+        # go back to using the shared empty set from the class
+        self.__dict__.pop('changed_attributes', None)
 
     def get_id(self):
         """Returns unique integer assocaited with this object
@@ -666,9 +1220,17 @@ class DDBObject(signals.SignalEmitter):
             # view trackers in this case.  Both will be done when the
             # BulkSQLManager.finish() is called.
             return
+        # grab changed_attributes before update_obj() resets it
+        changed_columns = self.changed_attributes.copy()
         if needs_save:
             app.db.update_obj(self)
-        app.view_tracker_manager.update_view_trackers(self)
+        if app.bulk_sql_manager.active:
+            # Update the view trackers along with the inserts/removes when
+            # the BulkSQLManager commits.
+            app.bulk_sql_manager.add_update(self)
+        else:
+            app.view_tracker_manager.update_view_trackers(self,
+                    changed_columns)
 
     def on_signal_change(self):
         pass
@@ -2920,3 +2920,29 @@ def upgrade128(cursor):
     """Add cover_art to item.
     """
     cursor.execute("ALTER TABLE item ADD COLUMN cover_art TEXT")
+
+def upgrade129(cursor):
+    """Switch the database to auto_vacuum=INCREMENTAL.
+
+    Changing auto_vacuum on an existing database only takes effect after a
+    VACUUM.  From now on we vacuum incrementally while idle instead of at
+    every shutdown.
+    """
+    cursor.execute("PRAGMA auto_vacuum=INCREMENTAL")
+    cursor.execute("VACUUM")
+
+def upgrade130(cursor):
+    """Add indexes for columns that our views and joins filter on.
+
+    These were suggested by the query plan report (see queryplan.py), each
+    one turns a full table scan into an index search.
+    """
+    cursor.execute("CREATE INDEX feed_folder ON feed (folder_id)")
+    cursor.execute("CREATE INDEX downloader_main_item ON remote_downloader "
+            "(main_item_id)")
+    cursor.execute("CREATE INDEX downloader_url ON remote_downloader "
+            "(origURL)")
+    cursor.execute("CREATE INDEX playlist_item_map_playlist ON "
+            "playlist_item_map (playlist_id)")
+    cursor.execute("CREATE INDEX playlist_folder_item_map_playlist ON "
+            "playlist_folder_item_map (playlist_id)")
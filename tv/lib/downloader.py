@@ -155,7 +155,8 @@ class RemoteDownloader(DDBObject):
         """
         if self._save_later_dc is None:
             self._save_later_dc = eventloop.add_timeout(15,
-                    self._save_now, "Delayed RemoteDownloader save")
+                    self._save_now, "Delayed RemoteDownloader save",
+                    tolerance=5)
 
     def _save_now(self):
         """If _save_later() was called and we haven't saved the
@@ -536,7 +537,8 @@ class RemoteDownloader(DDBObject):
             activity = self._calc_retry_time()
             if self._update_retry_time_dc is None:
                 self._update_retry_time_dc = eventloop.add_timeout(1,
-                        self._update_retry_time, 'Updating retry time')
+                        self._update_retry_time, 'Updating retry time',
+                        tolerance=0.5)
         if activity is None:
             return _("starting up")
         return activity
@@ -36,8 +36,6 @@ TODO: handle user setting clock back
 """
 
 import threading
-import errno
-import select
 import socket
 import heapq
 import Queue
@@ -45,15 +43,16 @@ import logging
 import traceback
 from miro import app
 from miro import config
+from miro import poller
+from miro import prefs
+from miro import eventloopstats
 from miro import trapcall
 from miro import signals
 from miro import util
 
 from miro.clock import clock
 
-from miro.plat.utils import thread_body
-
-cumulative = {}
+from miro.plat.utils import thread_body, get_logical_cpu_count
 
 class DelayedCall(object):
     def __init__(self, function, name, args, kwargs):
@@ -62,6 +61,8 @@ class DelayedCall(object):
         self.args = args
         self.kwargs = kwargs
         self.canceled = False
+        # Scheduler that has us in its heap, if any
+        self.scheduler = None
 
     def _unlink(self):
         """Removes the references that this object has to the outside
@@ -69,12 +70,17 @@ class DelayedCall(object):
         some memory leaks on windows.
         """
         self.function = self.args = self.kwargs = None
+        self.scheduler = None
 
     def cancel(self):
-        self.canceled = True
+        scheduler = self.scheduler
+        if scheduler is not None:
+            scheduler.timeout_canceled(self)
+        else:
+            self.canceled = True
         self._unlink()
 
-    def dispatch(self):
+    def dispatch(self, category='call'):
         success = True
         if not self.canceled:
             when = "While handling %s" % self.name
@@ -86,47 +92,147 @@ class DelayedCall(object):
                 logging.timing("%s too slow (%.3f secs)",
                                self.name, end-start)
             try:
-                total = cumulative[self.name]
-            except (KeyError, AttributeError):
-                total = 0
-            total += end - start
-            cumulative[self.name] = total
-            if total > 5.0:
-                logging.timing("%s cumulative is too slow (%.3f secs)",
-                               self.name, total)
-                cumulative[self.name] = 0
+                eventloopstats.loop_stats.record_call(self.name, category,
+                                                      start, end)
+            except AttributeError:
+                # module globals can be None at interpreter shutdown
+                pass
         self._unlink()
         return success
 
 class Scheduler(object):
+    """Keeps track of timeouts in a heap.
+
+    Canceled timeouts are dropped from the top of the heap before we
+    calculate the next timeout, so they never wake up the event loop.
+    If enough of them pile up further down, we rebuild the heap
+    without them.
+
+    Timeouts can be given a tolerance, which is how much earlier than
+    scheduled they are allowed to run.  When the event loop wakes up
+    for one timeout, it also runs the timeouts within their tolerance
+    of now, rather than waking up again for each of them.
+    """
+    # Don't bother compacting heaps smaller than this
+    COMPACT_MIN_SIZE = 64
+
     def __init__(self):
         self.heap = []
-
-    def add_timeout(self, delay, function, name, args=None, kwargs=None):
+        # timeouts can be added and canceled from other threads
+        self.lock = threading.Lock()
+        self.canceled_count = 0
+        self.compactions = 0
+        self.wakeups = 0
+        self.spurious_wakeups = 0
+
+    def add_timeout(self, delay, function, name, args=None, kwargs=None,
+                    tolerance=0):
         if args is None:
             args = ()
         if kwargs is None:
             kwargs = {}
         scheduled_time = clock() + delay
         dc = DelayedCall(function,  "timeout (%s)" % (name,), args, kwargs)
-        heapq.heappush(self.heap, (scheduled_time, dc))
+        dc.scheduler = self
+        self.lock.acquire()
+        try:
+            heapq.heappush(self.heap, (scheduled_time, tolerance, dc))
+        finally:
+            self.lock.release()
         return dc
 
+    def timeout_canceled(self, dc):
+        """Called by DelayedCall.cancel() for timeouts in our heap.
+
+        We set dc.canceled while holding our lock, so that canceled_count
+        always matches the canceled entries in the heap.  dc.scheduler gets
+        cleared when we pop dc, so if dc already left the heap, we don't
+        count it.
+        """
+        self.lock.acquire()
+        try:
+            if not dc.canceled and dc.scheduler is self:
+                self.canceled_count += 1
+            dc.canceled = True
+        finally:
+            self.lock.release()
+
+    def _drop_canceled(self):
+        """Remove canceled timeouts from the top of the heap, and from
+        the rest of it if they make up more than half of it.
+        """
+        self.lock.acquire()
+        try:
+            heap = self.heap
+            if (len(heap) >= self.COMPACT_MIN_SIZE and
+                    self.canceled_count * 2 > len(heap)):
+                for entry in heap:
+                    if entry[2].canceled:
+                        entry[2].scheduler = None
+                heap[:] = [entry for entry in heap if not entry[2].canceled]
+                heapq.heapify(heap)
+                self.canceled_count = 0
+                self.compactions += 1
+            while len(heap) > 0 and heap[0][2].canceled:
+                time, tolerance, dc = heapq.heappop(heap)
+                dc.scheduler = None
+                self.canceled_count -= 1
+        finally:
+            self.lock.release()
+
     def next_timeout(self):
+        self._drop_canceled()
         if len(self.heap) == 0:
             return None
         else:
             return max(0, self.heap[0][0] - clock())
 
     def has_pending_timeout(self):
-        return len(self.heap) > 0 and self.heap[0][0] < clock()
+        self._drop_canceled()
+        if len(self.heap) == 0:
+            return False
+        scheduled_time, tolerance, dc = self.heap[0]
+        return scheduled_time - tolerance < clock()
 
     def process_next_timeout(self):
-        time, dc = heapq.heappop(self.heap)
-        return dc.dispatch()
+        self.lock.acquire()
+        try:
+            time, tolerance, dc = heapq.heappop(self.heap)
+            if dc.canceled:
+                self.canceled_count -= 1
+            # canceling dc from now on doesn't affect our heap
+            dc.scheduler = None
+        finally:
+            self.lock.release()
+        if not dc.canceled:
+            eventloopstats.loop_stats.record_wait('timeout', clock() - time)
+        return dc.dispatch('timeout')
+
+    def note_wakeup(self):
+        """Called when the event loop wakes up because our timeout
+        expired.  If there's nothing to run, the wakeup was spurious.
+        """
+        self.wakeups += 1
+        if not self.has_pending_timeout():
+            self.spurious_wakeups += 1
+
+    def get_stats(self):
+        """Get a dict with the heap size, the number of canceled
+        timeouts still in the heap, the number of compactions and the
+        number of timer wakeups, spurious or not.
+        """
+        return {
+            'heap_size': len(self.heap),
+            'canceled': self.canceled_count,
+            'compactions': self.compactions,
+            'wakeups': self.wakeups,
+            'spurious_wakeups': self.spurious_wakeups,
+        }
 
 class CallQueue(object):
-    def __init__(self):
+    def __init__(self, kind='idle'):
+        # kind is used to categorize our calls in eventloopstats
+        self.kind = kind
         self.queue = Queue.Queue()
         self.quit_flag = False
 
@@ -135,13 +241,18 @@ class CallQueue(object):
             args = ()
         if kwargs is None:
             kwargs = {}
-        dc = DelayedCall(function, "idle (%s)" % (name,), args, kwargs)
+        dc = DelayedCall(function, "%s (%s)" % (self.kind, name), args,
+                kwargs)
+        dc.queued_at = clock()
         self.queue.put(dc)
         return dc
 
     def process_next_idle(self):
         dc = self.queue.get()
-        return dc.dispatch()
+        if not dc.canceled:
+            eventloopstats.loop_stats.record_wait(self.kind,
+                                                  clock() - dc.queued_at)
+        return dc.dispatch(self.kind)
 
     def has_pending_idle(self):
         return not self.queue.empty()
@@ -151,62 +262,229 @@ class CallQueue(object):
         while self.has_pending_idle() and not self.quit_flag:
             self.process_next_idle()
 
+class Future(object):
+    """Tracks a call made with call_in_thread().
+
+    cancel() stops the function from running if it hasn't started yet.
+    Either way, the callback and errback won't be called.  wait() and
+    get_result() can be used by code that runs outside the event loop.
+    """
+    def __init__(self, lane, name):
+        self.lane = lane
+        self.name = name
+        self.submitted = clock()
+        self.started = self.finished = None
+        self.canceled = False
+        self.delivered = False
+        self._result = self._exception = None
+        self._callback_dc = None
+        self._lock = threading.Lock()
+        self._done_event = threading.Event()
+
+    def cancel(self):
+        """Cancel the call.  Returns False if the callback or errback
+        already ran.
+        """
+        self._lock.acquire()
+        try:
+            if self.delivered:
+                return False
+            self.canceled = True
+            if self._callback_dc is not None:
+                self._callback_dc.cancel()
+            if self.started is None:
+                self._done_event.set()
+            return True
+        finally:
+            self._lock.release()
+
+    def is_done(self):
+        return self._done_event.isSet()
+
+    def wait(self, timeout=None):
+        """Wait for the call to finish.  Returns True if it did."""
+        self._done_event.wait(timeout)
+        return self._done_event.isSet()
+
+    def get_result(self):
+        """Get the function's return value.  If it raised an exception,
+        that exception gets raised.
+        """
+        if not self.is_done():
+            raise ValueError("%s hasn't finished" % self.name)
+        if self.started is None:
+            raise ValueError("%s was canceled" % self.name)
+        if self._exception is not None:
+            raise self._exception
+        return self._result
+
+    def _start(self):
+        """Called by the thread pool before running the function.  Returns
+        False if the call was canceled.
+        """
+        self._lock.acquire()
+        try:
+            if self.canceled:
+                return False
+            self.started = clock()
+            return True
+        finally:
+            self._lock.release()
+
+    def _finish(self, idle_queue, function, name, arg, result, exception):
+        """Called by the thread pool when the function returns.  Schedules
+        function to be called with arg in the event loop, unless
+        idle_queue is None.
+        """
+        self._lock.acquire()
+        try:
+            self.finished = clock()
+            self._result = result
+            self._exception = exception
+            if not self.canceled and idle_queue is not None:
+                self._callback_dc = idle_queue.add_idle(self._deliver, name,
+                        args=(function, arg))
+        finally:
+            self._lock.release()
+        self._done_event.set()
+
+    def _deliver(self, function, arg):
+        self._lock.acquire()
+        try:
+            if self.canceled:
+                return
+            self.delivered = True
+        finally:
+            self._lock.release()
+        loop_stats = eventloopstats.loop_stats
+        loop_stats.record_wait('%s lane' % self.lane,
+                               self.started - self.submitted)
+        loop_stats.record_call('thread (%s)' % self.name, 'thread',
+                               self.started, self.finished,
+                               1 + ThreadPool.LANES.index(self.lane))
+        function(arg)
+
 class ThreadPool(object):
     """The thread pool is used to handle calls like gethostbyname()
     that block and there's no asynchronous workaround.  What we do
     instead is call them in a separate thread and return the result in
     a callback that executes in the event loop.
+
+    Calls are split into lanes, each with their own queue and threads,
+    so that a long feed parse can't hold up hostname lookups:
+
+        - io for network calls like getaddrinfo() and SSL setup
+        - cpu for CPU heavy work like parsing feeds
+        - fs for blocking filesystem calls
+
+    A lane's threads get started the first time something is queued in it,
+    so lanes that nothing uses don't cost us any threads.
     """
-    THREADS = 3
+    LANES = ('io', 'cpu', 'fs')
+    LANE_PREFS = {
+        'io': prefs.THREAD_POOL_IO_THREADS,
+        'cpu': prefs.THREAD_POOL_CPU_THREADS,
+        'fs': prefs.THREAD_POOL_FS_THREADS,
+    }
 
     def __init__(self, event_loop):
         self.event_loop = event_loop
-        self.queue = Queue.Queue()
-        self.threads = []
+        self.queues = {}
+        self.threads = {}
+        # set by init_threads(), cleared by close_threads()
+        self.running = False
+        for lane in self.LANES:
+            self.queues[lane] = Queue.Queue()
+            self.threads[lane] = []
+            eventloopstats.loop_stats.add_gauge('%s lane queued' % lane,
+                                                self.queues[lane].qsize)
+
+    def lane_size(self, lane):
+        """Get the number of threads to use for a lane."""
+        count = app.config.get(self.LANE_PREFS[lane])
+        if count <= 0:
+            count = get_logical_cpu_count()
+        return max(count, 1)
 
     def init_threads(self):
-        while len(self.threads) < ThreadPool.THREADS:
-            t = threading.Thread(name='ThreadPool - %d' % len(self.threads),
-                                 target=thread_body,
-                                 args=[self.thread_loop])
+        self.running = True
+        for lane in self.LANES:
+            if not self.queues[lane].empty():
+                self._start_lane(lane)
+
+    def _start_lane(self, lane):
+        threads = self.threads[lane]
+        size = self.lane_size(lane)
+        while len(threads) < size:
+            t = threading.Thread(
+                    name='ThreadPool %s - %d' % (lane, len(threads)),
+                    target=thread_body,
+                    args=[self.thread_loop, self.queues[lane]])
             t.setDaemon(True)
+            # add the thread before starting it, so that the calls it runs
+            # see the lane as started
+            threads.append(t)
             t.start()
-            self.threads.append(t)
 
-    def thread_loop(self):
+    def thread_loop(self, queue):
         while True:
-            next_item = self.queue.get()
+            next_item = queue.get()
             if next_item == "QUIT":
                 break
             else:
-                callback, errback, func, name, args, kwargs, = next_item
+                future, callback, errback, func, args, kwargs = next_item
+            if not future._start():
+                continue
             try:
                 result = func(*args, **kwargs)
             except KeyboardInterrupt:
                 raise
             except Exception, exc:
                 logging.debug(">>> thread_loop: %s %s %s %s\n%s",
-                              func, name, args, kwargs,
+                              func, future.name, args, kwargs,
                               "".join(traceback.format_exc()))
                 func = errback
-                name = 'Thread Pool Errback (%s)' % name
-                args = (exc,)
+                name = 'Thread Pool Errback (%s)' % future.name
+                arg = exc
+                result = None
             else:
                 func = callback
-                name = 'Thread Pool Callback (%s)' % name
-                args = (result,)
-            if not self.event_loop.quit_flag:
-                self.event_loop.idle_queue.add_idle(func, name, args=args)
+                name = 'Thread Pool Callback (%s)' % future.name
+                arg = result
+                exc = None
+            if self.event_loop.quit_flag:
+                future._finish(None, func, name, arg, result, exc)
+            else:
+                future._finish(self.event_loop.idle_queue, func, name, arg,
+                               result, exc)
                 self.event_loop.wakeup()
 
-    def queue_call(self, callback, errback, function, name, *args, **kwargs):
-        self.queue.put((callback, errback, function, name, args, kwargs))
+    def queue_call(self, lane, callback, errback, function, name,
+                   *args, **kwargs):
+        """Queue a call in one of our lanes.  Returns a Future."""
+        future = Future(lane, name)
+        self.queues[lane].put((future, callback, errback, function, args,
+                               kwargs))
+        if self.running and not self.threads[lane]:
+            self._start_lane(lane)
+        return future
+
+    def queues_empty(self):
+        for queue in self.queues.values():
+            if not queue.empty():
+                return False
+        return True
 
     def close_threads(self):
-        for x in xrange(len(self.threads)):
-            self.queue.put("QUIT")
-        while len(self.threads) > 0:
-            x = self.threads.pop()
+        self.running = False
+        all_threads = []
+        for lane in self.LANES:
+            threads = self.threads[lane]
+            for x in xrange(len(threads)):
+                self.queues[lane].put("QUIT")
+            all_threads.extend(threads)
+            self.threads[lane] = []
+        for x in all_threads:
             try:
                 x.join()
             except (SystemExit, KeyboardInterrupt):
@@ -224,6 +502,17 @@ class SimpleEventLoop(signals.SignalEmitter):
         self.quit_flag = False
         self.wake_sender, self.wake_receiver = util.make_dummy_socket_pair()
         self.loop_ready = threading.Event()
+        # The poller keeps track of the file descriptors that we wait on.
+        # Subclasses register their fds with it when they change, rather
+        # than building lists of fds for each pass through the loop.
+        self.poller = self.make_poller()
+        self.poller.register_read(self.wake_receiver.fileno())
+
+    def make_poller(self):
+        """Create our poller.  Subclasses that update the poller with
+        set_fds() should override this to use make_stateless_poller().
+        """
+        return poller.make_poller()
 
     def loop(self):
         self.loop_ready.set()
@@ -234,25 +523,27 @@ class SimpleEventLoop(signals.SignalEmitter):
         while not self.quit_flag:
             self.emit('begin-loop')
             timeout = self.calc_timeout()
-            readfds, writefds, excfds = self.calc_fds()
-            readfds.append(self.wake_receiver.fileno())
+            self.update_poller()
             try:
-                read_fds_ready, write_fds_ready, exc_fds_ready = \
-                        select.select(readfds, writefds, excfds, timeout)
-            except select.error, (err, detail):
-                if err == errno.EINTR:
-                    logging.warning ("eventloop: %s", detail)
-                else:
-                    self.emit('end-loop')
-                    raise
+                read_fds_ready, write_fds_ready = self.poller.poll(timeout)
+            except:
+                self.emit('end-loop')
+                raise
             if self.quit_flag:
                 self.emit('end-loop')
                 break
             if self.wake_receiver.fileno() in read_fds_ready:
                 self._slurp_waker_data()
-            self.process_events(read_fds_ready, write_fds_ready, exc_fds_ready)
+            self.process_events(read_fds_ready, write_fds_ready)
             self.emit('end-loop')
 
+    def update_poller(self):
+        """Called before we wait on the poller.  Subclasses that can't
+        track when their file descriptors change can update the poller
+        here.
+        """
+        pass
+
     def wakeup(self):
         try:
             self.wake_sender.send("b")
@@ -267,9 +558,10 @@ class EventLoop(SimpleEventLoop):
         SimpleEventLoop.__init__(self)
         self.create_signal('event-finished')
         self.scheduler = Scheduler()
-        self.idle_queue = CallQueue()
-        self.urgent_queue = CallQueue()
+        self.idle_queue = CallQueue('idle')
+        self.urgent_queue = CallQueue('urgent')
         self.threadpool = ThreadPool(self)
+        self.timeout_pending = False
         self.read_callbacks = {}
         self.write_callbacks = {}
         self.clear_removed_callbacks()
@@ -280,24 +572,43 @@ class EventLoop(SimpleEventLoop):
 
     def add_read_callback(self, sock, callback):
         self.read_callbacks[sock.fileno()] = callback
+        self.poller.register_read(sock.fileno())
 
     def remove_read_callback(self, sock):
         del self.read_callbacks[sock.fileno()]
         self.removed_read_callbacks.add(sock.fileno())
+        self.poller.unregister_read(sock.fileno())
 
     def add_write_callback(self, sock, callback):
         self.write_callbacks[sock.fileno()] = callback
+        self.poller.register_write(sock.fileno())
 
     def remove_write_callback(self, sock):
         del self.write_callbacks[sock.fileno()]
         self.removed_write_callbacks.add(sock.fileno())
+        self.poller.unregister_write(sock.fileno())
 
     def call_in_thread(self, callback, errback, function, name,
                        *args, **kwargs):
-        self.threadpool.queue_call(callback, errback, function, name,
-                                  *args, **kwargs)
+        return self.threadpool.queue_call('io', callback, errback, function,
+                                          name, *args, **kwargs)
 
-    def process_events(self, read_fds_ready, write_fds_ready, exc_fds_ready):
+    def call_in_lane(self, lane, callback, errback, function, name,
+                     *args, **kwargs):
+        return self.threadpool.queue_call(lane, callback, errback, function,
+                                          name, *args, **kwargs)
+
+    def process_events(self, read_fds_ready, write_fds_ready):
+        start = clock()
+        try:
+            self._process_events(read_fds_ready, write_fds_ready)
+        finally:
+            eventloopstats.loop_stats.record_iteration(start, clock())
+
+    def _process_events(self, read_fds_ready, write_fds_ready):
+        if (self.timeout_pending and not read_fds_ready and
+                not write_fds_ready and not self.poller.interrupted):
+            self.scheduler.note_wakeup()
         self._process_urgent_events()
         if self.quit_flag:
             return
@@ -310,11 +621,10 @@ class EventLoop(SimpleEventLoop):
             if self.quit_flag:
                 break
 
-    def calc_fds(self):
-        return (self.read_callbacks.keys(), self.write_callbacks.keys(), [])
-
     def calc_timeout(self):
-        return self.scheduler.next_timeout()
+        timeout = self.scheduler.next_timeout()
+        self.timeout_pending = timeout is not None
+        return timeout
 
     def do_begin_loop(self):
         self.clear_removed_callbacks()
@@ -335,18 +645,20 @@ class EventLoop(SimpleEventLoop):
         """
         for callback in self.generate_callbacks(write_fds_ready,
                                                self.write_callbacks,
-                                               self.removed_write_callbacks):
+                                               self.removed_write_callbacks,
+                                               self.poller.unregister_write):
             yield callback
         for callback in self.generate_callbacks(read_fds_ready,
                                                self.read_callbacks,
-                                               self.removed_read_callbacks):
+                                               self.removed_read_callbacks,
+                                               self.poller.unregister_read):
             yield callback
         while self.scheduler.has_pending_timeout():
             yield self.scheduler.process_next_timeout
         while self.idle_queue.has_pending_idle():
             yield self.idle_queue.process_next_idle
 
-    def generate_callbacks(self, ready_list, map_, removed):
+    def generate_callbacks(self, ready_list, map_, removed, unregister):
         for fd in ready_list:
             try:
                 function = map_[fd]
@@ -359,9 +671,14 @@ class EventLoop(SimpleEventLoop):
                     continue
                 when = "While talking to the network"
                 def callback_event():
+                    start = clock()
                     success = trapcall.trap_call(when, function)
+                    eventloopstats.loop_stats.record_call(
+                        "socket (%s)" % _callback_name(function), 'socket',
+                        start, clock())
                     if not success:
                         del map_[fd]
+                        unregister(fd)
                     return success
                 yield callback_event
 
@@ -370,6 +687,12 @@ class EventLoop(SimpleEventLoop):
         self.idle_queue.quit_flag = True
         self.urgent_queue.quit_flag = True
 
+def _callback_name(function):
+    try:
+        return '%s.%s' % (function.im_class.__name__, function.__name__)
+    except AttributeError:
+        return getattr(function, '__name__', repr(function))
+
 _eventloop = EventLoop()
 
 def add_read_callback(sock, callback):
@@ -411,14 +734,25 @@ def stop_handling_socket(sock):
     except KeyError:
         pass
 
-def add_timeout(delay, function, name, args=None, kwargs=None):
+def add_timeout(delay, function, name, args=None, kwargs=None,
+                tolerance=0):
     """Schedule a function to be called at some point in the future.
     Returns a ``DelayedCall`` object that can be used to cancel the
     call.
+
+    If tolerance is given, the function may be called up to that many
+    seconds early, so that it can share a wakeup with other timeouts.
     """
-    dc = _eventloop.scheduler.add_timeout(delay, function, name, args, kwargs)
+    dc = _eventloop.scheduler.add_timeout(delay, function, name, args, kwargs,
+                                          tolerance)
     return dc
 
+def get_scheduler_stats():
+    """Get a dict of stats about the timeout scheduler.  See
+    Scheduler.get_stats().
+    """
+    return _eventloop.scheduler.get_stats()
+
 def add_idle(function, name, args=None, kwargs=None):
     """Schedule a function to be called when we get some spare time.
     Returns a ``DelayedCall`` object that can be used to cancel the
@@ -438,15 +772,24 @@ def add_urgent_call(function, name, args=None, kwargs=None):
     return dc
 
 def call_in_thread(callback, errback, function, name, *args, **kwargs):
-    """Schedule a function to be called in a separate thread.
+    """Schedule a function to be called in a separate thread.  The call
+    goes in the thread pool's io lane.  Returns a ``Future`` object that
+    can be used to cancel the call.
 
     .. Warning::
 
        Do not put code that accesses the database or the UI here!
     """
-    _eventloop.call_in_thread(
+    return _eventloop.call_in_thread(
         callback, errback, function, name, *args, **kwargs)
 
+def call_in_lane(lane, callback, errback, function, name, *args, **kwargs):
+    """Like call_in_thread(), but lane picks which of the thread pool's
+    lanes the call goes in ('io', 'cpu' or 'fs').
+    """
+    return _eventloop.call_in_lane(
+        lane, callback, errback, function, name, *args, **kwargs)
+
 lt = None
 
 profile_file = None
@@ -0,0 +1,214 @@
+# Miro - an RSS based video player application
+# Copyright (C) 2005, 2006, 2007, 2008, 2009, 2010, 2011
+# Participatory Culture Foundation
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
+#
+# In addition, as a special exception, the copyright holders give
+# permission to link the code of portions of this program with the OpenSSL
+# library.
+#
+# You must obey the GNU General Public License in all respects for all of
+# the code used other than OpenSSL. If you modify file(s) with this
+# exception, you may extend this exception to your version of the file(s),
+# but you are not obligated to do so. If you do not wish to do so, delete
+# this exception statement from your version. If you delete this exception
+# statement from all source files in the program, then also delete it here.
+
+
+"""``miro.eventloopstats`` -- Timing data for the backend event loop.
+
+LoopStats keeps track of how long each callback takes, how long idle
+and urgent calls wait in their queues, how late timeouts run and how
+long each loop iteration takes.  Memory use is bounded: histograms use
+a fixed set of buckets and the trace only keeps the most recent events.
+
+The trace can be exported in the Chrome trace event format, which can be
+loaded into chrome://tracing to see which callback caused a stall.
+"""
+
+import collections
+import json
+import math
+
+# Upper bound of the first histogram bucket, in seconds.  Each bucket after
+# that is twice as big as the one before.
+HISTOGRAM_MIN = 0.0001
+HISTOGRAM_BUCKETS = 24
+
+class Histogram(object):
+    """Tracks the distribution of a set of durations."""
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.buckets = [0] * HISTOGRAM_BUCKETS
+
+    def add(self, duration):
+        self.count += 1
+        self.total += duration
+        if duration > self.max:
+            self.max = duration
+        if duration <= HISTOGRAM_MIN:
+            index = 0
+        else:
+            index = int(math.ceil(math.log(duration / HISTOGRAM_MIN, 2)))
+            index = min(index, HISTOGRAM_BUCKETS - 1)
+        self.buckets[index] += 1
+
+    def percentile(self, percent):
+        """Estimate a percentile.
+
+        The result is the upper bound of the bucket that the percentile
+        falls in, so it can be off by up to a factor of 2.
+        """
+        if self.count == 0:
+            return 0.0
+        needed = self.count * percent / 100.0
+        seen = 0
+        for i, bucket_count in enumerate(self.buckets):
+            seen += bucket_count
+            if seen >= needed:
+                return min(HISTOGRAM_MIN * (2 ** i), self.max)
+        return self.max
+
+    def get_stats(self):
+        return {
+            'count': self.count,
+            'total': self.total,
+            'p50': self.percentile(50),
+            'p95': self.percentile(95),
+            'max': self.max,
+        }
+
+class LoopStats(object):
+    """Collects timing data for the event loop.
+
+    The record methods are called from the event loop thread.
+    """
+    # Callbacks after this many different names get lumped together
+    MAX_NAMES = 1000
+    OTHER_NAME = '(other)'
+    MAX_TRACE_EVENTS = 10000
+
+    def __init__(self):
+        self.gauges = {}
+        self.reset()
+
+    def reset(self):
+        self.callbacks = {}
+        self.waits = {}
+        self.iterations = Histogram()
+        self.trace = collections.deque(maxlen=self.MAX_TRACE_EVENTS)
+
+    def add_gauge(self, name, function):
+        """Add a gauge.  function will be called with no arguments to get
+        the current value when the stats are read.
+        """
+        self.gauges[name] = function
+
+    def record_call(self, name, category, start, end, track=0):
+        """Record that a callback ran from start to end.
+
+        track separates calls that ran on other threads in the trace.  The
+        event loop's calls use track 0.
+        """
+        try:
+            histogram = self.callbacks[name]
+        except KeyError:
+            if len(self.callbacks) >= self.MAX_NAMES:
+                name = self.OTHER_NAME
+            histogram = self.callbacks.setdefault(name, Histogram())
+        histogram.add(end - start)
+        self.trace.append((name, category, start, end - start, track))
+
+    def record_wait(self, queue_name, wait):
+        """Record how long a call waited before it ran."""
+        try:
+            histogram = self.waits[queue_name]
+        except KeyError:
+            histogram = self.waits[queue_name] = Histogram()
+        histogram.add(max(wait, 0))
+
+    def record_iteration(self, start, end):
+        """Record how long we spent handling events for one pass through
+        the event loop.
+        """
+        self.iterations.add(end - start)
+        self.trace.append(('loop iteration', 'loop', start, end - start, 0))
+
+    def get_stats(self):
+        """Get a dict with the stats for each callback name, for each
+        queue's wait times, for loop iterations and the current value of
+        each gauge.
+        """
+        return {
+            'gauges': dict((name, function())
+                           for name, function in self.gauges.items()),
+            'callbacks': dict((name, histogram.get_stats())
+                              for name, histogram in self.callbacks.items()),
+            'waits': dict((name, histogram.get_stats())
+                          for name, histogram in self.waits.items()),
+            'iterations': self.iterations.get_stats(),
+        }
+
+    def format_report(self, limit=20):
+        """Format the stats as text.  Callbacks are sorted by total time
+        and only the top limit are included.
+        """
+        def format_line(name, stats):
+            return ("%-50s %7d %9.3f %8.4f %8.4f %8.4f" %
+                    (name[:50], stats['count'], stats['total'],
+                     stats['p50'], stats['p95'], stats['max']))
+        header = "%-50s %7s %9s %8s %8s %8s" % ("", "count", "total",
+                "p50", "p95", "max")
+        stats = self.get_stats()
+        lines = [header, format_line('loop iteration', stats['iterations'])]
+        for name, wait_stats in sorted(stats['waits'].items()):
+            lines.append(format_line('%s wait' % name, wait_stats))
+        for name, value in sorted(stats['gauges'].items()):
+            lines.append("%-50s %7s" % (name[:50], value))
+        lines.append('')
+        lines.append(header)
+        callbacks = stats['callbacks'].items()
+        callbacks.sort(key=lambda item: item[1]['total'], reverse=True)
+        for name, callback_stats in callbacks[:limit]:
+            lines.append(format_line(name, callback_stats))
+        return '\n'.join(lines)
+
+    def chrome_trace(self):
+        """Get the recent trace events in the Chrome trace event format."""
+        events = []
+        for name, category, start, duration, track in self.trace:
+            events.append({
+                'name': name,
+                'cat': category,
+                'ph': 'X',
+                'ts': int(start * 1000000),
+                'dur': int(duration * 1000000),
+                'pid': 1,
+                'tid': track + 1,
+            })
+        return {'traceEvents': events}
+
+    def write_chrome_trace(self, path):
+        f = open(path, 'w')
+        try:
+            json.dump(self.chrome_trace(), f)
+        finally:
+            f.close()
+
+loop_stats = LoopStats()
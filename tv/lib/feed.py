@@ -55,6 +55,7 @@ from miro import databaselog
 from miro import dialogs
 from miro import download_utils
 from miro import eventloop
+from miro import feedparserpool
 from miro import feedupdate
 from miro import flashscraper
 from miro import models
@@ -254,7 +255,8 @@ class FeedImpl(DDBObject):
         if firstTriggerDelay >= 0:
             self.scheduler = eventloop.add_timeout(
                 firstTriggerDelay, self.update,
-                "Feed update (%s)" % self.get_title())
+                "Feed update (%s)" % self.get_title(),
+                tolerance=firstTriggerDelay * 0.1)
         else:
             if self.updateFreq > 0:
                 logging.info("scheduling update in %s minutes (%s)",
@@ -262,7 +264,8 @@ class FeedImpl(DDBObject):
                              self.get_title())
                 self.scheduler = eventloop.add_timeout(
                     self.updateFreq, self.update,
-                    "Feed update (%s)" % self.get_title())
+                    "Feed update (%s)" % self.get_title(),
+                    tolerance=self.updateFreq * 0.1)
             else:
                 logging.info("updateFreq is %s: skipping update (%s)",
                              self.updateFreq,
@@ -531,54 +534,80 @@ class Feed(DDBObject, iconcache.IconCacheOwnerMixin):
         if self.actualFeed:
             return self.actualFeed.clean_old_items()
 
+    @staticmethod
+    def _count_tracker(view):
+        return app.view_tracker_manager.get_count_tracker(view.table_name,
+                'feed_id', view.where, view.joins)
+
+    def _count_views(self):
+        return (self.downloaded_items, self.downloading_items,
+                self.available_items, self.auto_pending_items,
+                self.unwatched_items)
+
     def invalidate_counts(self):
-        for cached_count_attr in ('_num_available', '_num_unwatched',
-                '_num_downloaded', '_num_downloading'):
-            if cached_count_attr in self.__dict__:
-                del self.__dict__[cached_count_attr]
+        """Force our item counts to be re-calculated from the database."""
+        for view in self._count_views():
+            self._count_tracker(view).forget_key(self.id)
+
+    def _forget_folder_counts(self, folder_id):
+        for view in self._count_views():
+            self._count_tracker(view).forget_group(folder_id)
+
+    @classmethod
+    def _count_folder_items(cls, folder_id, view):
+        def get_feed_ids():
+            return list(cls.folder_view(folder_id).id_list())
+        return cls._count_tracker(view).group_count(folder_id, get_feed_ids)
+
+    @classmethod
+    def folder_num_unwatched(cls, folder_id):
+        """Returns the number of unwatched items in the feeds of a folder.
+        """
+        return cls._count_folder_items(folder_id,
+                models.Item.feed_unwatched_view(None))
+
+    @classmethod
+    def folder_num_available(cls, folder_id):
+        """Returns the number of available items in the feeds of a folder.
+        """
+        return (cls._count_folder_items(folder_id,
+                    models.Item.feed_available_view(None)) -
+                cls._count_folder_items(folder_id,
+                    models.Item.feed_auto_pending_view(None)))
 
     def recalc_counts(self):
-        self.invalidate_counts()
+        """Let the frontend know that our item counts may have changed.
+
+        The counts themselves are kept up to date by the CountTrackers as
+        items change.
+        """
         self.signal_change(needs_save=False)
         if self.in_folder():
             self.get_folder().signal_change(needs_save=False)
 
+    def _count_items(self, view):
+        return self._count_tracker(view).count(self.id)
+
     def num_downloaded(self):
         """Returns the number of downloaded items in the feed.
         """
-        try:
-            return self._num_downloaded
-        except AttributeError:
-            self._num_downloaded = self.downloaded_items.count()
-            return self._num_downloaded
+        return self._count_items(self.downloaded_items)
 
     def num_downloading(self):
         """Returns the number of downloading items in the feed.
         """
-        try:
-            return self._num_downloading
-        except AttributeError:
-            self._num_downloading = self.downloading_items.count()
-            return self._num_downloading
+        return self._count_items(self.downloading_items)
 
     def num_unwatched(self):
         """Returns string with number of unwatched videos in feed
         """
-        try:
-            return self._num_unwatched
-        except AttributeError:
-            self._num_unwatched = self.unwatched_items.count()
-            return self._num_unwatched
+        return self._count_items(self.unwatched_items)
 
     def num_available(self):
         """Returns string with number of available videos in feed
         """
-        try:
-            return self._num_available
-        except AttributeError:
-            self._num_available = (self.available_items.count() -
-                    self.auto_pending_items.count())
-            return self._num_available
+        return (self._count_items(self.available_items) -
+                self._count_items(self.auto_pending_items))
 
     def get_viewed(self):
         """Returns true iff this feed has been looked at
@@ -589,10 +618,6 @@ class Feed(DDBObject, iconcache.IconCacheOwnerMixin):
         """Sets the last time the feed was viewed to now
         """
         self.last_viewed = datetime.now()
-        try:
-            del self._num_available
-        except AttributeError:
-            pass
         if self.in_folder():
             self.get_folder().signal_change()
         self.signal_change()
@@ -789,6 +814,9 @@ class Feed(DDBObject, iconcache.IconCacheOwnerMixin):
             self.folder_id = new_folder.get_id()
         else:
             self.folder_id = None
+        for folder in (old_folder, new_folder):
+            if folder is not None:
+                self._forget_folder_counts(folder.id)
         self.signal_change()
         if update_trackers:
             models.Item.update_folder_trackers()
@@ -1114,6 +1142,8 @@ class Feed(DDBObject, iconcache.IconCacheOwnerMixin):
         finally:
             app.bulk_sql_manager.finish()
         self.remove_icon_cache()
+        if self.in_folder():
+            self._forget_folder_counts(self.folder_id)
         DDBObject.remove(self)
         self.actualFeed.remove()
 
@@ -1423,10 +1453,9 @@ class RSSFeedImpl(RSSFeedImplBase):
 
     def call_feedparser(self, html):
         self.ufeed.confirm_db_thread()
-        eventloop.call_in_thread(self.feedparser_callback,
-                               self.feedparser_errback,
-                               feedparserutil.parse,
-                               "Feedparser callback - %s" % self.url, html)
+        feedparserpool.parse(self.feedparser_callback,
+                             self.feedparser_errback, html,
+                             "Feedparser callback - %s" % self.url)
 
     def update(self):
         """Updates a feed
@@ -1591,10 +1620,10 @@ class RSSMultiFeedBase(RSSFeedImplBase):
                 self.feedparser_errback(self, None, url)
                 raise
         else:
-            eventloop.call_in_thread(
+            feedparserpool.parse(
                 lambda parsed, url=url: self.feedparser_callback(parsed, url),
                 lambda e, url=url: self.feedparser_errback(e, url),
-                feedparserutil.parse, "Feedparser callback - %s" % url, html)
+                html, "Feedparser callback - %s" % url)
 
     def update(self):
         self.ufeed.confirm_db_thread()
@@ -2007,16 +2036,79 @@ class DirectoryScannerImplBase(FeedImpl):
 
     def update(self):
         self.ufeed.confirm_db_thread()
+        if self.updating:
+            return
+        self.updating = True
+        self.ufeed.signal_change(needs_save=False)
+        self._start_tracking_changed_files()
 
         self._before_update()
 
         # Calculate files known about by feeds other than the directory feed
         # Using a select statement is good here because we don't want to
-        # construct all the Item objects if we don't need to.
-        known_files = set(os.path.normcase(row[0]) for row in
-                models.Item.select(['filename'],
-                    'filename IS NOT NULL AND '
-                    '(feed_id is NULL or feed_id != ?)', (self.ufeed_id,)))
+        # construct all the Item objects if we don't need to.  The query
+        # can take a while with lots of items, so run it in the background.
+        # It only sees committed changes, so we add the filenames of items
+        # that change before the update finishes in _scan_callback().
+        models.Item.select_async(['filename'],
+                'filename IS NOT NULL AND '
+                '(feed_id is NULL or feed_id != ?)', (self.ufeed_id,),
+                self._known_files_callback, self._scan_errback)
+
+    def _start_tracking_changed_files(self):
+        self._changed_files = set()
+        self._changed_files_handles = []
+        if app.item_info_cache is not None:
+            for signal in ('added', 'changed'):
+                self._changed_files_handles.append(
+                        app.item_info_cache.connect(signal,
+                            self._on_item_info_changed))
+
+    def _stop_tracking_changed_files(self):
+        for handle in self._changed_files_handles:
+            app.item_info_cache.disconnect(handle)
+        self._changed_files_handles = []
+        changed_files = self._changed_files
+        self._changed_files = set()
+        return changed_files
+
+    def _on_item_info_changed(self, item_info_cache, info):
+        if info.video_path is not None and info.feed_id != self.ufeed_id:
+            self._changed_files.add(os.path.normcase(info.video_path))
+
+    def _scan_errback(self, error):
+        self._stop_tracking_changed_files()
+        self.updating = False
+        if not self.ufeed.id_exists():
+            return
+        logging.warn("error scanning files for %s: %s", self.ufeed, error)
+        self.ufeed.signal_change(needs_save=False)
+        self.schedule_update_events(-1)
+
+    def _known_files_callback(self, rows):
+        if not self.ufeed.id_exists():
+            self._stop_tracking_changed_files()
+            self.updating = False
+            return
+        known_files = set(os.path.normcase(row[0]) for row in rows)
+        filenames = [item.get_filename() for item in self.items]
+        filenames = [f for f in filenames if f is not None]
+        # Walking the directory and checking our files can block for a
+        # while, so do it in the thread pool's fs lane.
+        def callback(result):
+            self._scan_callback(known_files, result)
+        eventloop.call_in_lane('fs', callback, self._scan_errback,
+                _scan_filesystem, 'Scan files (%s)' % self.ufeed_id,
+                self._scan_dir(), filenames)
+
+    def _scan_callback(self, known_files, result):
+        changed_files = self._stop_tracking_changed_files()
+        self.updating = False
+        if not self.ufeed.id_exists():
+            return
+        self.ufeed.signal_change(needs_save=False)
+        missing_files, media_files = result
+        known_files.update(changed_files)
         self._add_known_files(known_files)
 
         # Remove items with deleted files or that that are in feeds
@@ -2024,7 +2116,7 @@ class DirectoryScannerImplBase(FeedImpl):
         for item in self.items:
             filename = item.get_filename()
             if (filename is None or
-                not fileutil.isfile(filename) or
+                filename in missing_files or
                 os.path.normcase(filename) in known_files):
                 to_remove.append(item)
         app.bulk_sql_manager.start()
@@ -2042,16 +2134,8 @@ class DirectoryScannerImplBase(FeedImpl):
 
         # adds any files we don't know about
         # files on the filesystem
-        to_add = []
-        scan_dir = self._scan_dir()
-        if fileutil.isdir(scan_dir):
-            all_files = fileutil.miro_allfiles(scan_dir)
-            for file_ in all_files:
-                file_ = os.path.normcase(file_)
-                ufile = filename_to_unicode(file_)
-                if (file_ not in known_files and
-                        filetypes.is_media_filename(ufile)):
-                    to_add.append(file_)
+        to_add = [file_ for file_ in media_files
+                  if file_ not in known_files]
 
         app.bulk_sql_manager.start()
         try:
@@ -2063,6 +2147,26 @@ class DirectoryScannerImplBase(FeedImpl):
         self._after_update()
         self.schedule_update_events(-1)
 
+def _scan_filesystem(scan_dir, filenames):
+    """Do the blocking filesystem work for DirectoryScannerImplBase.
+
+    This runs in the thread pool's fs lane.
+
+    :param scan_dir: directory to look for media files in
+    :param filenames: filenames of the feed's current items
+    :returns: (missing_files, media_files) tuple.  missing_files is the set
+        of filenames that no longer exist, media_files lists the
+        (normcased) media files in scan_dir.
+    """
+    missing_files = set(f for f in filenames if not fileutil.isfile(f))
+    media_files = []
+    if fileutil.isdir(scan_dir):
+        for file_ in fileutil.miro_allfiles(scan_dir):
+            file_ = os.path.normcase(file_)
+            if filetypes.is_media_filename(filename_to_unicode(file_)):
+                media_files.append(file_)
+    return missing_files, media_files
+
 class DirectoryWatchFeedImpl(DirectoryScannerImplBase):
     def setup_new(self, ufeed, directory):
         # calculate url and title arguments to FeedImpl's constructor
@@ -2429,7 +2533,8 @@ def expire_items():
         for feed in Feed.make_view():
             feed.expire_items()
     finally:
-        eventloop.add_timeout(300, expire_items, "Expire Items")
+        eventloop.add_timeout(300, expire_items, "Expire Items",
+                              tolerance=30)
 
 def lookup_feed(url, search_term=None):
     try:
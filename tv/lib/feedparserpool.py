@@ -0,0 +1,354 @@
+# Miro - an RSS based video player application
+# Copyright (C) 2005, 2006, 2007, 2008, 2009, 2010, 2011
+# Participatory Culture Foundation
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
+#
+# In addition, as a special exception, the copyright holders give
+# permission to link the code of portions of this program with the OpenSSL
+# library.
+#
+# You must obey the GNU General Public License in all respects for all of
+# the code used other than OpenSSL. If you modify file(s) with this
+# exception, you may extend this exception to your version of the file(s),
+# but you are not obligated to do so. If you do not wish to do so, delete
+# this exception statement from your version. If you delete this exception
+# statement from all source files in the program, then also delete it here.
+
+
+"""``miro.feedparserpool`` -- Parse feeds in worker processes.
+
+Parsing a feed is CPU bound, pure Python work.  In a thread it holds the
+GIL and competes with the event loop, so we parse feeds in a
+multiprocessing pool instead.  FeedParserDicts can't be pickled, so the
+workers send back their results converted with
+normalize_feedparser_dict().  We turn them back into FeedParserDicts
+before handing them to the callback.  If that conversion fails, the feed
+gets parsed again in the thread pool's cpu lane.
+
+Forking a multithreaded process isn't safe, since the child can inherit
+locks that other threads were holding.  So the worker pool doesn't live in
+our process.  startup() forks a pool parent process before the backend
+starts its threads.  The parent owns the multiprocessing.Pool, and it has
+no threads except the pool's own.  It can fork fresh workers whenever it
+needs to: the pool replaces each worker after feedparserProcessMaxParses
+parses, and the parent builds a new pool if a worker gets stuck.  We talk
+to the parent over a pipe.
+
+If the pool isn't running, parse() falls back to parsing in the cpu lane.
+That happens when multiprocessing isn't available, on platforms where
+forking isn't safe, when the feedparserProcesses pref is 0, or when the
+pool parent dies.
+"""
+
+import itertools
+import logging
+import os
+import signal
+import sys
+import threading
+import time
+
+try:
+    import multiprocessing
+except ImportError:
+    multiprocessing = None
+
+from miro import app
+from miro import eventloop
+from miro import feedparserutil
+from miro import prefs
+
+class FeedParserError(StandardError):
+    """A feed couldn't be parsed in a worker process."""
+    pass
+
+def _parse_in_worker(html):
+    """Parse a feed.  This runs in the worker processes.
+
+    Returns a (success, value) tuple, where value is either the normalized
+    feed or a description of the error.  value is None if the feed parsed,
+    but we couldn't normalize it.
+    """
+    try:
+        parsed = feedparserutil.parse(html)
+    except Exception, e:
+        return False, "%s: %s" % (e.__class__.__name__, e)
+    try:
+        if parsed.get('bozo_exception') is not None:
+            # exceptions don't survive normalizing
+            parsed['bozo_exception'] = str(parsed['bozo_exception'])
+        return True, feedparserutil.normalize_feedparser_dict(parsed)
+    except Exception:
+        return True, None
+
+def _run_pool_parent(conn, processes, max_parses):
+    """Main loop for the pool parent process.
+
+    We read commands from conn:
+
+    - ('parse', parse_id, html): parse a feed in the pool and send back a
+      (parse_id, result) tuple
+    - ('restart', None, None): kill the workers and start a new pool
+    - ('quit', None, None): kill the workers and exit
+
+    We also exit when the main process closes its end of the pipe.
+    """
+    if max_parses <= 0:
+        max_parses = None
+    def make_pool():
+        return multiprocessing.Pool(processes, maxtasksperchild=max_parses)
+    def make_callback(parse_id):
+        # this runs in the pool's result thread, so only one runs at a time
+        def callback(result):
+            conn.send((parse_id, result))
+        return callback
+    pool = make_pool()
+    try:
+        while True:
+            try:
+                command, parse_id, html = conn.recv()
+            except EOFError:
+                break
+            if command == 'parse':
+                pool.apply_async(_parse_in_worker, (html,),
+                                 callback=make_callback(parse_id))
+            elif command == 'restart':
+                pool.terminate()
+                pool.join()
+                pool = make_pool()
+            elif command == 'quit':
+                break
+    finally:
+        pool.terminate()
+        pool.join()
+
+def _parse_in_thread(callback, errback, html, name):
+    eventloop.call_in_lane('cpu', callback, errback, feedparserutil.parse,
+                           name, html)
+
+class FeedParserPool(object):
+    """Pool of processes that parse feeds.
+
+    parse() should be called from the event loop thread, callbacks and
+    errbacks get called there too.
+
+    :param processes: number of worker processes
+    :param max_parses: parses before a worker gets replaced, 0 to keep
+        them forever
+    """
+    # if we don't get a result back in this long, assume the worker is
+    # stuck or died.
+    PARSE_TIMEOUT = 300
+
+    def __init__(self, processes, max_parses):
+        self.conn, parent_conn = multiprocessing.Pipe()
+        # Fork the pool parent ourselves.  A multiprocessing.Process would
+        # be daemonic, and those can't start a Pool.
+        self.parent_pid = os.fork()
+        if self.parent_pid == 0:
+            status = 0
+            try:
+                try:
+                    # close our copy of the main process's end, so that we
+                    # see EOF when it goes away
+                    self.conn.close()
+                    _run_pool_parent(parent_conn, processes, max_parses)
+                except:
+                    logging.exception("Error in feed parser pool parent")
+                    status = 1
+            finally:
+                os._exit(status)
+        parent_conn.close()
+        self.id_counter = itertools.count()
+        # maps ids to (callback, errback, timeout, html, name) tuples
+        self.pending = {}
+        self.result_thread = threading.Thread(target=self._result_loop,
+                                              name="Feed parser results")
+        self.result_thread.setDaemon(True)
+        self.result_thread.start()
+
+    def is_running(self):
+        if self.parent_pid is None:
+            return False
+        try:
+            pid, status = os.waitpid(self.parent_pid, os.WNOHANG)
+        except OSError:
+            pid = self.parent_pid
+        if pid == 0:
+            return True
+        self.parent_pid = None
+        return False
+
+    def parse(self, callback, errback, html, name):
+        parse_id = self.id_counter.next()
+        timeout = eventloop.add_timeout(self.PARSE_TIMEOUT, self._on_timeout,
+                "Feed parser timeout (%s)" % name, args=(parse_id,))
+        self.pending[parse_id] = (callback, errback, timeout, html, name)
+        try:
+            self.conn.send(('parse', parse_id, html))
+        except (IOError, OSError):
+            # the pool parent died.  parse() in this module will notice
+            # that next time and stop using us.
+            logging.warn("Error sending feed to the parser processes (%s)",
+                         name, exc_info=True)
+            self._parse_pending_in_threads()
+
+    def _result_loop(self):
+        while True:
+            try:
+                parse_id, result = self.conn.recv()
+            except (EOFError, IOError):
+                return
+            self._on_result(parse_id, result)
+
+    def _on_result(self, parse_id, result):
+        # This gets called in our result thread.  Converting back to
+        # FeedParserDicts takes a while for big feeds, so do it here rather
+        # than in the event loop.
+        try:
+            name = self.pending[parse_id][4]
+        except KeyError:
+            # timed out
+            return
+        success, value = result
+        if success and value is not None:
+            try:
+                value = feedparserutil.restore_feedparser_dict(value)
+            except StandardError:
+                logging.warn("Error restoring parsed feed (%s)", name,
+                        exc_info=True)
+                value = None
+        if success and value is None:
+            eventloop.add_idle(self._parse_in_thread_instead,
+                    "Feed parser process fallback (%s)" % name,
+                    args=(parse_id,))
+        else:
+            eventloop.add_idle(self._deliver,
+                    "Feed parser process callback (%s)" % name,
+                    args=(parse_id, success, value))
+
+    def _parse_in_thread_instead(self, parse_id):
+        # The worker parsed the feed, but we couldn't get the result back.
+        # Parse it again in the cpu lane, where it doesn't need converting.
+        try:
+            callback, errback, timeout, html, name = self.pending.pop(
+                    parse_id)
+        except KeyError:
+            # timed out
+            return
+        timeout.cancel()
+        _parse_in_thread(callback, errback, html, name)
+
+    def _deliver(self, parse_id, success, value):
+        try:
+            callback, errback, timeout, html, name = self.pending.pop(
+                    parse_id)
+        except KeyError:
+            # timed out
+            return
+        timeout.cancel()
+        if success:
+            callback(value)
+        else:
+            errback(FeedParserError(value))
+
+    def _on_timeout(self, parse_id):
+        # The worker is stuck or died.  multiprocessing.Pool never replaces
+        # a stuck worker, so ask the pool parent for a new pool.  Every
+        # parse we were waiting for was queued in the old one, so parse
+        # them in the cpu lane instead.
+        name = self.pending[parse_id][4]
+        logging.warn("Timed out waiting for feed parser process (%s), "
+                     "restarting the workers", name)
+        try:
+            self.conn.send(('restart', None, None))
+        except (IOError, OSError):
+            logging.warn("Error restarting the feed parser processes",
+                         exc_info=True)
+        self._parse_pending_in_threads()
+
+    def _parse_pending_in_threads(self):
+        pending = self.pending
+        self.pending = {}
+        for callback, errback, timeout, html, name in pending.values():
+            timeout.cancel()
+            _parse_in_thread(callback, errback, html, name)
+
+    def close(self):
+        try:
+            self.conn.send(('quit', None, None))
+        except (IOError, OSError):
+            pass
+        for i in xrange(50):
+            if not self.is_running():
+                break
+            time.sleep(0.1)
+        else:
+            logging.warn("Feed parser pool parent didn't quit, killing it")
+            os.kill(self.parent_pid, signal.SIGKILL)
+            os.waitpid(self.parent_pid, 0)
+            self.parent_pid = None
+        # the parent closing its end of the pipe stops our result thread
+        self.result_thread.join(5)
+        self.conn.close()
+
+_pool = None
+
+def can_use_processes():
+    """Check if we can parse feeds in worker processes.
+
+    multiprocessing forks without exec-ing on unix, which isn't safe on
+    OS X once Cocoa is loaded, so we only use it on Linux for now.
+    """
+    return multiprocessing is not None and sys.platform.startswith('linux')
+
+def startup():
+    """Start the pool parent process.
+
+    Call this before starting any threads, so that the pool parent gets
+    forked from a single-threaded process.
+    """
+    global _pool
+    processes = app.config.get(prefs.FEEDPARSER_PROCESSES)
+    if processes <= 0 or not can_use_processes():
+        logging.info("Parsing feeds in threads")
+        return
+    try:
+        _pool = FeedParserPool(processes,
+                app.config.get(prefs.FEEDPARSER_PROCESS_MAX_PARSES))
+    except (OSError, ImportError):
+        logging.warn("Error starting feed parser processes, parsing feeds "
+                     "in threads", exc_info=True)
+
+def shutdown():
+    global _pool
+    if _pool is not None:
+        _pool.close()
+        _pool = None
+
+def parse(callback, errback, html, name):
+    """Parse a feed.  callback will be called with the FeedParserDict for
+    it or errback will be called with an exception.
+    """
+    global _pool
+    if _pool is not None and not _pool.is_running():
+        logging.warn("Feed parser processes died, parsing feeds in threads")
+        _pool.close()
+        _pool = None
+    if _pool is not None:
+        _pool.parse(callback, errback, html, name)
+    else:
+        _parse_in_thread(callback, errback, html, name)
@@ -72,6 +72,23 @@ def _convert_if_feedparser_dict(obj):
         return normalize_feedparser_dict(obj)
     return obj
 
+def restore_feedparser_dict(value):
+    """Convert the output of normalize_feedparser_dict() back to
+    FeedParserDicts.
+
+    We can't tell which dicts were FeedParserDicts to begin with, so all
+    of them get converted.
+    """
+    if isinstance(value, dict):
+        return feedparser.FeedParserDict(dict(
+            (k, restore_feedparser_dict(v)) for (k, v) in value.items()))
+    elif isinstance(value, list):
+        return [restore_feedparser_dict(o) for o in value]
+    elif isinstance(value, tuple):
+        return tuple(restore_feedparser_dict(o) for o in value)
+    else:
+        return value
+
 from miro import app
 from miro import prefs
 USER_AGENT = (feedparser.USER_AGENT + " %s/%s (%s)" %
@@ -49,7 +49,7 @@ class FeedUpdateQueue(object):
     def schedule_update(self, delay, feed, update_callback):
         name = "Feed update (%s)" % feed.get_title()
         self.timeouts[feed.id] = eventloop.add_timeout(delay, self.do_update, 
-                name, args=(feed, update_callback))
+                name, args=(feed, update_callback), tolerance=delay * 0.1)
 
     def cancel_update(self, feed):
         try:
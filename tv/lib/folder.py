@@ -141,18 +141,12 @@ class ChannelFolder(FolderBase):
     def num_unwatched(self):
         """Returns number of unwatched items in feed.
         """
-        unwatched = 0
-        for child in self.get_children_view():
-            unwatched += child.num_unwatched()
-        return unwatched
+        return feed.Feed.folder_num_unwatched(self.id)
 
     def num_available(self):
         """Returns number of available items in feed
         """
-        available = 0
-        for child in self.get_children_view():
-            available += child.num_available()
-        return available
+        return feed.Feed.folder_num_available(self.id)
 
     def mark_as_viewed(self):
         """Marks all children as viewed.
@@ -35,6 +35,7 @@ import Queue
 from miro import app
 from miro import dialogs
 from miro import eventloop
+from miro import eventloopstats
 from miro import item
 from miro import folder
 from miro import util
@@ -424,6 +425,15 @@ class MiroInterpreter(cmd.Cmd):
             print "TEST CHOICE: %s" % dialog.choice
         d.run(callback)
 
+    @run_in_event_loop
+    def do_loopstats(self, line):
+        """loopstats [tracefile] -- Shows event loop timing stats."""
+        loop_stats = eventloopstats.loop_stats
+        print loop_stats.format_report()
+        if line:
+            loop_stats.write_chrome_trace(line)
+            print "Trace written to %s" % line
+
     @run_in_event_loop
     def do_dumpdatabase(self, line):
         """dumpdatabase -- Dumps the database."""
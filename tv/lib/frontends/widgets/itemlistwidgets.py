@@ -292,7 +292,6 @@ class ListItemView(widgetset.TableView):
         self.set_alternate_row_backgrounds(True)
         self.set_fixed_height(True)
         self.allow_multiple_select(True)
-        self.html_stripper = util.HTMLStripper()
         self.column_by_label = {}
         for name, label in widgetconst.COLUMN_LABELS.items():
             self.column_by_label[label] = unicode(name)
@@ -318,7 +317,7 @@ class ListItemView(widgetset.TableView):
         if ('name' in self._column_name_to_column and
                 self._column_name_to_column['name'] == column):
             info = self.item_list.model[iter][0]
-            text, links = self.html_stripper.strip(info.description)
+            text, links = util.stripped_html_cache.strip(info.description)
             if text:
                 if len(text) > 1000:
                     text = text[:994] + ' [...]'
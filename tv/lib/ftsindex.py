@@ -0,0 +1,448 @@
+# Miro - an RSS based video player application
+# Copyright (C) 2005, 2006, 2007, 2008, 2009, 2010, 2011
+# Participatory Culture Foundation
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
+#
+# In addition, as a special exception, the copyright holders give
+# permission to link the code of portions of this program with the OpenSSL
+# library.
+#
+# You must obey the GNU General Public License in all respects for all of
+# the code used other than OpenSSL. If you modify file(s) with this
+# exception, you may extend this exception to your version of the file(s),
+# but you are not obligated to do so. If you do not wish to do so, delete
+# this exception statement from your version. If you delete this exception
+# statement from all source files in the program, then also delete it here.
+
+"""``miro.ftsindex`` -- Persistent full-text index for item searches.
+
+ItemFTSIndex keeps an SQLite FTS table with the search text of each item.
+It's an alternative to search.NGramIndex for people with huge libraries and
+not much memory: searches run as SQL queries, so we don't need to keep the
+N-grams for every item in memory.  The table is built and updated from the
+item table itself, so it doesn't need the ItemInfoCache either.
+
+Searches work a little differently than the N-gram search.  FTS matches the
+start of words, so "vid" matches "video", but "ide" doesn't.  Multi-word
+terms (from quotes) match phrases.
+
+The index is only used if the USE_FTS_SEARCH_INDEX pref is set and SQLite
+was compiled with FTS support.
+"""
+
+import logging
+import os
+import re
+
+try:
+    import sqlite3
+except ImportError:
+    from pysqlite2 import dbapi2 as sqlite3
+
+from miro import app
+from miro import database
+from miro import models
+from miro import search
+from miro.plat.utils import filename_to_unicode
+
+# FTS modules to try, in order of preference
+FTS_MODULES = ('fts4(search_text, tokenize=unicode61)', 'fts4(search_text)',
+               'fts3(search_text)')
+WORDMATCHER = re.compile(r'\w+', re.UNICODE)
+# number of items that rebuild() reads at once
+REBUILD_CHUNK_SIZE = 1000
+# max number of ids to put in an "IN (...)" clause
+MAX_IDS_PER_QUERY = 500
+# max number of candidates that matching_ids() checks row by row.  For more
+# than this, running the MATCH over the whole table is faster.
+MAX_CANDIDATE_IDS = 2000
+
+class ItemFTSIndex(object):
+    """Keeps the item_fts table in sync with the item table.
+
+    Item calls item_changed() and item_removed() whenever an Item is
+    inserted, updated or removed.  We only remember which items changed.
+    Their search text gets calculated and written through app.db when it
+    finishes its transaction (or right before a search), so the writes get
+    committed or rolled back along with the changes that caused them.  Rows
+    whose search text didn't change aren't rewritten.
+
+    To handle crashes, we delete VERSION_KEY from dtv_variables while Miro is
+    running and set it again in shutdown().  If it's missing at startup, the
+    table could be out of sync, so we rebuild it.
+    """
+
+    TABLE_NAME = 'item_fts'
+    VERSION_KEY = 'item_fts_version'
+    # Bump this to force the table to be rebuilt
+    VERSION = 2
+
+    def __init__(self):
+        # maps item ids to the Item to write, or None to delete the row
+        self._pending = {}
+        # same as _pending, but for changes that we've written in app.db's
+        # current transaction
+        self._uncommitted = {}
+
+    @classmethod
+    def is_supported(cls, cursor):
+        """Check if SQLite has an FTS module that we can use."""
+        return cls._pick_fts_module(cursor) is not None
+
+    @classmethod
+    def _pick_fts_module(cls, cursor):
+        for module in FTS_MODULES:
+            try:
+                cursor.execute("CREATE VIRTUAL TABLE temp.fts_check "
+                               "USING %s" % module)
+            except sqlite3.OperationalError:
+                continue
+            cursor.execute("DROP TABLE temp.fts_check")
+            return module
+        return None
+
+    def setup(self):
+        """Create or check the FTS table and start tracking item changes.
+
+        After this, set app.item_fts_index so that Item tells us about its
+        changes.
+        """
+        cursor = app.db.cursor
+        if (not self._table_exists(cursor) or
+                self._saved_version() != self.VERSION):
+            self._create_table(cursor)
+            self.rebuild()
+        app.db.execute_update("DELETE FROM dtv_variables WHERE name=?",
+                              (self.VERSION_KEY,))
+        app.db.add_finish_transaction_callback(self._on_finish_transaction)
+
+    def shutdown(self):
+        """Stop tracking changes and write out the index."""
+        app.db.remove_finish_transaction_callback(self._on_finish_transaction)
+        self.flush()
+        app.db.set_variable(self.VERSION_KEY, self.VERSION)
+
+    def _table_exists(self, cursor):
+        cursor.execute("SELECT COUNT(*) FROM sqlite_master "
+                       "WHERE type='table' AND name=?", (self.TABLE_NAME,))
+        return cursor.fetchone()[0] > 0
+
+    def _saved_version(self):
+        try:
+            return app.db.get_variable(self.VERSION_KEY)
+        except KeyError:
+            return None
+
+    def _create_table(self, cursor):
+        module = self._pick_fts_module(cursor)
+        if module is None:
+            raise ValueError("SQLite doesn't support FTS")
+        app.db.execute_update("DROP TABLE IF EXISTS %s" % self.TABLE_NAME)
+        app.db.execute_update("CREATE VIRTUAL TABLE %s USING %s" %
+                              (self.TABLE_NAME, module))
+
+    def rebuild(self):
+        """Rebuild the index from scratch with a pass over the item table.
+
+        We read the columns that the search text comes from a chunk at a
+        time, so this doesn't load any Items or ItemInfos.
+        """
+        self._pending = {}
+        self._uncommitted = {}
+        app.db.execute_update("DELETE FROM %s" % self.TABLE_NAME)
+        feed_names = _calc_feed_names()
+        parent_titles = _calc_parent_titles()
+        torrent_downloader_ids = _calc_torrent_downloader_ids()
+        columns = ['id', 'title', 'entry_title', 'description',
+                   'entry_description', 'metadata', 'filename', 'feed_id',
+                   'parent_id', 'downloader_id']
+        count = 0
+        last_id = -1
+        while True:
+            rows = app.db.select(models.Item, columns,
+                    'id IN (SELECT id FROM item WHERE id > ? '
+                    'ORDER BY id LIMIT %d)' % REBUILD_CHUNK_SIZE, (last_id,))
+            if not rows:
+                break
+            inserts = []
+            for (id_, title, entry_title, description, entry_description,
+                    metadata, filename, feed_id, parent_id,
+                    downloader_id) in rows:
+                source = feed_names.get(feed_id)
+                if source is None:
+                    source = parent_titles.get(parent_id)
+                text = _calc_search_text(title, entry_title, description,
+                        entry_description, metadata, filename, source,
+                        downloader_id in torrent_downloader_ids)
+                inserts.append((id_, text))
+                last_id = max(last_id, id_)
+            app.db.execute_update("INSERT INTO %s (docid, search_text) "
+                                  "VALUES (?, ?)" % self.TABLE_NAME, inserts,
+                                  many=True)
+            count += len(inserts)
+        logging.info("Built FTS search index for %d items", count)
+
+    def item_changed(self, item):
+        """Called by Item when it's created or changed."""
+        self._pending[item.id] = item
+
+    def item_removed(self, item):
+        """Called by Item when it's removed."""
+        self._pending[item.id] = None
+
+    def _on_finish_transaction(self, commit):
+        if commit:
+            self.flush()
+        else:
+            # Our writes got rolled back.  Write them again in the next
+            # transaction.  flush() deletes the rows of items that don't
+            # exist anymore.
+            for id_, item in self._uncommitted.iteritems():
+                self._pending.setdefault(id_, item)
+        self._uncommitted = {}
+
+    def flush(self):
+        """Write pending changes to the FTS table.
+
+        This doesn't commit anything, the writes are part of app.db's
+        current transaction.
+        """
+        if not self._pending:
+            return
+        pending = self._pending
+        self._pending = {}
+        self._uncommitted.update(pending)
+        new_texts = {}
+        for id_, item in pending.iteritems():
+            if item is not None and item.id_exists():
+                new_texts[id_] = _item_search_text(item)
+        current_texts = self._current_texts(pending.keys())
+        deletes = [(id_,) for id_ in current_texts
+                   if current_texts[id_] != new_texts.get(id_)]
+        inserts = [(id_, text) for (id_, text) in new_texts.iteritems()
+                   if current_texts.get(id_) != text]
+        if deletes:
+            app.db.execute_update("DELETE FROM %s WHERE docid=?" %
+                                  self.TABLE_NAME, deletes, many=True)
+        if inserts:
+            app.db.execute_update("INSERT INTO %s (docid, search_text) "
+                                  "VALUES (?, ?)" % self.TABLE_NAME,
+                                  inserts, many=True)
+
+    def _current_texts(self, ids):
+        """Get the search text in the FTS table for a list of item ids.
+
+        :returns: dict mapping ids to their text.  Ids without a row are
+            left out.
+        """
+        cursor = app.db.cursor
+        texts = {}
+        for i in xrange(0, len(ids), MAX_IDS_PER_QUERY):
+            chunk = ids[i:i+MAX_IDS_PER_QUERY]
+            cursor.execute("SELECT docid, search_text FROM %s "
+                           "WHERE docid IN (%s)" % (self.TABLE_NAME,
+                               ', '.join('?' * len(chunk))), chunk)
+            texts.update(cursor.fetchall())
+        return texts
+
+    def where_sql(self, search_text, id_column='item.id'):
+        """Get an SQL expression that selects items matching a search.
+
+        The expression can be passed to Item.make_view() to run a search as a
+        database view.  Pending changes get written first, so that the view
+        sees them.
+
+        :param search_text: search string, as passed to search.item_matches()
+        :param id_column: column that holds the item id
+        :returns: (sql, values) tuple, sql is None for searches that match
+            everything.
+        """
+        parsed_search = search._get_boolean_search(search_text)
+        clauses = []
+        values = []
+        if parsed_search.positive_terms:
+            phrases = [_phrase_for_term(term)
+                       for term in parsed_search.positive_terms]
+            if None in phrases:
+                # a term without any words can't match anything
+                return '0', []
+            clauses.append("%s IN (SELECT docid FROM %s WHERE %s MATCH ?)" %
+                           (id_column, self.TABLE_NAME, self.TABLE_NAME))
+            values.append(' '.join(phrases))
+        phrases = [_phrase_for_term(term)
+                   for term in parsed_search.negative_terms]
+        phrases = [phrase for phrase in phrases if phrase is not None]
+        if phrases:
+            clauses.append("%s NOT IN (SELECT docid FROM %s WHERE %s MATCH ?)"
+                           % (id_column, self.TABLE_NAME, self.TABLE_NAME))
+            values.append(' OR '.join(phrases))
+        if not clauses:
+            return None, []
+        self.flush()
+        return ' AND '.join(clauses), values
+
+    def matching_ids(self, search_text, candidates=None):
+        """Get the ids of the items that match a search.
+
+        :param candidates: if given, only ids in this set are returned.
+            If there aren't too many, we look up their rows and match the
+            text in memory rather than running the search over the whole
+            table.
+        :returns: set of item ids
+        """
+        self.flush()
+        if candidates is not None and len(candidates) <= MAX_CANDIDATE_IDS:
+            parsed_search = search._get_boolean_search(search_text)
+            texts = self._current_texts(list(candidates))
+            return set(id_ for id_, text in texts.iteritems()
+                       if _text_matches(text, parsed_search))
+        sql = "SELECT docid FROM %s" % self.TABLE_NAME
+        where, values = self.where_sql(search_text, 'docid')
+        if where is not None:
+            sql += " WHERE " + where
+        cursor = app.db.cursor
+        cursor.execute(sql, values)
+        matches = set(row[0] for row in cursor.fetchall())
+        if candidates is not None:
+            matches &= candidates
+        return matches
+
+    def info_matches(self, info, search_text):
+        """Check if a single ItemInfo matches a search.
+
+        We look up the item's row by docid and match its text in memory,
+        using the same rules as the FTS query, so it's cheap enough to call
+        for each item that changes.  Items that were just removed don't
+        have a row anymore, for those we use the ItemInfo's search text.
+        """
+        self.flush()
+        text = self._current_texts([info.id]).get(info.id)
+        if text is None:
+            text = search.calc_search_text(info)
+        return _text_matches(text, search._get_boolean_search(search_text))
+
+def _text_matches(text, parsed_search):
+    """Match a row's search text in memory, the same way MATCH would."""
+    words = WORDMATCHER.findall(text)
+    for term in parsed_search.positive_terms:
+        if not _words_match_term(words, term):
+            return False
+    for term in parsed_search.negative_terms:
+        if WORDMATCHER.search(term) and _words_match_term(words, term):
+            return False
+    return True
+
+def _calc_title(title, metadata, entry_title):
+    """Item.get_title(), without the fallbacks that aren't searchable."""
+    if title:
+        return title
+    if metadata and metadata.get('title'):
+        return metadata['title']
+    return entry_title
+
+def _calc_search_text(title, entry_title, description, entry_description,
+                      metadata, filename, source, torrent):
+    """Calculate the text that we index for an item.
+
+    This follows search.calc_search_text(), but works from the item's
+    columns, so that rebuild() doesn't need Items or ItemInfos.
+
+    :param source: title of the item's feed or parent, like
+        Item.get_source()
+    :param torrent: True if the item's downloader is a torrent download
+    """
+    if metadata is None:
+        metadata = {}
+    match_against = [_calc_title(title, metadata, entry_title) or u'',
+                     description or entry_description or u'',
+                     metadata.get('artist') or u'',
+                     metadata.get('album') or u'',
+                     metadata.get('genre') or u'']
+    if source:
+        match_against.append(source)
+    if torrent:
+        match_against.append(u'torrent')
+    if filename:
+        match_against.append(filename_to_unicode(os.path.basename(filename)))
+    return (u' '.join(match_against)).lower()
+
+def _item_search_text(item):
+    source = None
+    if item.feed_id is not None:
+        feed = item.get_feed()
+        if feed.origURL != 'dtv:manualFeed':
+            source = feed.get_title()
+    if source is None and item.parent_id is not None:
+        try:
+            parent = item.get_parent()
+        except database.ObjectNotFoundError:
+            pass
+        else:
+            source = _calc_title(parent.title, parent.metadata,
+                                 parent.entry_title)
+    downloader = item.downloader
+    torrent = (downloader is not None and
+               downloader.contentType == u'application/x-bittorrent')
+    return _calc_search_text(item.title, item.entry_title, item.description,
+                             item.entry_description, item.metadata,
+                             item.filename, source, torrent)
+
+def _calc_feed_names():
+    """Map feed ids to the name that items in that feed are searched with.
+    """
+    feed_names = {}
+    for feed in models.Feed.make_view():
+        if feed.origURL != 'dtv:manualFeed':
+            feed_names[feed.id] = feed.get_title()
+    return feed_names
+
+def _calc_parent_titles():
+    """Map the ids of container items to their titles."""
+    rows = app.db.select(models.Item, ['id', 'title', 'metadata',
+                                       'entry_title'], 'isContainerItem', ())
+    return dict((id_, _calc_title(title, metadata, entry_title))
+                for (id_, title, metadata, entry_title) in rows)
+
+def _calc_torrent_downloader_ids():
+    rows = app.db.select(models.RemoteDownloader, ['id'], 'contentType=?',
+                         (u'application/x-bittorrent',))
+    return set(row[0] for row in rows)
+
+def _phrase_for_term(term):
+    """Convert a search term to an FTS phrase query that matches the start
+    of the term's last word.
+
+    Returns None if the term doesn't contain any words.
+    """
+    words = WORDMATCHER.findall(term)
+    if not words:
+        return None
+    return '"%s*"' % ' '.join(words)
+
+def _words_match_term(words, term):
+    """Python version of the phrase query from _phrase_for_term().
+
+    :param words: lowercase words of an item's search text
+    """
+    term_words = WORDMATCHER.findall(term)
+    if not term_words:
+        return False
+    count = len(term_words)
+    for i in xrange(len(words) - count + 1):
+        if (words[i:i+count-1] == term_words[:-1] and
+                words[i+count-1].startswith(term_words[-1])):
+            return True
+    return False
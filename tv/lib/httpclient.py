@@ -51,6 +51,7 @@ from miro import eventloop
 from miro import fileutil
 from miro import httpauth
 from miro import net
+from miro import poller
 from miro import prefs
 from miro import signals
 from miro import util
@@ -793,8 +794,19 @@ class LibCURLManager(eventloop.SimpleEventLoop):
     def call_after_perform(self, callback):
         self.after_perform_callbacks.append(callback)
 
-    def calc_fds(self):
-        return self.multi.fdset()
+    def make_poller(self):
+        # we hand the poller libcurl's complete fd list on each pass, which
+        # doesn't work with epoll's registrations
+        return poller.make_stateless_poller()
+
+    def update_poller(self):
+        # libcurl gives us the complete list of fds each time.  The poller
+        # only re-registers the ones that changed.
+        read_fds, write_fds, exc_fds = self.multi.fdset()
+        read_fds = set(read_fds)
+        read_fds.update(exc_fds)
+        read_fds.add(self.wake_receiver.fileno())
+        self.poller.set_fds(read_fds, write_fds)
 
     def calc_timeout(self):
         timeout = self.multi.timeout()
@@ -805,7 +817,7 @@ class LibCURLManager(eventloop.SimpleEventLoop):
         else:
             return timeout / 1000.0
 
-    def process_events(self, readfds, writefds, excfds):
+    def process_events(self, readfds, writefds):
         self.process_queues()
         while True:
             rv, num_handles = self.multi.perform()
@@ -165,7 +165,8 @@ class IconCache(DDBObject):
             self.needsUpdate = False
             self.request_update(True)
         elif error is not None:
-            eventloop.add_timeout(3600, self.request_update, "Thumbnail request for %s" % url)
+            eventloop.add_timeout(3600, self.request_update,
+                    "Thumbnail request for %s" % url, tolerance=60)
         iconCacheUpdater.update_finished()
 
     def update_icon_cache(self, url, info):
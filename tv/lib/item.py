@@ -379,9 +379,13 @@ class Item(DDBObject, iconcache.IconCacheOwnerMixin):
 
     def after_setup_new(self):
         app.item_info_cache.item_created(self)
+        if app.item_fts_index is not None:
+            app.item_fts_index.item_changed(self)
 
     def signal_change(self, needs_save=True):
         app.item_info_cache.item_changed(self)
+        if app.item_fts_index is not None:
+            app.item_fts_index.item_changed(self)
         DDBObject.signal_change(self, needs_save)
 
     @classmethod
@@ -1823,6 +1827,8 @@ class Item(DDBObject, iconcache.IconCacheOwnerMixin):
         # need to call this after DDBObject.remove(), so that the item info is
         # there for ItemInfoFetcher to see.
         app.item_info_cache.item_removed(self)
+        if app.item_fts_index is not None:
+            app.item_fts_index.item_removed(self)
 
     def setup_links(self):
         self.split_item()
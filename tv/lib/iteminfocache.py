@@ -46,17 +46,39 @@ The general strategy is to just dumbly pickle the data and if we notice any
 errors, or if the DB version changes, throw away the cache and rebuild.  We
 use a lot of direct SQL queries in this code, borrowing app.db's cursor.  This
 is slightly naughty, but results in fast peformance.
+
+We don't pickle the ItemInfo objects themselves.  Each row stores a compact
+record: a tuple of the ItemInfo's attribute values, in the order of
+DatabaseItemSource.INFO_FIELDS.  Attributes that ItemInfo can calculate on
+its own (description_stripped and search_ngrams) are left out, they get
+calculated the first time they're used.
+
+Saving happens in a separate thread (see ItemInfoCacheWriter), so that the
+event loop doesn't have to pickle the infos and wait for SQLite.
 """
 
 import cPickle
+import gc
+import itertools
 import logging
+import Queue
+import threading
+
+try:
+    import sqlite3
+except ImportError:
+    from pysqlite2 import dbapi2 as sqlite3
 
 from miro import app
 from miro import eventloop
 from miro import itemsource
+from miro import messages
 from miro import models
 from miro import schema
+from miro import search
 from miro import signals
+from miro import util
+from miro.plat.utils import thread_body
 
 class ItemInfoCache(signals.SignalEmitter):
     """ItemInfoCache stores the latest ItemInfo objects for each item
@@ -78,6 +100,14 @@ class ItemInfoCache(signals.SignalEmitter):
     # how often should we save cache data to the DB? (in seconds)
     SAVE_INTERVAL = 30
     VERSION_KEY = 'item_info_cache_db_version'
+    # Bump this whenever the record format changes.  Version 1 was pickled
+    # ItemInfo objects.
+    RECORD_VERSION = 2
+    # attributes stored in each record
+    RECORD_FIELDS = ('id',) + itemsource.DatabaseItemSource.INFO_FIELDS
+    CHILDREN_INDEX = RECORD_FIELDS.index('children')
+    INTERNED_INDEXES = tuple(map(RECORD_FIELDS.index,
+            itemsource.INTERNED_FIELDS))
 
     def __init__(self):
         signals.SignalEmitter.__init__(self)
@@ -86,6 +116,9 @@ class ItemInfoCache(signals.SignalEmitter):
         self.create_signal('removed')
         self.id_to_info = None
         self.loaded = False
+        self._save_dc = None
+        self._writer = None
+        self._search_index = None
 
     def load(self):
         did_failsafe_load = False
@@ -99,6 +132,7 @@ class ItemInfoCache(signals.SignalEmitter):
             app.db.cursor.execute("DELETE FROM item_info_cache")
             did_failsafe_load = True
         app.db.set_variable(self.VERSION_KEY, self.version())
+        self._search_index = None
         self._reset_changes()
         self._save_dc = None
         if did_failsafe_load:
@@ -108,14 +142,36 @@ class ItemInfoCache(signals.SignalEmitter):
         self.loaded = True
 
     def version(self):
-        return "%s-%s" % (schema.VERSION,
-                          itemsource.DatabaseItemSource.VERSION)
+        return "%s-%s-%s" % (schema.VERSION,
+                             itemsource.DatabaseItemSource.VERSION,
+                             self.RECORD_VERSION)
+
+    def _info_to_record(self, info):
+        attrs = info.__dict__
+        record = [attrs[name] for name in self.RECORD_FIELDS]
+        record[self.CHILDREN_INDEX] = [self._info_to_record(child)
+                for child in record[self.CHILDREN_INDEX]]
+        return tuple(record)
+
+    def _record_to_info(self, record):
+        # Unpickling creates separate copies of the strings for each record,
+        # intern the ones that get repeated a lot.
+        record = list(record)
+        for i in self.INTERNED_INDEXES:
+            record[i] = util.intern_string(record[i])
+        info = messages.ItemInfo.__new__(messages.ItemInfo)
+        info.__dict__ = dict(itertools.izip(self.RECORD_FIELDS, record))
+        if info.children:
+            info.children = [self._record_to_info(child_record)
+                    for child_record in info.children]
+        return info
 
     def _info_to_blob(self, info):
-        return buffer(cPickle.dumps(info))
+        return buffer(cPickle.dumps(self._info_to_record(info),
+                                    cPickle.HIGHEST_PROTOCOL))
 
     def _blob_to_info(self, blob):
-        return cPickle.loads(str(blob))
+        return self._record_to_info(cPickle.loads(str(blob)))
 
     def _quick_load(self):
         """Load ItemInfos using the item_info_cache table
@@ -123,16 +179,30 @@ class ItemInfoCache(signals.SignalEmitter):
         This is much faster than _failsafe_load(), but could result in errors.
         """
         saved_db_version = app.db.get_variable(self.VERSION_KEY)
-        if saved_db_version == self.version():
-            quick_load_values = {}
-            app.db.cursor.execute("SELECT id, pickle FROM item_info_cache")
-            for row in app.db.cursor:
-                quick_load_values[row[0]] = self._blob_to_info(row[1])
-            # double check that we have the right number of rows
-            app.db.cursor.execute("SELECT COUNT(*) from item")
-            item_count = app.db.cursor.fetchone()[0]
-            if item_count == len(quick_load_values):
-                self.id_to_info = quick_load_values
+        if saved_db_version != self.version():
+            return
+        # double check that we have the right number of rows before doing
+        # any real work
+        app.db.cursor.execute("SELECT COUNT(*) from item")
+        item_count = app.db.cursor.fetchone()[0]
+        app.db.cursor.execute("SELECT COUNT(*) from item_info_cache")
+        if app.db.cursor.fetchone()[0] != item_count:
+            return
+        app.db.cursor.execute("SELECT id, pickle FROM item_info_cache")
+        rows = app.db.cursor.fetchall()
+        blob_to_info = self._blob_to_info
+        # We create a couple container objects for each row, which makes the
+        # cyclic garbage collector run over and over again while we load.
+        # None of them can be part of a cycle, so turn it off until we're
+        # done.
+        gc_was_enabled = gc.isenabled()
+        gc.disable()
+        try:
+            self.id_to_info = dict((id_, blob_to_info(blob))
+                                   for (id_, blob) in rows)
+        finally:
+            if gc_was_enabled:
+                gc.enable()
 
     def _failsafe_load(self):
         """Load ItemInfos using Item objects.
@@ -158,40 +228,101 @@ class ItemInfoCache(signals.SignalEmitter):
         self._infos_deleted = set()
 
     def save(self):
-        app.db.cursor.execute("BEGIN TRANSACTION")
-        try:
-            self._run_inserts()
-            self._run_updates()
-            self._run_deletes()
-        except:
-            app.db.cursor.execute("ROLLBACK TRANSACTION")
-            raise
-        else:
-            app.db.cursor.execute("COMMIT TRANSACTION")
-        self._reset_changes()
+        """Save the changes since the last call to save().
 
-    def _run_inserts(self):
-        if not self._infos_added:
+        If the database supports it, the changes get handed off to our
+        ItemInfoCacheWriter and written out in its thread.  Otherwise we
+        write them using app.db's cursor.
+        """
+        self._save_dc = None
+        snapshot = SaveSnapshot(self._infos_added, self._infos_changed,
+                                frozenset(self._infos_deleted))
+        # Use new containers for future changes, the snapshot now owns the
+        # old ones.
+        self._reset_changes()
+        if snapshot.is_empty():
             return
-        sql = "INSERT INTO item_info_cache (id, pickle) VALUES (?, ?)"
-        values = ((id, self._info_to_blob(info)) for (id,
-            info) in self._infos_added.iteritems())
-        app.db.cursor.executemany(sql, values)
+        if (self._writer is None and
+                app.db.supports_worker_connections()):
+            self._writer = ItemInfoCacheWriter(self, app.db.path)
+            self._writer.start_thread()
+        if self._writer is not None:
+            self._writer.add_snapshot(snapshot)
+        else:
+            self._write_snapshot(app.db.cursor, snapshot)
 
-    def _run_updates(self):
-        if not self._infos_changed:
-            return
-        sql = "UPDATE item_info_cache SET PICKLE=? WHERE id=?"
-        values = ((self._info_to_blob(info), id) for (id, info) in
-                self._infos_changed.iteritems())
-        app.db.cursor.executemany(sql, values)
+    def flush(self):
+        """Save our changes and wait until they are written to disk.
 
-    def _run_deletes(self):
-        if not self._infos_deleted:
-            return
-        id_list = ', '.join(str(id_) for id_ in self._infos_deleted)
-        app.db.cursor.execute("DELETE FROM item_info_cache "
-                "WHERE id IN (%s)" % id_list)
+        Only call this when app.db doesn't have uncommitted changes (not in
+        the middle of an event).  Otherwise app.db holds the write lock that
+        the writer thread is waiting for.
+        """
+        self.save()
+        if self._writer is not None:
+            self._writer.wait()
+
+    def stop_writer(self):
+        """Stop our writer thread, after it writes out all the changes that
+        it has been given.
+
+        Like flush(), only call this when app.db doesn't have uncommitted
+        changes.
+        """
+        if self._writer is not None:
+            self._writer.shutdown()
+            self._writer = None
+
+    def invalidate_saved_data(self):
+        """Make sure that we do a failsafe load the next time we start.
+
+        This is called when some of our changes couldn't be saved.
+        """
+        app.db.execute_update("DELETE FROM dtv_variables WHERE name=?",
+                              (self.VERSION_KEY,))
+
+    def shutdown(self):
+        """Save our changes and stop the writer thread.
+
+        After this returns, everything has been written to disk, so it's safe
+        to close app.db.
+        """
+        if self._save_dc is not None:
+            self._save_dc.cancel()
+            self._save_dc = None
+        if self.loaded:
+            self.save()
+        self.stop_writer()
+
+    def _write_snapshot(self, cursor, snapshot):
+        """Write the changes in a SaveSnapshot to the database.
+
+        This gets called from the writer thread, so it can't touch anything
+        besides snapshot and cursor.
+        """
+        # Pickle everything first, so that we hold the write lock for as
+        # short a time as possible.
+        inserts = [(id_, self._info_to_blob(info))
+                   for (id_, info) in snapshot.added.iteritems()]
+        updates = [(self._info_to_blob(info), id_)
+                   for (id_, info) in snapshot.changed.iteritems()]
+        cursor.execute("BEGIN IMMEDIATE TRANSACTION")
+        try:
+            if inserts:
+                cursor.executemany("INSERT INTO item_info_cache "
+                        "(id, pickle) VALUES (?, ?)", inserts)
+            if updates:
+                cursor.executemany("UPDATE item_info_cache SET pickle=? "
+                        "WHERE id=?", updates)
+            if snapshot.deleted:
+                id_list = ', '.join(str(id_) for id_ in snapshot.deleted)
+                cursor.execute("DELETE FROM item_info_cache "
+                        "WHERE id IN (%s)" % id_list)
+        except:
+            cursor.execute("ROLLBACK TRANSACTION")
+            raise
+        else:
+            cursor.execute("COMMIT TRANSACTION")
 
     def all_infos(self):
         """Return all ItemInfo objects that in the database.
@@ -204,6 +335,16 @@ class ItemInfoCache(signals.SignalEmitter):
         """Get the ItemInfo for a given item id"""
         return self.id_to_info[id_]
 
+    def search_index(self):
+        """Get a search.NGramIndex for all the ItemInfos in the cache.
+
+        The index gets built the first time this is called.  After that, we
+        update it whenever we emit the added, changed or removed signals.
+        """
+        if self._search_index is None:
+            self._search_index = search.NGramIndex(self.id_to_info.values())
+        return self._search_index
+
     def item_created(self, item):
         if not self.loaded:
             # New item created in Item.setup_restored(), while we were doing a
@@ -213,6 +354,8 @@ class ItemInfoCache(signals.SignalEmitter):
         self.id_to_info[item.id] = info
         self._infos_added[item.id] = info
         self.schedule_save_to_db()
+        if self._search_index is not None:
+            self._search_index.add_info(info)
         self.emit("added", info)
 
     def item_changed(self, item):
@@ -223,7 +366,8 @@ class ItemInfoCache(signals.SignalEmitter):
         if item.id not in self.id_to_info:
             # signal_change() called inside setup_new(), just ignor it
             return
-        info = itemsource.DatabaseItemSource._item_info_for(item)
+        info = itemsource.DatabaseItemSource._updated_item_info(item,
+                self.id_to_info[item.id])
         self.id_to_info[item.id] = info
         if item.id in self._infos_added:
             # no need to update if we insert the new values
@@ -231,6 +375,8 @@ class ItemInfoCache(signals.SignalEmitter):
         else:
             self._infos_changed[item.id] = info
         self.schedule_save_to_db()
+        if self._search_index is not None:
+            self._search_index.update_info(info)
         self.emit("changed", info)
 
     def item_removed(self, item):
@@ -250,8 +396,107 @@ class ItemInfoCache(signals.SignalEmitter):
         else:
             self._infos_deleted.add(item.id)
         self.schedule_save_to_db()
+        if self._search_index is not None:
+            self._search_index.remove_info(info)
         self.emit("removed", info)
 
+class SaveSnapshot(object):
+    """Changes to the item info cache that ItemInfoCache.save() passes off
+    to be written.
+
+    Once a snapshot is created, nothing changes its containers.  The infos
+    are never changed in place (see ItemInfo.updated()), so it's safe to read
+    a snapshot from another thread.
+    """
+    def __init__(self, added, changed, deleted):
+        self.added = added
+        self.changed = changed
+        self.deleted = deleted
+
+    def is_empty(self):
+        return not (self.added or self.changed or self.deleted)
+
+class ItemInfoCacheWriter(object):
+    """Writes item info cache changes to the database in a separate thread.
+
+    The thread has its own connection to the database.  Since the database
+    uses a write-ahead log, it only blocks the event loop's connection while
+    it's actually running its INSERT/UPDATE/DELETE statements.
+    """
+
+    # how long to wait for the event loop's connection to release the write
+    # lock (in seconds).  This should match LiveStorage.BUSY_TIMEOUT.
+    BUSY_TIMEOUT = 60
+
+    def __init__(self, cache, path):
+        self.cache = cache
+        self.path = path
+        self.queue = Queue.Queue()
+        self.thread = None
+
+    def start_thread(self):
+        self.thread = threading.Thread(name='Item Info Cache Writer',
+                                       target=thread_body,
+                                       args=[self.thread_loop])
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def add_snapshot(self, snapshot):
+        self.queue.put(snapshot)
+
+    def wait(self):
+        """Wait for all snapshots passed to add_snapshot() to be written."""
+        self.queue.join()
+
+    def shutdown(self):
+        # Wake up our thread.  It writes out the snapshots that are already
+        # in the queue before it sees this.
+        self.queue.put(None)
+        if self.thread is not None:
+            self.thread.join()
+
+    def thread_loop(self):
+        try:
+            connection = sqlite3.connect(self.path, isolation_level=None,
+                    timeout=self.BUSY_TIMEOUT)
+        except:
+            logging.warn("error opening item info cache connection",
+                    exc_info=True)
+            connection = None
+        try:
+            while True:
+                snapshot = self.queue.get(block=True)
+                try:
+                    if snapshot is None:
+                        # shutdown() was called
+                        break
+                    self.write_snapshot(connection, snapshot)
+                finally:
+                    # always call task_done(), otherwise wait() would never
+                    # return
+                    self.queue.task_done()
+        finally:
+            if connection is not None:
+                connection.close()
+
+    def write_snapshot(self, connection, snapshot):
+        try:
+            self.cache._write_snapshot(connection.cursor(), snapshot)
+        except:
+            logging.warn("error saving item info cache", exc_info=True)
+            # We lost some changes, so the cache data can't be trusted
+            # anymore.  Delete the version key, which forces a failsafe load
+            # the next time we start up.  If we can't do that from our
+            # connection, have the event loop do it.
+            try:
+                connection.execute("DELETE FROM dtv_variables WHERE name=?",
+                        (ItemInfoCache.VERSION_KEY,))
+            except:
+                logging.warn("error invalidating item info cache",
+                        exc_info=True)
+                eventloop.add_idle(self.cache.invalidate_saved_data,
+                        'invalidate item info cache')
+
 def create_sql():
     """Get the SQL needed to create the tables we need for the ItemInfo cache
     """
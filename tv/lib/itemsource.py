@@ -28,12 +28,14 @@
 # statement from all source files in the program, then also delete it here.
 
 import datetime
+from operator import attrgetter, methodcaller
 
 from miro import app
 from miro import database
 from miro import devices
 from miro import messages
 from miro import signals
+from miro import util
 
 class ItemSource(signals.SignalEmitter):
     """
@@ -89,11 +91,33 @@ class ItemSource(signals.SignalEmitter):
     def set_limiter(self, limiter):
         """
         Set the current limiter and reset the list.
+
+        If the new limiter refines the current one, only the items that
+        currently pass the limiter need to be checked.
         """
+        old_limiter = self.limiter
         self.limiter = limiter
-        infos = self.fetch() # resets current_ids
+        if (limiter is not None and old_limiter is not None and
+                limiter.refines(old_limiter)):
+            matching_ids = limiter.refine_ids(self.current_ids)
+            if matching_ids is not None:
+                self.current_ids = matching_ids
+                infos = list(self.fetch_current())
+            else:
+                infos = list(limiter.filter_list(self.fetch_current()))
+            self.current_ids = set(info.id for info in infos)
+        else:
+            infos = self.fetch() # resets current_ids
         self.emit('new-list', infos)
 
+    def fetch_current(self):
+        """
+        Returns the ItemInfos for the items in current_ids.  Subclasses can
+        override this if they have a faster way than calling fetch_all().
+        """
+        return [info for info in self.fetch_all()
+                if info.id in self.current_ids]
+
     def fetch(self):
         """
         Fetch all the ItemInfos which match the current limiter.
@@ -106,6 +130,132 @@ class ItemSource(signals.SignalEmitter):
         self.current_ids = set(info.id for info in infos)
         return infos
 
+# Functions that calculate ItemInfo attributes from Item objects.  The
+# attributes that come from related objects are calculated in
+# DatabaseItemSource._related_fields().
+_FIELD_GETTERS = {
+    'name': methodcaller('get_title'),
+    'feed_id': attrgetter('feed_id'),
+    'feed_name': methodcaller('get_source'),
+    'feed_url': methodcaller('get_feed_url'),
+    'description': methodcaller('get_description'),
+    'state': methodcaller('get_state'),
+    'release_date': methodcaller('get_release_date_obj'),
+    'size': methodcaller('get_size'),
+    'duration': methodcaller('get_duration_value'),
+    'resume_time': attrgetter('resumeTime'),
+    'permalink': methodcaller('get_link'),
+    'commentslink': methodcaller('get_comments_link'),
+    'payment_link': methodcaller('get_payment_link'),
+    'has_sharable_url': methodcaller('has_shareable_url'),
+    'can_be_saved': methodcaller('show_save_button'),
+    'pending_manual_dl': methodcaller('is_pending_manual_download'),
+    'pending_auto_dl': methodcaller('is_pending_auto_download'),
+    'item_viewed': methodcaller('get_viewed'),
+    'downloaded': methodcaller('is_downloaded'),
+    'is_external': methodcaller('is_external'),
+    'video_watched': methodcaller('get_seen'),
+    'video_path': methodcaller('get_filename'),
+    'thumbnail': methodcaller('get_thumbnail'),
+    'thumbnail_url': methodcaller('get_thumbnail_url'),
+    'file_format': methodcaller('get_format'),
+    'license': methodcaller('get_license'),
+    'file_url': methodcaller('get_url'),
+    'is_container_item': attrgetter('isContainerItem'),
+    'is_playable': methodcaller('is_playable'),
+    'file_type': attrgetter('file_type'),
+    'subtitle_encoding': attrgetter('subtitle_encoding'),
+    'media_type_checked': attrgetter('media_type_checked'),
+    'seeding_status': methodcaller('torrent_seeding_status'),
+    'mime_type': attrgetter('enclosure_type'),
+    'artist': methodcaller('get_artist'),
+    'album': methodcaller('get_album'),
+    'track': methodcaller('get_track'),
+    'year': methodcaller('get_year'),
+    'genre': methodcaller('get_genre'),
+    'rating': methodcaller('get_rating'),
+    'date_added': methodcaller('get_creation_time'),
+    'last_played': methodcaller('get_watched_time'),
+    'device': lambda item: None,
+    'play_count': attrgetter('play_count'),
+    'skip_count': attrgetter('skip_count'),
+    'cover_art': methodcaller('get_cover_art'),
+    'auto_rating': methodcaller('get_auto_rating'),
+}
+
+# ItemInfo attributes that have the same few values for lots of items.  We
+# intern these so that every ItemInfo shares one copy of each value.
+INTERNED_FIELDS = ('feed_name', 'feed_url', 'file_format', 'file_type',
+                   'mime_type', 'license', 'artist', 'album', 'genre')
+
+def _interned(getter):
+    return lambda item: util.intern_string(getter(item))
+
+for _name in INTERNED_FIELDS:
+    _FIELD_GETTERS[_name] = _interned(_FIELD_GETTERS[_name])
+del _name
+
+# Maps Item columns to the ItemInfo attributes that are calculated only from
+# the item's own columns.  When an item changes, we recalculate the
+# attributes for the changed columns, plus _VOLATILE_FIELDS.  A change to a
+# column that's not listed here makes us recalculate everything.
+_COLUMN_DEPENDENCIES = {
+    'title': ('name',),
+    'entry_title': ('name',),
+    'metadata': ('name', 'artist', 'album', 'track', 'year', 'genre'),
+    'filename': ('name', 'video_path'),
+    'duration': ('duration',),
+    'resumeTime': ('resume_time',),
+    'link': ('permalink',),
+    'comments_link': ('commentslink',),
+    'payment_link': ('payment_link',),
+    'url': ('has_sharable_url', 'file_url'),
+    'pendingManualDL': ('pending_manual_dl',),
+    'seen': ('video_watched',),
+    'thumbnail_url': ('thumbnail_url',),
+    'isContainerItem': ('is_container_item',),
+    'file_type': ('file_type',),
+    'subtitle_encoding': ('subtitle_encoding',),
+    'media_type_checked': ('media_type_checked',),
+    'enclosure_type': ('mime_type',),
+    'rating': ('rating',),
+    'creationTime': ('date_added',),
+    'play_count': ('play_count', 'auto_rating'),
+    'skip_count': ('skip_count', 'auto_rating'),
+    'cover_art': ('cover_art',),
+    # these columns are only used by volatile attributes
+    'autoDownloaded': (),
+    'channelTitle': (),
+    'description': (),
+    'downloadedTime': (),
+    'downloader_id': (),
+    'eligibleForAutoDownload': (),
+    'enclosure_format': (),
+    'enclosure_size': (),
+    'entry_description': (),
+    'expired': (),
+    'deleted': (),
+    'icon_cache_id': (),
+    'keep': (),
+    'license': (),
+    'pendingReason': (),
+    'releaseDateObj': (),
+    'screenshot': (),
+    'was_downloaded': (),
+    'watchedTime': (),
+}
+
+# Everything else depends on feeds, downloaders, parent/child items, icon
+# caches or state that's not stored in the item's columns, so it gets
+# recalculated on every change.
+_VOLATILE_FIELDS = frozenset(_FIELD_GETTERS).difference(
+    *_COLUMN_DEPENDENCIES.values())
+
+# ItemInfo attributes calculated in DatabaseItemSource._related_fields()
+_RELATED_FIELDS = ('children', 'expiration_date', 'download_info',
+        'leechers', 'seeders', 'up_rate', 'down_rate', 'up_total',
+        'down_total', 'up_down_ratio')
+
 class DatabaseItemSource(ItemSource):
     """
     An ItemSource which pulls its data from the database, along with
@@ -116,6 +266,9 @@ class DatabaseItemSource(ItemSource):
     # Item.get_description()).
     VERSION = 8
 
+    # names of all the attributes we set for ItemInfo objects (besides id)
+    INFO_FIELDS = tuple(sorted(_FIELD_GETTERS)) + _RELATED_FIELDS
+
     def __init__(self, view, use_cache=True):
         ItemSource.__init__(self)
         # use_cache=False for priming the cache
@@ -132,49 +285,37 @@ class DatabaseItemSource(ItemSource):
 
     @staticmethod
     def _item_info_for(item):
+        info = dict((name, getter(item))
+                    for name, getter in _FIELD_GETTERS.iteritems())
+        info.update(DatabaseItemSource._related_fields(item))
+        return messages.ItemInfo(item.id, **info)
+
+    @staticmethod
+    def _updated_item_info(item, old_info):
+        """Get a new ItemInfo for an item that changed.
+
+        We only recalculate the attributes that depend on the item's changed
+        columns (see _COLUMN_DEPENDENCIES), plus the ones in _VOLATILE_FIELDS.
+        If a column changed that we don't know about, we recalculate
+        everything.  old_info isn't modified.
+        """
+        fields = set(_VOLATILE_FIELDS)
+        for name in item.changed_attributes:
+            try:
+                fields.update(_COLUMN_DEPENDENCIES[name])
+            except KeyError:
+                fields = _FIELD_GETTERS.keys()
+                break
+        changes = dict((name, _FIELD_GETTERS[name](item)) for name in fields)
+        changes.update(DatabaseItemSource._related_fields(item))
+        return old_info.updated(changes)
+
+    @staticmethod
+    def _related_fields(item):
+        """Calculate the ItemInfo attributes that come from child items, the
+        item's feed and its downloader.
+        """
         info = {
-            'name': item.get_title(),
-            'feed_id': item.feed_id,
-            'feed_name': item.get_source(),
-            'feed_url': item.get_feed_url(),
-            'description': item.get_description(),
-            'state': item.get_state(),
-            'release_date': item.get_release_date_obj(),
-            'size': item.get_size(),
-            'duration': item.get_duration_value(),
-            'resume_time': item.resumeTime,
-            'permalink': item.get_link(),
-            'commentslink': item.get_comments_link(),
-            'payment_link': item.get_payment_link(),
-            'has_sharable_url': item.has_shareable_url(),
-            'can_be_saved': item.show_save_button(),
-            'pending_manual_dl': item.is_pending_manual_download(),
-            'pending_auto_dl': item.is_pending_auto_download(),
-            'item_viewed': item.get_viewed(),
-            'downloaded': item.is_downloaded(),
-            'is_external': item.is_external(),
-            'video_watched': item.get_seen(),
-            'video_path': item.get_filename(),
-            'thumbnail': item.get_thumbnail(),
-            'thumbnail_url': item.get_thumbnail_url(),
-            'file_format': item.get_format(),
-            'license': item.get_license(),
-            'file_url': item.get_url(),
-            'is_container_item': item.isContainerItem,
-            'is_playable': item.is_playable(),
-            'file_type': item.file_type,
-            'subtitle_encoding': item.subtitle_encoding,
-            'media_type_checked': item.media_type_checked,
-            'seeding_status': item.torrent_seeding_status(),
-            'mime_type': item.enclosure_type,
-            'artist': item.get_artist(),
-            'album': item.get_album(),
-            'track': item.get_track(),
-            'year': item.get_year(),
-            'genre': item.get_genre(),
-            'rating': item.get_rating(),
-            'date_added': item.get_creation_time(),
-            'last_played': item.get_watched_time(),
             'children': [],
             'expiration_date': None,
             'download_info': None,
@@ -185,11 +326,6 @@ class DatabaseItemSource(ItemSource):
             'up_total': None,
             'down_total': None,
             'up_down_ratio': 0.0,
-            'device': None,
-            'play_count': item.play_count,
-            'skip_count': item.skip_count,
-            'cover_art': item.get_cover_art(),
-            'auto_rating': item.get_auto_rating(),
             }
         if item.isContainerItem:
             info['children'] = [DatabaseItemSource._item_info_for(i) for i in
@@ -199,7 +335,7 @@ class DatabaseItemSource(ItemSource):
 
         if item.downloader:
             info['download_info'] = messages.DownloadInfo(item.downloader)
-        elif info['state'] == 'downloading':
+        elif item.get_state() == 'downloading':
             info['download_info'] = messages.PendingDownloadInfo()
 
         ## Torrent-specific stuff
@@ -218,7 +354,7 @@ class DatabaseItemSource(ItemSource):
             if info['down_total'] > 0:
                 info['up_down_ratio'] = float(info['up_total'] /
                                               info['down_total'])
-        return messages.ItemInfo(item.id, **info)
+        return info
 
     def fetch_all(self):
         if self.use_cache:
@@ -226,6 +362,34 @@ class DatabaseItemSource(ItemSource):
         else:
             return [self._item_info_for(i) for i in self.view]
 
+    def fetch(self):
+        if self.limiter is not None and self.use_cache:
+            limiter_sql = self.limiter.where_sql()
+            if limiter_sql is not None:
+                infos = list(self._limited_view(*limiter_sql))
+                self.current_ids = set(info.id for info in infos)
+                return infos
+        return ItemSource.fetch(self)
+
+    def _limited_view(self, where, values):
+        """Get a View for the items in our view that also match where."""
+        view = self.view
+        if view.where is not None:
+            where = '(%s) AND (%s)' % (view.where, where)
+        return database.View(view.fetcher, where,
+                             tuple(view.values) + tuple(values),
+                             view.order_by, view.joins, view.limit)
+
+    def fetch_current(self):
+        if self.use_cache:
+            # Skip ids that the cache doesn't have.  In bulk mode, items get
+            # removed from the cache before our view tracker hears about it.
+            id_to_info = app.item_info_cache.id_to_info
+            return [id_to_info[id_] for id_ in self.current_ids
+                    if id_ in id_to_info]
+        else:
+            return ItemSource.fetch_current(self)
+
     def _emit_from_db(self, vt, obj, signal_method):
         if self.use_cache:
             info = obj
@@ -344,12 +508,43 @@ class SourceLimiter(object):
     """Interface for objects that are passed into ItemSource.set_limiter.
 
     SourceLimiter objects allow us to filter sets of items in Python, rather
-    than through the database.
+    than through the database.  Limiters that can also work in the database
+    return an SQL expression from where_sql().
     """
     def filter_info(self, info):
         """Return True if we should filter out info from fetch()."""
         raise NotImplementedError()
 
+    def where_sql(self):
+        """Get an SQL expression that selects the items that we let through.
+
+        DatabaseItemSource.fetch() adds this to its view's WHERE clause,
+        rather than filtering all of its items with filter_list().
+
+        :returns: (sql, values) tuple, or None to filter in Python
+        """
+        return None
+
     def filter_list(self, infos):
         """Only return infos which should be part of fetch()."""
         raise NotImplementedError()
+
+    def refine_ids(self, ids):
+        """Narrow down the ids that passed a limiter that this one refines.
+
+        ItemSource.set_limiter() calls this so that limiters with an index
+        can check just those ids, without fetching their ItemInfos.
+
+        :returns: set of the ids that we let through, or None to check the
+            ItemInfos with filter_list()
+        """
+        return None
+
+    def refines(self, other):
+        """Return True if this limiter never lets through an info that other
+        filters out.
+
+        ItemSource.set_limiter() uses this to avoid checking all items when
+        the limiter is narrowed down.
+        """
+        return False
@@ -41,6 +41,7 @@ from miro import database
 from miro import devices
 from miro import downloader
 from miro import eventloop
+from miro import eventloopstats
 from miro import feed
 from miro.displaystate import DisplayState
 from miro import guide
@@ -119,11 +120,14 @@ class ViewTracker(object):
         for obj in changed:
             info = self.info_factory(obj)
             if (obj.id not in self._last_sent_info or
-                info.__dict__ != self._last_sent_info[obj.id].__dict__):
+                self._info_changed(info, self._last_sent_info[obj.id])):
                 retval.append(info)
                 self._last_sent_info[obj.id] = info
         return retval
 
+    def _info_changed(self, info, last_info):
+        return info.__dict__ != last_info.__dict__
+
     def _make_removed_list(self, removed):
         for obj in removed:
             del self._last_sent_info[obj.id]
@@ -289,27 +293,71 @@ class WatchedFolderTracker(ViewTracker):
         messages.WatchedFolderList(info_list).send_to_frontend()
 
 class ItemSearchLimiter(itemsource.SourceLimiter):
-    """ViewLimiter that filters out items that don't match a search query"""
-    def __init__(self, query):
+    """ViewLimiter that filters out items that don't match a search query
+
+    If use_index is True, filter_list() looks up the matches in the item info
+    cache's search index rather than checking each item.  If the FTS index is
+    enabled, we use that instead, and where_sql() lets DatabaseItemSource run
+    the search as part of its view.  Only use that for infos from the item
+    info cache.
+    """
+    def __init__(self, query, use_index=False):
         self.query = query
+        self.use_index = use_index
+
+    def _use_fts(self):
+        return self.use_index and app.item_fts_index is not None
 
     def filter_info(self, info):
+        if self._use_fts():
+            return not app.item_fts_index.info_matches(info, self.query)
         return not search.item_matches(info, self.query)
 
+    def where_sql(self):
+        if self._use_fts():
+            where, values = app.item_fts_index.where_sql(self.query)
+            if where is not None:
+                return where, values
+        return None
+
+    def refines(self, other):
+        return (isinstance(other, ItemSearchLimiter) and
+                search.is_refinement(self.query, other.query))
+
+    def _search_index(self):
+        if app.item_fts_index is not None:
+            return app.item_fts_index
+        else:
+            return app.item_info_cache.search_index()
+
     def filter_list(self, info_list):
+        if self.use_index:
+            matching_ids = self._search_index().matching_ids(self.query)
+            return [info for info in info_list if info.id in matching_ids]
         return search.list_matches(info_list, self.query)
 
+    def refine_ids(self, ids):
+        # Only the items that matched the old query can match, so just check
+        # those rather than searching the whole index.
+        if self.use_index:
+            return self._search_index().matching_ids(self.query, ids)
+        return None
+
 class SourceTrackerBase(ViewTracker):
     # we only deal with ItemInfo objects, so we don't need to create anything
     info_factory = lambda self, info: info
 
+    def _info_changed(self, info, last_info):
+        return info.differs_from(last_info)
+
     def __init__(self, search_text):
         ViewTracker.__init__(self)
         self.current_search_text = self.last_search_text = search_text
         self.sent_initial_list = False
+        self._ranked_search = None
         if search_text:
             for source in self.trackers:
-                source.set_limiter(ItemSearchLimiter(search_text))
+                source.set_limiter(self.make_search_limiter(search_text))
 
     def get_sources(self):
         return [self.source]
@@ -322,7 +370,20 @@ class SourceTrackerBase(ViewTracker):
             source.connect('new-list', self.on_new_list)
             self.trackers.append(source)
 
+    def on_object_added(self, tracker, obj):
+        self._ranked_search = None
+        ViewTracker.on_object_added(self, tracker, obj)
+
+    def on_object_removed(self, tracker, obj):
+        self._ranked_search = None
+        ViewTracker.on_object_removed(self, tracker, obj)
+
+    def on_object_changed(self, tracker, obj):
+        self._ranked_search = None
+        ViewTracker.on_object_changed(self, tracker, obj)
+
     def on_new_list(self, source, infos):
+        self._ranked_search = None
         if not self.sent_initial_list:
             # don't send this until we send ItemList()
             return
@@ -362,11 +423,31 @@ class SourceTrackerBase(ViewTracker):
         if not self.current_search_text:
             limiter = None
         else:
-            limiter = ItemSearchLimiter(self.current_search_text)
+            limiter = self.make_search_limiter(self.current_search_text)
         for source in self.trackers:
             source.set_limiter(limiter)
         self.last_search_text = self.current_search_text
 
+    def make_search_limiter(self, search_text):
+        return ItemSearchLimiter(search_text)
+
+    def ranked_search(self, search_text, page_size):
+        """Get a search.RankedSearch for the items in our list.
+
+        We hold on to the last one, so that asking for the next page picks up
+        where the last page stopped instead of scoring everything again.  It
+        gets dropped as soon as our list changes.
+        """
+        ranked = self._ranked_search
+        if (ranked is None or ranked.search_text != search_text or
+                ranked.page_size != page_size):
+            infos = []
+            for source in self.trackers:
+                infos.extend(source.fetch_current())
+            ranked = search.RankedSearch(infos, search_text, page_size)
+            self._ranked_search = ranked
+        return ranked
+
     def set_search_text(self, search_text):
         # don't change the search yet, schedule it in an urgent call.  That
         # way if we get tons of search changes at once, we can skip to the
@@ -376,6 +457,9 @@ class SourceTrackerBase(ViewTracker):
 
 class DatabaseSourceTrackerBase(SourceTrackerBase):
 
+    def make_search_limiter(self, search_text):
+        return ItemSearchLimiter(search_text, use_index=True)
+
     def get_sources(self):
         return [itemsource.DatabaseItemSource(view) for view in
                 self.get_object_views()]
@@ -1269,6 +1353,20 @@ New ids: %s""", playlist_item_ids, message.item_ids)
             return
         item_tracker.set_search_text(message.search_text)
 
+    def handle_query_ranked_items(self, message):
+        key = self.item_tracker_key(message)
+        try:
+            item_tracker = self.item_trackers[key]
+        except KeyError:
+            logging.warn("QueryRankedItems key not being tracked: %s", key)
+            return
+        ranked = item_tracker.ranked_search(message.search_text,
+                                            message.page_size)
+        messages.RankedItemList(message.type, message.id,
+                message.search_text, message.page,
+                ranked.get_page(message.page),
+                ranked.has_more(message.page)).send_to_frontend()
+
     def handle_stop_tracking_items(self, message):
         key = self.item_tracker_key(message)
         try:
@@ -1581,6 +1679,14 @@ New ids: %s""", playlist_item_ids, message.item_ids)
         app.controller.send_bug_report(message.report, message.text,
                                        message.send_report)
 
+    def handle_dump_event_loop_stats(self, message):
+        loop_stats = eventloopstats.loop_stats
+        logging.info("Event loop stats:\n%s", loop_stats.format_report())
+        if message.trace_path is not None:
+            loop_stats.write_chrome_trace(message.trace_path)
+            logging.info("Event loop trace written to %s",
+                         message.trace_path)
+
     def _get_display_state(self, key):
         try:
             return DisplayState.make_view("type=? AND id_=?",
@@ -239,6 +239,26 @@ class SetTrackItemsSearch(BackendMessage):
         self.id = id_
         self.search_text = search_text
 
+class QueryRankedItems(BackendMessage):
+    """Ask for the items that best match a search, best match first.
+
+    This ranks the items currently in a TrackItems list.  A TrackItems
+    message for the same type/id must have already been sent.  The backend
+    will send back a RankedItemList message with one page of results.
+
+    The backend keeps the ranking around, so asking for the next page of the
+    same search is cheap.  It gets thrown away when the list changes.
+
+    :param page: page number, starting with 0
+    :param page_size: number of items on each page
+    """
+    def __init__(self, typ, id_, search_text, page=0, page_size=100):
+        self.type = typ
+        self.id = id_
+        self.search_text = search_text
+        self.page = page
+        self.page_size = page_size
+
 class StopTrackingItems(BackendMessage):
     """Stop tracking items for a feed.
     """
@@ -818,6 +838,13 @@ class ReportCrash(BackendMessage):
         self.text = text
         self.send_report = send_report
 
+class DumpEventLoopStats(BackendMessage):
+    """Log the event loop timing stats.  If trace_path is given, also
+    write the recent events there in the Chrome trace format.
+    """
+    def __init__(self, trace_path=None):
+        self.trace_path = trace_path
+
 class SaveDisplayState(BackendMessage):
     """Save changes to one display for the frontend
     """
@@ -1125,7 +1152,8 @@ class ItemInfo(object):
     :param up_down_ratio: (Torrent only) ratio of uploaded to downloaded
     """
 
-    html_stripper = util.HTMLStripper()
+    # attributes that we calculate from the other ones
+    DERIVED_ATTRIBUTES = frozenset(('description_stripped', 'search_ngrams'))
 
     def __init__(self, id_, **kwargs):
         self.id = id_
@@ -1134,12 +1162,63 @@ class ItemInfo(object):
                                      # data
 
         # stuff we can calculate, if it wasn't stored
-        if not hasattr(self, 'description_stripped'):
-            self.description_stripped = ItemInfo.html_stripper.strip(
+        if 'description_stripped' not in self.__dict__:
+            self.description_stripped = util.stripped_html_cache.strip(
                 self.description)
-        if not hasattr(self, 'search_ngrams'):
+        if 'search_ngrams' not in self.__dict__:
             self.search_ngrams = search.calc_ngrams(self)
 
+    def __getattr__(self, name):
+        # ItemInfos loaded from the item info cache don't have
+        # description_stripped or search_ngrams.  Calculate them the first
+        # time they're used.
+        if name == 'description_stripped':
+            value = util.stripped_html_cache.strip(self.description)
+        elif name == 'search_ngrams':
+            value = search.calc_ngrams(self)
+        else:
+            raise AttributeError(name)
+        self.__dict__[name] = value
+        return value
+
+    def differs_from(self, other):
+        """Check if this ItemInfo has different data than another one.
+
+        The derived attributes are ignored, since they might not be
+        calculated yet.
+        """
+        return self._stored_attributes() != other._stored_attributes()
+
+    def _stored_attributes(self):
+        return dict((name, value)
+                    for (name, value) in self.__dict__.iteritems()
+                    if name not in self.DERIVED_ATTRIBUTES)
+
+    def updated(self, changes):
+        """Make a copy of this ItemInfo with some attributes changed.
+
+        ItemInfo objects get shared between the item info cache and the
+        trackers, so we never modify them in place.  description_stripped
+        and search_ngrams are only recalculated if the attributes they're
+        calculated from actually changed.
+
+        :param changes: dict mapping attribute names to their new values
+        """
+        new_info = ItemInfo.__new__(ItemInfo)
+        new_info.__dict__ = self.__dict__.copy()
+        new_info.__dict__.update(changes)
+        # If self doesn't have the derived attributes yet, new_info will
+        # calculate them when they're first used.
+        if ('description_stripped' in self.__dict__ and
+                new_info.description != self.description):
+            new_info.description_stripped = util.stripped_html_cache.strip(
+                new_info.description)
+        if ('search_ngrams' in self.__dict__ and
+                search.calc_search_text(new_info) !=
+                search.calc_search_text(self)):
+            new_info.search_ngrams = search.calc_ngrams(new_info)
+        return new_info
+
 class DownloadInfo(object):
     """Tracks the download state of an item.
 
@@ -1299,6 +1378,24 @@ class ItemsChanged(FrontendMessage):
         self.changed = changed
         self.removed = removed
 
+class RankedItemList(FrontendMessage):
+    """Sends the frontend a page of results for a QueryRankedItems message.
+
+    :param type: type of object being tracked (same as in TrackItems)
+    :param id: id of the object being tracked (same as in TrackItems)
+    :param search_text: search that the items were ranked for
+    :param page: page number, starting with 0
+    :param items: list of ItemInfo objects, best match first
+    :param more: True if there are more pages after this one
+    """
+    def __init__(self, typ, id_, search_text, page, item_infos, more):
+        self.type = typ
+        self.id = id_
+        self.search_text = search_text
+        self.page = page
+        self.items = item_infos
+        self.more = more
+
 class WatchedFolderList(FrontendMessage):
     """Sends the frontend the initial list of watched folders.
 
@@ -32,7 +32,8 @@
 /*
  * ngrams.c
  *
- * Calculate N-grams for a string quickly.
+ * Calculate N-grams for a string quickly, and match lists of N-grams
+ * against search queries.
  */
 
 #include <Python.h>
@@ -124,6 +125,230 @@ static PyObject *breakup_list(PyObject *self, PyObject *args)
     return ngram_list;
 }
 
+/*
+ * Query used by batch_match().  We flatten the positive N-grams and each
+ * group of negative N-grams into a single array.  group[i] is 0 for
+ * positive N-grams and 1..group_count for the negative groups.
+ */
+typedef struct {
+    PyObject* ngrams; /* list that owns the references */
+    Py_ssize_t count;
+    long* hashes;
+    int* groups;
+    Py_ssize_t group_count;
+    Py_ssize_t* group_sizes; /* number of N-grams in each group */
+    Py_ssize_t* group_found; /* scratch space used while matching */
+    char* found; /* scratch space used while matching */
+} Query;
+
+static void free_query(Query* query)
+{
+    Py_XDECREF(query->ngrams);
+    PyMem_Free(query->hashes);
+    PyMem_Free(query->groups);
+    PyMem_Free(query->group_sizes);
+    PyMem_Free(query->group_found);
+    PyMem_Free(query->found);
+}
+
+static int add_query_group(Query* query, PyObject* ngrams, int group)
+{
+    PyObject* iter;
+    PyObject* item;
+
+    iter = PyObject_GetIter(ngrams);
+    if(!iter) return -1;
+    while ((item = PyIter_Next(iter))) {
+        if(PyList_Append(query->ngrams, item) == -1) {
+            Py_DECREF(item);
+            Py_DECREF(iter);
+            return -1;
+        }
+        Py_DECREF(item);
+        query->group_sizes[group]++;
+    }
+    Py_DECREF(iter);
+    if(PyErr_Occurred()) return -1;
+    return 0;
+}
+
+static int build_query(Query* query, PyObject* positive,
+        PyObject* negative_groups)
+{
+    PyObject* negative_fast;
+    Py_ssize_t i, group;
+
+    memset(query, 0, sizeof(Query));
+    negative_fast = PySequence_Fast(negative_groups,
+            "negative N-grams must be a sequence");
+    if(!negative_fast) return -1;
+    query->group_count = PySequence_Fast_GET_SIZE(negative_fast);
+    query->ngrams = PyList_New(0);
+    query->group_sizes = PyMem_New(Py_ssize_t, query->group_count + 1);
+    query->group_found = PyMem_New(Py_ssize_t, query->group_count + 1);
+    if(!query->ngrams || !query->group_sizes || !query->group_found) {
+        Py_DECREF(negative_fast);
+        PyErr_NoMemory();
+        return -1;
+    }
+    memset(query->group_sizes, 0,
+            sizeof(Py_ssize_t) * (query->group_count + 1));
+
+    if(add_query_group(query, positive, 0) == -1) {
+        Py_DECREF(negative_fast);
+        return -1;
+    }
+    for(group = 1; group <= query->group_count; group++) {
+        if(add_query_group(query,
+                    PySequence_Fast_GET_ITEM(negative_fast, group - 1),
+                    group) == -1) {
+            Py_DECREF(negative_fast);
+            return -1;
+        }
+    }
+    Py_DECREF(negative_fast);
+
+    query->count = PyList_GET_SIZE(query->ngrams);
+    /* allocate at least 1 element, PyMem_New(x, 0) can return NULL */
+    query->hashes = PyMem_New(long, query->count + 1);
+    query->groups = PyMem_New(int, query->count + 1);
+    query->found = PyMem_New(char, query->count + 1);
+    if(!query->hashes || !query->groups || !query->found) {
+        PyErr_NoMemory();
+        return -1;
+    }
+    i = 0;
+    for(group = 0; group <= query->group_count; group++) {
+        Py_ssize_t j;
+        for(j = 0; j < query->group_sizes[group]; j++, i++) {
+            query->groups[i] = (int)group;
+            query->hashes[i] = PyObject_Hash(
+                    PyList_GET_ITEM(query->ngrams, i));
+            if(query->hashes[i] == -1) return -1;
+        }
+    }
+    return 0;
+}
+
+/*
+ * Check if a list of N-grams matches a query.  Returns 1 if it does, 0 if it
+ * doesn't and -1 on errors.
+ */
+static int match_ngrams(Query* query, PyObject* item_ngrams)
+{
+    PyObject* fast;
+    PyObject* ngram;
+    Py_ssize_t len, i, q, group;
+    long hash;
+    int cmp;
+    int only_positive = (query->group_count == 0);
+
+    fast = PySequence_Fast(item_ngrams, "N-grams must be a sequence");
+    if(!fast) return -1;
+    len = PySequence_Fast_GET_SIZE(fast);
+    memset(query->found, 0, query->count);
+    memset(query->group_found, 0,
+            sizeof(Py_ssize_t) * (query->group_count + 1));
+
+    for(i = 0; i < len; i++) {
+        ngram = PySequence_Fast_GET_ITEM(fast, i);
+        hash = PyObject_Hash(ngram);
+        if(hash == -1) {
+            Py_DECREF(fast);
+            return -1;
+        }
+        for(q = 0; q < query->count; q++) {
+            if(query->found[q] || query->hashes[q] != hash) continue;
+            cmp = PyObject_RichCompareBool(ngram,
+                    PyList_GET_ITEM(query->ngrams, q), Py_EQ);
+            if(cmp == -1) {
+                Py_DECREF(fast);
+                return -1;
+            }
+            if(cmp) {
+                query->found[q] = 1;
+                query->group_found[query->groups[q]]++;
+            }
+        }
+        if(only_positive && query->group_found[0] == query->group_sizes[0]) {
+            /* found everything we need, no need to look further */
+            break;
+        }
+    }
+    Py_DECREF(fast);
+
+    if(query->group_found[0] != query->group_sizes[0]) return 0;
+    for(group = 1; group <= query->group_count; group++) {
+        if(query->group_found[group] == query->group_sizes[group]) return 0;
+    }
+    return 1;
+}
+
+static PyObject *batch_match(PyObject *self, PyObject *args)
+{
+    PyObject* ngram_lists;
+    PyObject* positive;
+    PyObject* negative_groups;
+    PyObject* iter;
+    PyObject* item;
+    PyObject* index;
+    PyObject* matches;
+    Query query;
+    Py_ssize_t i;
+    int result;
+
+    if (!PyArg_ParseTuple(args, "OOO:batch_match", &ngram_lists, &positive,
+                &negative_groups)) {
+        return NULL;
+    }
+
+    if(build_query(&query, positive, negative_groups) == -1) {
+        free_query(&query);
+        return NULL;
+    }
+
+    iter = PyObject_GetIter(ngram_lists);
+    if(!iter) {
+        free_query(&query);
+        return NULL;
+    }
+    matches = PyList_New(0);
+    if(!matches) {
+        Py_DECREF(iter);
+        free_query(&query);
+        return NULL;
+    }
+
+    i = 0;
+    while ((item = PyIter_Next(iter))) {
+        result = match_ngrams(&query, item);
+        Py_DECREF(item);
+        if(result == 1) {
+            index = PyInt_FromSsize_t(i);
+            if(!index || PyList_Append(matches, index) == -1) {
+                Py_XDECREF(index);
+                result = -1;
+            } else {
+                Py_DECREF(index);
+            }
+        }
+        if(result == -1) {
+            Py_DECREF(iter);
+            Py_DECREF(matches);
+            free_query(&query);
+            return NULL;
+        }
+        i++;
+    }
+    Py_DECREF(iter);
+    free_query(&query);
+    if(PyErr_Occurred()) {
+        Py_DECREF(matches);
+        return NULL;
+    }
+    return matches;
+}
+
 static PyMethodDef NgramsMethods[] =
 {
     {"breakup_word", (PyCFunction)breakup_word, METH_VARARGS,
@@ -132,6 +357,9 @@ static PyMethodDef NgramsMethods[] =
     {"breakup_list", (PyCFunction)breakup_list, METH_VARARGS,
         "split a sequence of words into a list of ngrams"
     },
+    {"batch_match", (PyCFunction)batch_match, METH_VARARGS,
+        "get the indexes of the ngram lists that match a search query"
+    },
     { NULL, NULL, 0, NULL }
 };
 
@@ -0,0 +1,298 @@
+# Miro - an RSS based video player application
+# Copyright (C) 2005, 2006, 2007, 2008, 2009, 2010, 2011
+# Participatory Culture Foundation
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
+#
+# In addition, as a special exception, the copyright holders give
+# permission to link the code of portions of this program with the OpenSSL
+# library.
+#
+# You must obey the GNU General Public License in all respects for all of
+# the code used other than OpenSSL. If you modify file(s) with this
+# exception, you may extend this exception to your version of the file(s),
+# but you are not obligated to do so. If you do not wish to do so, delete
+# this exception statement from your version. If you delete this exception
+# statement from all source files in the program, then also delete it here.
+
+"""``miro.poller`` -- Wait for sockets to be ready.
+
+The event loops use a poller to wait for their sockets.  Pollers keep track
+of which file descriptors we're interested in, so that they don't need to be
+told about all of them on each pass through the loop.  The best poller for
+the platform is picked by make_poller():
+
+    - EpollPoller uses select.epoll (Linux).  The kernel remembers the
+      registrations, so each wait only costs O(ready fds).
+    - PollPoller uses select.poll, which doesn't have select()'s FD_SETSIZE
+      limit.
+    - SelectPoller uses select.select() and works everywhere.
+
+Code that gets the complete list of fds on each pass, like LibCURLManager,
+should use make_stateless_poller() instead.  See Poller.set_fds().
+"""
+
+import errno
+import math
+import select
+import sys
+
+def _timeout_millis(timeout):
+    """Convert a timeout in seconds to milliseconds.
+
+    We round up, otherwise we would wake up just before a timeout is due
+    and then have to wait again.
+    """
+    return max(int(math.ceil(timeout * 1000)), 0)
+
+class Poller(object):
+    """Base class for pollers.
+
+    Subclasses implement _update_fd(), which gets called whenever the
+    events we want for a file descriptor change, and poll().
+    """
+    def __init__(self):
+        self.read_fds = set()
+        self.write_fds = set()
+        # set by poll() when a signal interrupted the wait
+        self.interrupted = False
+
+    def register_read(self, fd):
+        if fd not in self.read_fds:
+            self.read_fds.add(fd)
+            self._update_fd(fd)
+
+    def unregister_read(self, fd):
+        if fd in self.read_fds:
+            self.read_fds.discard(fd)
+            self._update_fd(fd)
+
+    def register_write(self, fd):
+        if fd not in self.write_fds:
+            self.write_fds.add(fd)
+            self._update_fd(fd)
+
+    def unregister_write(self, fd):
+        if fd in self.write_fds:
+            self.write_fds.discard(fd)
+            self._update_fd(fd)
+
+    def set_fds(self, read_fds, write_fds):
+        """Replace all our registrations.
+
+        This is for code like LibCURLManager that gets the complete list of
+        file descriptors each time.  Only the fds that changed get
+        re-registered.  That's only safe for pollers that look the fds up
+        again on each wait (SelectPoller and PollPoller).  If a socket gets
+        closed and a new one reuses its number, the fd list looks the same,
+        but epoll would have dropped the registration.
+        """
+        read_fds = set(read_fds)
+        write_fds = set(write_fds)
+        changed = ((read_fds ^ self.read_fds) | (write_fds ^ self.write_fds))
+        self.read_fds = read_fds
+        self.write_fds = write_fds
+        for fd in changed:
+            self._update_fd(fd)
+
+    def _update_fd(self, fd):
+        pass
+
+    def poll(self, timeout):
+        """Wait for our file descriptors to be ready.
+
+        :param timeout: max time to wait in seconds, or None to wait forever
+        :returns: (read_ready, write_ready) tuple of fd lists.  If the wait
+            gets interrupted by a signal, both lists are empty and
+            interrupted is set to True.
+        """
+        raise NotImplementedError()
+
+    def close(self):
+        pass
+
+class SelectPoller(Poller):
+    def poll(self, timeout):
+        self.interrupted = False
+        try:
+            read_ready, write_ready, exc_ready = select.select(
+                    self.read_fds, self.write_fds, [], timeout)
+        except select.error, (err, detail):
+            if err == errno.EINTR:
+                self.interrupted = True
+                return [], []
+            raise
+        return read_ready, write_ready
+
+class _EventMaskPoller(Poller):
+    """Base class for pollers that register an event mask for each fd."""
+    READ_EVENTS = WRITE_EVENTS = READY_READ = READY_WRITE = 0
+
+    def __init__(self):
+        Poller.__init__(self)
+        self.registered = {}
+
+    def _calc_mask(self, fd):
+        mask = 0
+        if fd in self.read_fds:
+            mask |= self.READ_EVENTS
+        if fd in self.write_fds:
+            mask |= self.WRITE_EVENTS
+        return mask
+
+    def _update_fd(self, fd):
+        mask = self._calc_mask(fd)
+        old_mask = self.registered.get(fd)
+        if mask == old_mask:
+            return
+        if not mask:
+            del self.registered[fd]
+            self._unregister(fd)
+        elif old_mask is None:
+            self.registered[fd] = mask
+            self._register(fd, mask)
+        else:
+            self.registered[fd] = mask
+            self._modify(fd, mask)
+
+    def _register(self, fd, mask):
+        self.impl.register(fd, mask)
+
+    def _modify(self, fd, mask):
+        self.impl.modify(fd, mask)
+
+    def _unregister(self, fd):
+        try:
+            self.impl.unregister(fd)
+        except (IOError, OSError, KeyError):
+            # the fd was already closed
+            pass
+
+    def _split_events(self, events):
+        read_ready = []
+        write_ready = []
+        for fd, event in events:
+            if fd in self.read_fds and event & self.READY_READ:
+                read_ready.append(fd)
+            if fd in self.write_fds and event & self.READY_WRITE:
+                write_ready.append(fd)
+        return read_ready, write_ready
+
+class PollPoller(_EventMaskPoller):
+    def __init__(self):
+        _EventMaskPoller.__init__(self)
+        self.impl = select.poll()
+
+    def poll(self, timeout):
+        if timeout is not None:
+            timeout = _timeout_millis(timeout)
+        self.interrupted = False
+        try:
+            events = self.impl.poll(timeout)
+        except select.error, (err, detail):
+            if err == errno.EINTR:
+                self.interrupted = True
+                return [], []
+            raise
+        return self._split_events(events)
+
+if hasattr(select, 'poll'):
+    # like select(), report errors and hangups as readable and writable, so
+    # that the socket callbacks see them.
+    PollPoller.READ_EVENTS = select.POLLIN | select.POLLPRI
+    PollPoller.WRITE_EVENTS = select.POLLOUT
+    PollPoller.READY_READ = (select.POLLIN | select.POLLPRI | select.POLLERR |
+            select.POLLHUP | select.POLLNVAL)
+    PollPoller.READY_WRITE = (select.POLLOUT | select.POLLERR |
+            select.POLLHUP | select.POLLNVAL)
+
+class EpollPoller(_EventMaskPoller):
+    def __init__(self):
+        _EventMaskPoller.__init__(self)
+        self.impl = select.epoll()
+
+    def set_fds(self, read_fds, write_fds):
+        raise NotImplementedError("EpollPoller can't track fd lists, use "
+                                  "make_stateless_poller()")
+
+    def _register(self, fd, mask):
+        try:
+            self.impl.register(fd, mask)
+        except IOError, e:
+            if e.errno != errno.EEXIST:
+                raise
+            self.impl.modify(fd, mask)
+
+    def _modify(self, fd, mask):
+        try:
+            self.impl.modify(fd, mask)
+        except IOError, e:
+            # epoll forgets about fds when they're closed.  If the fd number
+            # got reused, we need to register it again.
+            if e.errno != errno.ENOENT:
+                raise
+            self.impl.register(fd, mask)
+
+    def poll(self, timeout):
+        if timeout is None:
+            timeout = -1
+        else:
+            # epoll truncates to whole milliseconds, aim for the middle of
+            # the one we want.
+            timeout = (_timeout_millis(timeout) + 0.5) / 1000.0
+        self.interrupted = False
+        try:
+            events = self.impl.poll(timeout)
+        except IOError, e:
+            if e.errno == errno.EINTR:
+                self.interrupted = True
+                return [], []
+            raise
+        return self._split_events(events)
+
+    def close(self):
+        self.impl.close()
+
+if hasattr(select, 'epoll'):
+    EpollPoller.READ_EVENTS = select.EPOLLIN | select.EPOLLPRI
+    EpollPoller.WRITE_EVENTS = select.EPOLLOUT
+    EpollPoller.READY_READ = (select.EPOLLIN | select.EPOLLPRI |
+            select.EPOLLERR | select.EPOLLHUP)
+    EpollPoller.READY_WRITE = (select.EPOLLOUT | select.EPOLLERR |
+            select.EPOLLHUP)
+
+def make_poller():
+    """Create the best poller for this platform."""
+    if hasattr(select, 'epoll'):
+        return EpollPoller()
+    # poll() is broken for some file types on OS X
+    elif hasattr(select, 'poll') and sys.platform != 'darwin':
+        return PollPoller()
+    else:
+        return SelectPoller()
+
+def make_stateless_poller():
+    """Create a poller for code that calls set_fds() on each pass.
+
+    select() and poll() get told which fds to check on every wait, so
+    there's no kernel registration that can go stale when an fd number gets
+    reused, and set_fds() doesn't need to refresh anything.  poll() also
+    doesn't have select()'s FD_SETSIZE limit.
+    """
+    # poll() is broken for some file types on OS X
+    if hasattr(select, 'poll') and sys.platform != 'darwin':
+        return PollPoller()
+    else:
+        return SelectPoller()
@@ -104,6 +104,18 @@ SUBTITLE_FONT               = Pref(key='subtitleFont',          default=None,  p
 # language setting: "system" uses system default; all other languages are overrides
 LANGUAGE                    = Pref(key='language',              default="system", platformSpecific=False)
 MAX_CONCURRENT_CONVERSIONS  = Pref(key='maxConcurrentConversions', default=1, platformSpecific=False)
+# search items using an SQLite FTS table rather than in-memory N-grams
+USE_FTS_SEARCH_INDEX        = Pref(key='useFTSSearchIndex',     default=False, platformSpecific=False)
+# threads for each thread pool lane.  0 threads for the cpu lane means one
+# per logical CPU.
+THREAD_POOL_IO_THREADS      = Pref(key='threadPoolIOThreads',   default=3, platformSpecific=False)
+THREAD_POOL_CPU_THREADS     = Pref(key='threadPoolCPUThreads',  default=0, platformSpecific=False)
+THREAD_POOL_FS_THREADS      = Pref(key='threadPoolFSThreads',   default=2, platformSpecific=False)
+# worker processes for parsing feeds.  0 means parse them in threads.
+FEEDPARSER_PROCESSES        = Pref(key='feedparserProcesses',   default=2, platformSpecific=False)
+# parses before a feed parser process gets replaced by a fresh one.  0 means
+# never replace them.
+FEEDPARSER_PROCESS_MAX_PARSES = Pref(key='feedparserProcessMaxParses', default=50, platformSpecific=False)
 
 # This doesn't need to be defined on the platform, but it can be overridden there if the platform wants to.
 SHOW_ERROR_DIALOG           = Pref(key='showErrorDialog',       default=True,  platformSpecific=True)
@@ -0,0 +1,262 @@
+# Miro - an RSS based video player application
+# Copyright (C) 2005, 2006, 2007, 2008, 2009, 2010, 2011
+# Participatory Culture Foundation
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
+#
+# In addition, as a special exception, the copyright holders give
+# permission to link the code of portions of this program with the OpenSSL
+# library.
+#
+# You must obey the GNU General Public License in all respects for all of
+# the code used other than OpenSSL. If you modify file(s) with this
+# exception, you may extend this exception to your version of the file(s),
+# but you are not obligated to do so. If you do not wish to do so, delete
+# this exception statement from your version. If you delete this exception
+# statement from all source files in the program, then also delete it here.
+
+
+"""queryplan.py -- Find SQL statements that scan entire tables.
+
+QueryPlanAuditor runs "EXPLAIN QUERY PLAN" once for each distinct
+statement that LiveStorage executes and remembers which ones make SQLite
+scan a whole table.  This is only done in debug mode, since it means an
+extra query for every new statement.
+
+IndexAdvisor takes the statements that the auditor flagged and tries
+adding an index for each column they reference in a copy of the schema.
+If the scan goes away, that index gets suggested in the report, along
+with the statements that it would help.
+"""
+
+import logging
+import re
+
+try:
+    import sqlite3
+except ImportError:
+    from pysqlite2 import dbapi2 as sqlite3
+
+# Matches the detail column for full table scans.  Older SQLite versions
+# say "SCAN TABLE item AS rd (~100000 rows)", newer ones just "SCAN rd".
+# Scanning a whole index counts too, only a SEARCH avoids reading every
+# row.
+_SCAN_RE = re.compile(r'^SCAN (?:TABLE )?(\w+)(?: AS (\w+))?')
+_TOKEN_RE = re.compile(r'\w+(?:\.\w+)?')
+# words that can follow a table name in a FROM or JOIN clause, but aren't
+# aliases
+_NOT_ALIASES = set(['ON', 'WHERE', 'LEFT', 'INNER', 'CROSS', 'OUTER',
+    'JOIN', 'ORDER', 'GROUP', 'LIMIT', 'USING'])
+
+def parse_tables(sql):
+    """Find the tables a statement uses.
+
+    :returns: dict mapping the names used in sql (aliases or table names) to
+        table names
+    """
+    tables = {}
+    tokens = _TOKEN_RE.findall(sql)
+    for i, token in enumerate(tokens):
+        if token.upper() not in ('FROM', 'JOIN') or i + 1 >= len(tokens):
+            continue
+        table = tokens[i+1]
+        tables[table] = table
+        pos = i + 2
+        if pos < len(tokens) and tokens[pos].upper() == 'AS':
+            pos += 1
+        if pos < len(tokens) and tokens[pos].upper() not in _NOT_ALIASES:
+            tables[tokens[pos]] = table
+    return tables
+
+def find_full_scans(cursor, sql, values=()):
+    """Run EXPLAIN QUERY PLAN for a statement.
+
+    :returns: list of (table name, alias) tuples for each table that
+        gets scanned rather than searched.
+    """
+    cursor.execute("EXPLAIN QUERY PLAN %s" % sql, values)
+    tables = parse_tables(sql)
+    scans = []
+    for row in cursor.fetchall():
+        match = _SCAN_RE.match(row[-1])
+        if match is None:
+            continue
+        name, alias = match.group(1), match.group(2)
+        if alias is None:
+            alias = name
+        if name in tables:
+            scans.append((tables[name], alias))
+    return scans
+
+class StatementInfo(object):
+    """Info about a statement that we've audited."""
+    def __init__(self, sql, values, full_scans):
+        self.sql = sql
+        self.values = values
+        self.full_scans = full_scans
+        self.count = 0
+
+class QueryPlanAuditor(object):
+    """Keeps track of which statements cause full table scans."""
+
+    def __init__(self):
+        # maps SQL text -> StatementInfo
+        self.statements = {}
+
+    def audit(self, cursor, sql, values):
+        """Check the query plan for a statement that's about to run.
+
+        Only SELECT statements are checked and each distinct statement is
+        only checked once.
+        """
+        try:
+            self.statements[sql].count += 1
+            return
+        except KeyError:
+            pass
+        if not sql.lstrip().upper().startswith('SELECT'):
+            return
+        try:
+            full_scans = find_full_scans(cursor, sql, values)
+        except sqlite3.Error, e:
+            logging.warn("Can't get query plan for %s: %s", sql, e)
+            return
+        info = StatementInfo(sql, values, full_scans)
+        info.count = 1
+        self.statements[sql] = info
+        for table, alias in full_scans:
+            logging.info("full table scan of %s: %s", table,
+                    _one_line(sql))
+
+    def scanning_statements(self):
+        """Get StatementInfo objects for statements that cause full table
+        scans, most executed first.
+        """
+        rv = [info for info in self.statements.values() if info.full_scans]
+        rv.sort(key=lambda info: info.count, reverse=True)
+        return rv
+
+class IndexAdvisor(object):
+    """Suggests indexes that would avoid full table scans.
+
+    We create the schema from the live database in an in-memory database
+    and try out indexes on it.  Miro never runs ANALYZE, so SQLite picks
+    the same plans for the empty copy as for the real database.
+    """
+
+    def __init__(self, cursor):
+        self.connection = sqlite3.connect(':memory:')
+        self.cursor = self.connection.cursor()
+        cursor.execute("SELECT sql FROM sqlite_master "
+                "WHERE type IN ('table', 'index') AND sql IS NOT NULL "
+                "AND name NOT LIKE 'sqlite_%'")
+        for (sql,) in cursor.fetchall():
+            self.cursor.execute(sql)
+        self._columns = {}
+
+    def close(self):
+        self.connection.close()
+
+    def table_columns(self, table):
+        if table not in self._columns:
+            self.cursor.execute("PRAGMA table_info(%s)" % table)
+            self._columns[table] = [row[1] for row in self.cursor.fetchall()]
+        return self._columns[table]
+
+    def candidate_columns(self, sql, table, alias):
+        """Get the columns of table that sql references."""
+        columns = self.table_columns(table)
+        main_table = parse_tables(sql).get(table) == table
+        candidates = []
+        for token in _TOKEN_RE.findall(sql):
+            if '.' in token:
+                prefix, column = token.split('.', 1)
+                if prefix != alias:
+                    continue
+            elif main_table:
+                column = token
+            else:
+                continue
+            if column in columns and column not in candidates:
+                candidates.append(column)
+        return candidates
+
+    def _avoids_scan(self, info, table, alias, column):
+        self.cursor.execute("CREATE INDEX advisor_test ON %s (%s)" %
+                (table, column))
+        try:
+            scans = find_full_scans(self.cursor, info.sql, info.values)
+        finally:
+            self.cursor.execute("DROP INDEX advisor_test")
+        return (table, alias) not in scans
+
+    def suggest(self, statements):
+        """Suggest indexes for a list of StatementInfo objects.
+
+        :returns: list of ((table, column), [StatementInfo, ...]) tuples,
+            with the indexes that help the most statements first.
+        """
+        suggestions = {}
+        for info in statements:
+            for table, alias in info.full_scans:
+                for column in self.candidate_columns(info.sql, table, alias):
+                    try:
+                        helps = self._avoids_scan(info, table, alias, column)
+                    except sqlite3.Error, e:
+                        logging.warn("Error testing index on %s.%s: %s",
+                                table, column, e)
+                        continue
+                    if helps:
+                        suggestions.setdefault((table, column),
+                                []).append(info)
+        rv = suggestions.items()
+        rv.sort(key=lambda (key, infos): sum(i.count for i in infos),
+                reverse=True)
+        return rv
+
+def _one_line(sql):
+    return ' '.join(sql.split())
+
+def make_report(auditor, cursor):
+    """Make a text report about full table scans and suggested indexes.
+
+    :param auditor: QueryPlanAuditor that has been collecting statements
+    :param cursor: cursor for the database the statements ran on
+    """
+    scanning = auditor.scanning_statements()
+    lines = ["Query plan report: %d statements checked, %d scan tables" %
+            (len(auditor.statements), len(scanning))]
+    for info in scanning:
+        lines.append("  %d executions, scans %s: %s" % (info.count,
+            ', '.join(table for table, alias in info.full_scans),
+            _one_line(info.sql)))
+    if not scanning:
+        return '\n'.join(lines)
+    advisor = IndexAdvisor(cursor)
+    try:
+        suggestions = advisor.suggest(scanning)
+    finally:
+        advisor.close()
+    if not suggestions:
+        lines.append("No indexes would avoid these scans")
+    for (table, column), infos in suggestions:
+        lines.append("Suggested index: CREATE INDEX %s_%s ON %s (%s)" %
+                (table, column.lower(), table, column))
+        lines.append("  avoids scanning %s in %d statements "
+                "(%d executions):" % (table, len(infos),
+                    sum(i.count for i in infos)))
+        for info in infos:
+            lines.append("    %s" % _one_line(info.sql))
+    return '\n'.join(lines)
@@ -483,6 +483,10 @@ class FeedSchema(DDBObjectSchema):
         ('last_viewed', SchemaDateTime()),
     ]
 
+    indexes = (
+        ('feed_folder', ('folder_id',)),
+    )
+
 class FeedImplSchema(DDBObjectSchema):
     klass = FeedImpl
     table_name = 'feed_impl'
@@ -586,6 +590,8 @@ class RemoteDownloaderSchema(DDBObjectSchema):
 
     indexes = (
         ('downloader_state', ('state',)),
+        ('downloader_main_item', ('main_item_id',)),
+        ('downloader_url', ('origURL',)),
     )
 
     @staticmethod
@@ -626,6 +632,10 @@ class PlaylistItemMapSchema(DDBObjectSchema):
         ('position', SchemaInt()),
     ]
 
+    indexes = (
+        ('playlist_item_map_playlist', ('playlist_id',)),
+    )
+
 class PlaylistFolderItemMapSchema(DDBObjectSchema):
     klass = PlaylistFolderItemMap
     table_name = 'playlist_folder_item_map'
@@ -636,6 +646,10 @@ class PlaylistFolderItemMapSchema(DDBObjectSchema):
         ('count', SchemaInt()),
     ]
 
+    indexes = (
+        ('playlist_folder_item_map_playlist', ('playlist_id',)),
+    )
+
 class TabOrderSchema(DDBObjectSchema):
     klass = TabOrder
     table_name = 'taborder_order'
@@ -711,7 +725,7 @@ class DBLogEntrySchema(DDBObjectSchema):
         ('description', SchemaString()),
     ]
 
-VERSION = 128
+VERSION = 130
 object_schemas = [
     IconCacheSchema, ItemSchema, FeedSchema,
     FeedImplSchema, RSSFeedImplSchema, SavedSearchFeedImplSchema,
@@ -30,8 +30,14 @@
 """search.py -- Indexed searching of items.
 
 To make incremental search fast, we index the n-grams for each item.
+NGramIndex maps the n-grams back to items, so that a search doesn't have to
+check every item.
 """
 
+import array
+import bisect
+import datetime
+import heapq
 import os
 import re
 
@@ -42,6 +48,11 @@ QUOTEKILLER = re.compile(r'(?<!\\)"')
 SLASHKILLER = re.compile(r'\\.')
 WORDMATCHER = re.compile("\w+")
 NGRAM_MAX = 5
+# weights used by score_match()
+TITLE_WEIGHT = 3.0
+DESCRIPTION_WEIGHT = 1.0
+RECENCY_WEIGHT = 1.0
+RECENCY_HALF_LIFE = datetime.timedelta(days=30)
 SEARCHOBJECTS = {}
 
 def _get_boolean_search(search_string):
@@ -94,7 +105,7 @@ class BooleanSearch:
     def as_string(self):
         return self.string
 
-def _calc_search_text(item_info):
+def calc_search_text(item_info):
     match_against = [ item_info.name, item_info.description ]
     match_against.append(item_info.artist)
     match_against.append(item_info.album)
@@ -110,7 +121,7 @@ def _calc_search_text(item_info):
 
 def calc_ngrams(item_info):
     """Get the N-grams that we want to index for a ItemInfo object"""
-    words = WORDMATCHER.findall(_calc_search_text(item_info))
+    words = WORDMATCHER.findall(calc_search_text(item_info))
     return ngrams.breakup_list(words, 1, NGRAM_MAX)
 
 def _ngrams_for_term(term):
@@ -126,6 +137,43 @@ def _ngrams_for_term(term):
         # N-grams will just be substrings of those.
         return ngrams.breakup_word(term, NGRAM_MAX, NGRAM_MAX)
 
+def _query_ngrams(search_text):
+    """Get the N-grams to pass to batch_match() for a search.
+
+    :returns: (positive, negative_groups) tuple.  An item matches if it
+        contains all of the positive N-grams, and doesn't contain all the
+        N-grams in any of the negative groups.
+    """
+    parsed_search = _get_boolean_search(search_text)
+    positive = set()
+    for term in parsed_search.positive_terms:
+        positive.update(_ngrams_for_term(term))
+    negative_groups = [list(set(_ngrams_for_term(term)))
+                       for term in parsed_search.negative_terms]
+    return list(positive), negative_groups
+
+def _py_batch_match(ngram_lists, positive, negative_groups):
+    """Python version of ngrams.batch_match()."""
+    positive = set(positive)
+    negative_groups = [set(group) for group in negative_groups]
+    matches = []
+    for i, item_ngrams in enumerate(ngram_lists):
+        item_ngrams = set(item_ngrams)
+        if not positive.issubset(item_ngrams):
+            continue
+        for group in negative_groups:
+            if group.issubset(item_ngrams):
+                break
+        else:
+            matches.append(i)
+    return matches
+
+try:
+    batch_match = ngrams.batch_match
+except AttributeError:
+    # ngrams extension was built before it had batch_match()
+    batch_match = _py_batch_match
+
 def item_matches(item_info, search_text):
     """Test if a single ItemInfo matches a search
 
@@ -134,14 +182,30 @@ def item_matches(item_info, search_text):
 
     :returns: True if the item matches the search string
     """
-    parsed_search = _get_boolean_search(search_text)
-    item_ngrams = item_info.search_ngrams
+    positive, negative_groups = _query_ngrams(search_text)
+    return bool(batch_match([item_info.search_ngrams], positive,
+                            negative_groups))
 
-    for term in parsed_search.positive_terms:
-        if not set(_ngrams_for_term(term)).issubset(item_ngrams):
-            return False
-    for term in parsed_search.negative_terms:
-        if set(_ngrams_for_term(term)).issubset(item_ngrams):
+def is_refinement(search_text, old_search_text):
+    """Test if a search only narrows down the results of another search.
+
+    This is true if every positive term in old_search_text is the start of a
+    positive term in search_text and every negative term in old_search_text
+    is also in search_text.  That's the case when the user types a few more
+    letters, or adds a new term.  In that case, the items that match
+    search_text are a subset of the items that match old_search_text (for
+    both the N-gram search and FTS).
+    """
+    parsed_search = _get_boolean_search(search_text)
+    old_search = _get_boolean_search(old_search_text)
+    if not set(old_search.negative_terms).issubset(
+            parsed_search.negative_terms):
+        return False
+    for old_term in old_search.positive_terms:
+        for term in parsed_search.positive_terms:
+            if term.startswith(old_term):
+                break
+        else:
             return False
     return True
 
@@ -150,24 +214,253 @@ def list_matches(item_infos, search_text):
     Optimized version of item_matches() which filters a iterable
     of item_infos.
 
-    Right now, the optimization is for a short search string and a lot of
-    items (the typical case).  This will probably be slow for long search
-    strings since we'll need to iterate over all of the terms.
+    The matching is done by batch_match(), which checks all the items in one
+    call to the ngrams extension.
+
+    :returns: list of the ItemInfos that match
+    """
+    item_infos = list(item_infos)
+    positive, negative_groups = _query_ngrams(search_text)
+    indexes = batch_match([info.search_ngrams for info in item_infos],
+                          positive, negative_groups)
+    return [item_infos[i] for i in indexes]
+
+
+def score_match(item_info, search_text, now=None):
+    """Calculate how well an ItemInfo matches a search.
+
+    Each time a positive term appears in the title counts TITLE_WEIGHT and
+    each time it appears in the description counts DESCRIPTION_WEIGHT.  On
+    top of that, newer items get a bonus of up to RECENCY_WEIGHT, which
+    halves every RECENCY_HALF_LIFE.
+
+    This doesn't check if the item actually matches the search, use
+    item_matches() or list_matches() for that.
     """
     parsed_search = _get_boolean_search(search_text)
-    positive_set = set()
-    negative_set = set()
+    if now is None:
+        now = datetime.datetime.now()
+    title = (item_info.name or u'').lower()
+    description = (item_info.description or u'').lower()
+    score = 0.0
     for term in parsed_search.positive_terms:
-        positive_set |= set(_ngrams_for_term(term))
-    for term in parsed_search.negative_terms:
-        negative_set |= set(_ngrams_for_term(term))
+        if term:
+            score += TITLE_WEIGHT * title.count(term)
+            score += DESCRIPTION_WEIGHT * description.count(term)
+    release_date = item_info.release_date
+    if isinstance(release_date, datetime.datetime):
+        age = max(now - release_date, datetime.timedelta(0))
+        half_lives = ((age.days * 86400 + age.seconds) /
+                      float(RECENCY_HALF_LIFE.days * 86400))
+        score += RECENCY_WEIGHT * 0.5 ** half_lives
+    return score
+
+class RankedSearch(object):
+    """Search that returns the best matches first, one page at a time.
+
+    Each match gets scored once, when the search is created.  The scores go
+    into a heap (heapq.heapify() is O(n)) and pages get popped off it as
+    they're asked for.  Getting the first page costs O(n + page_size * log
+    n) instead of sorting every match, and each later page picks up where
+    the last one stopped.  That's a big win for broad searches where the
+    user only looks at the first few pages.
+
+    Pages that have already been popped are kept, so asking for one again
+    is cheap.
+
+    :param item_infos: ItemInfos to search.  This is only iterated once.
+    :param search_text: search string
+    :param page_size: number of ItemInfos to return for each page
+    """
+    def __init__(self, item_infos, search_text, page_size=100, now=None):
+        self.search_text = search_text
+        self.page_size = page_size
+        if now is None:
+            now = datetime.datetime.now()
+        # the index breaks ties, so we never compare ItemInfos
+        self._heap = [(-score_match(info, search_text, now), i, info)
+                      for i, info in enumerate(list_matches(item_infos,
+                                                            search_text))]
+        heapq.heapify(self._heap)
+        self.match_count = len(self._heap)
+        self._pages = []
+
+    def get_page(self, page):
+        """Get the ItemInfos for a page of results.
+
+        :param page: page number, starting with 0
+        :returns: list of ItemInfos, best match first.  An empty list
+            means there are no more results.
+        """
+        while len(self._pages) <= page and self._heap:
+            count = min(self.page_size, len(self._heap))
+            self._pages.append([heapq.heappop(self._heap)[2]
+                                for i in xrange(count)])
+        if page < len(self._pages):
+            return self._pages[page]
+        else:
+            return []
+
+    def has_more(self, page):
+        """Check if there are results after a page."""
+        return (page + 1) * self.page_size < self.match_count
+
+    def __iter__(self):
+        """Iterate through the pages of results."""
+        page = 0
+        while True:
+            results = self.get_page(page)
+            if results:
+                yield results
+            if not self.has_more(page):
+                return
+            page += 1
+
+class NGramIndex(object):
+    """Inverted index that maps N-grams to the ItemInfos that contain them.
+
+    item_matches() and list_matches() need to look at the N-grams of every
+    item.  NGramIndex lets us skip that: for each N-gram it stores the ids of
+    the items that contain it, so we can find the matches for a search by
+    intersecting the id lists of the search terms' N-grams.
+
+    The id lists are sorted arrays, which take up a lot less memory than
+    sets.  Since there's an id list entry for every distinct N-gram in every
+    item, this adds up quickly.
+    """
+
+    # When the candidate set is this many times smaller than an id list, we
+    # look up the candidates with a binary search rather than scanning the
+    # whole list.
+    BISECT_RATIO = 16
+
+    def __init__(self, infos=()):
+        self._postings = {}
+        # we keep the ItemInfos that we indexed, so that we know what N-grams
+        # to remove when they change.
+        self._infos = {}
+        # adding the infos in id order means that we just append to the id
+        # lists.
+        for info in sorted(infos, key=lambda info: info.id):
+            self.add_info(info)
+
+    def __len__(self):
+        return len(self._infos)
+
+    def add_info(self, info):
+        """Add an ItemInfo to the index."""
+        self._infos[info.id] = info
+        for gram in set(info.search_ngrams):
+            self._add_posting(gram, info.id)
+
+    def update_info(self, info):
+        """Update the index for an ItemInfo that changed."""
+        old_info = self._infos.get(info.id)
+        if old_info is None:
+            self.add_info(info)
+            return
+        self._infos[info.id] = info
+        old_ngrams = old_info.search_ngrams
+        new_ngrams = info.search_ngrams
+        if old_ngrams is new_ngrams:
+            # ItemInfo.updated() keeps the N-gram list when the search text
+            # didn't change.
+            return
+        old_ngrams = set(old_ngrams)
+        new_ngrams = set(new_ngrams)
+        for gram in old_ngrams - new_ngrams:
+            self._remove_posting(gram, info.id)
+        for gram in new_ngrams - old_ngrams:
+            self._add_posting(gram, info.id)
+
+    def remove_info(self, info):
+        """Remove an ItemInfo from the index."""
+        old_info = self._infos.pop(info.id, None)
+        if old_info is None:
+            return
+        for gram in set(old_info.search_ngrams):
+            self._remove_posting(gram, info.id)
+
+    def _add_posting(self, gram, id_):
+        try:
+            ids = self._postings[gram]
+        except KeyError:
+            self._postings[gram] = array.array('l', (id_,))
+            return
+        if ids[-1] < id_:
+            ids.append(id_)
+        else:
+            pos = bisect.bisect_left(ids, id_)
+            if pos == len(ids) or ids[pos] != id_:
+                ids.insert(pos, id_)
+
+    def _remove_posting(self, gram, id_):
+        ids = self._postings.get(gram)
+        if ids is None:
+            return
+        pos = bisect.bisect_left(ids, id_)
+        if pos < len(ids) and ids[pos] == id_:
+            del ids[pos]
+            if not ids:
+                del self._postings[gram]
+
+    def _ids_with_ngrams(self, grams, candidates=None):
+        """Get the ids of the items that contain all of grams.
+
+        :param candidates: if given, only ids in this set are returned.  If
+            it's smaller than the postings lists, we start with it and only
+            check those ids.
+        """
+        id_lists = []
+        for gram in set(grams):
+            try:
+                id_lists.append(self._postings[gram])
+            except KeyError:
+                return set()
+        # start with the shortest list, it bounds the size of the result
+        id_lists.sort(key=len)
+        if candidates is None:
+            if not id_lists:
+                return set(self._infos)
+            result = set(id_lists.pop(0))
+        elif not id_lists:
+            return set(id_ for id_ in candidates if id_ in self._infos)
+        elif len(candidates) <= len(id_lists[0]):
+            result = set(candidates)
+        else:
+            # set intersection only iterates the smaller set
+            result = set(id_lists.pop(0)) & candidates
+        for ids in id_lists:
+            if not result:
+                break
+            if len(result) * self.BISECT_RATIO < len(ids):
+                result = set(id_ for id_ in result
+                             if _sorted_contains(ids, id_))
+            else:
+                result.intersection_update(ids)
+        return result
+
+    def matching_ids(self, search_text, candidates=None):
+        """Get the ids of the indexed items that match a search.
 
-    for info in item_infos:
-        item_ngrams_set = set(info.search_ngrams)
-        match = positive_set.issubset(item_ngrams_set)
-        if match and negative_set:
-            match = negative_set.isdisjoint(item_ngrams_set)
+        This returns the same items as running item_matches() on each
+        indexed ItemInfo.
 
-        if match:
-            yield info
+        :param candidates: if given, a set of ids to check.  Use this to
+            narrow down the results of an earlier search.
+        :returns: set of item ids
+        """
+        parsed_search = _get_boolean_search(search_text)
+        positive_ngrams = []
+        for term in parsed_search.positive_terms:
+            positive_ngrams.extend(_ngrams_for_term(term))
+        matches = self._ids_with_ngrams(positive_ngrams, candidates)
+        for term in parsed_search.negative_terms:
+            if not matches:
+                break
+            matches -= self._ids_with_ngrams(_ngrams_for_term(term), matches)
+        return matches
 
+def _sorted_contains(sorted_list, value):
+    pos = bisect.bisect_left(sorted_list, value)
+    return pos < len(sorted_list) and sorted_list[pos] == value
@@ -204,6 +204,45 @@ class SignalEmitter(object):
                 if callback_map[id_].is_dead():
                     del callback_map[id_]
 
+class _LazySignalAttribute(object):
+    """Descriptor used by LazySignalEmitter.  The first time the attribute
+    is accessed on an instance, we set up the signal state for it.  After
+    that, the value in the instance dict takes precedence over us.
+    """
+    def __init__(self, name):
+        self.name = name
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+        instance._setup_signals()
+        return instance.__dict__[self.name]
+
+class LazySignalEmitter(SignalEmitter):
+    """SignalEmitter that doesn't create its callback maps until they're
+    needed.
+
+    This is useful for classes that have lots of instances, most of which
+    never have callbacks connected to them.  Subclasses list their signals
+    in SIGNAL_NAMES and don't need to call SignalEmitter.__init__().
+    """
+    SIGNAL_NAMES = ()
+
+    _frozen = False
+    signal_callbacks = _LazySignalAttribute('signal_callbacks')
+    id_generator = _LazySignalAttribute('id_generator')
+    _currently_emitting = _LazySignalAttribute('_currently_emitting')
+
+    def __init__(self):
+        pass
+
+    def _setup_signals(self):
+        self.signal_callbacks = {}
+        self.id_generator = itertools.count()
+        self._currently_emitting = set()
+        for name in self.SIGNAL_NAMES:
+            self.create_signal(name)
+
 class SystemSignals(SignalEmitter):
     """System wide signals for Miro.  These can be accessed from the singleton
     object signals.system.  Signals include:
@@ -58,6 +58,7 @@ from miro import dialogs
 from miro import downloader
 from miro import eventloop
 from miro import fileutil
+from miro import ftsindex
 from miro import guide
 from miro import httpauth
 from miro import httpclient
@@ -65,6 +66,7 @@ from miro import iconcache
 from miro import item
 from miro import iteminfocache
 from miro import feed
+from miro import feedparserpool
 from miro import folder
 from miro import messages
 from miro import messagehandler
@@ -195,6 +197,16 @@ def setup_global_feed(url, *args, **kwargs):
         raise StartupError("Database inconsistent",
                 "Too many db objects for %s" % url)
 
+# How often we check the item counts against the database in debug mode
+COUNT_CHECK_INTERVAL = 600
+
+def check_count_trackers():
+    """Make sure the counts from our CountTrackers match the database."""
+    if app.view_tracker_manager.check_count_trackers():
+        logging.debug("count trackers okay")
+    eventloop.add_timeout(COUNT_CHECK_INTERVAL, check_count_trackers,
+            "check count trackers")
+
 def initialize(themeName):
     """Initialize Miro.  This sets up things like logging and the config
     system and should be called as early as possible.
@@ -232,6 +244,10 @@ def startup():
     logging.info("Build Time: %s", app.config.get(prefs.BUILD_TIME))
     logging.info("Debugmode:  %s", app.debugmode)
     eventloop.connect('thread-started', finish_startup)
+    # this forks the feed parser processes, so it needs to happen before we
+    # start any threads
+    logging.info("Starting feed parser processes")
+    feedparserpool.startup()
     logging.info("Reading HTTP Password list")
     httpauth.init()
     httpauth.restore_from_file()
@@ -266,6 +282,10 @@ def finish_startup(obj, thread):
     except storedatabase.UpgradeError:
         raise StartupError(None, None)
     database.initialize()
+    app.db.start_idle_vacuum()
+    if app.debugmode:
+        eventloop.add_timeout(COUNT_CHECK_INTERVAL, check_count_trackers,
+                "check count trackers")
     end = time.time()
     logging.timing("Database upgrade time: %.3f", end - start)
     if app.db.startup_version != app.db.current_version:
@@ -278,6 +298,8 @@ def finish_startup(obj, thread):
         mem_usage_test_event.set()
     app.item_info_cache = iteminfocache.ItemInfoCache()
     app.item_info_cache.load()
+    if app.config.get(prefs.USE_FTS_SEARCH_INDEX):
+        setup_fts_index()
 
     logging.info("Loading video converters...")
     conversions.conversion_manager.startup()
@@ -297,6 +319,15 @@ def finish_startup(obj, thread):
 
     eventloop.add_urgent_call(check_firsttime, "check first time")
 
+def setup_fts_index():
+    if not ftsindex.ItemFTSIndex.is_supported(app.db.cursor):
+        logging.warn("SQLite doesn't support FTS, using the in-memory "
+                "search index")
+        return
+    index = ftsindex.ItemFTSIndex()
+    index.setup()
+    app.item_fts_index = index
+
 def fix_database_inconsistencies():
     item.fix_non_container_parents()
     item.move_orphaned_items()
@@ -489,13 +520,16 @@ def clear_icon_cache_orphans():
 
     existingFiles = [os.path.normcase(os.path.join(cachedir, f))
             for f in os.listdir(cachedir)]
-    yield None
-
-    knownIcons = iconcache.IconCache.all_filenames()
-    yield None
+    # Query the filenames in the background.  We list the directory first,
+    # so any file that we see already has its IconCache row committed.
+    iconcache.IconCache.select_async(["filename"], 'filename IS NOT NULL',
+            None, lambda rows: _clear_icon_cache_orphan_files(existingFiles,
+                rows))
 
-    knownIcons = [ os.path.normcase(fileutil.expand_filename(path)) for path in
-            knownIcons]
+@eventloop.idle_iterator
+def _clear_icon_cache_orphan_files(existingFiles, rows):
+    knownIcons = [ os.path.normcase(fileutil.expand_filename(row[0]))
+            for row in rows]
     yield None
 
     for filename in existingFiles:
@@ -40,10 +40,13 @@ separate column.
 Most columns are stored using SQLite datatypes (``INTEGER``, ``REAL``,
 ``TEXT``, ``DATETIME``, etc.).  However some of our python values,
 don't have an equivalent (lists, dicts and timedelta objects).  For
-those, we store the python representation of the object.  This makes
-the column look similar to a JSON value, although not quite the same.
-The hope is that it will be human readable.  We use the type
-``pythonrepr`` to label these columns.
+timedelta objects, we store the python representation of the object.
+Container values (dicts, lists, tuples and the downloader status dict) are
+stored as a BLOB in a small versioned binary format (see
+SQLiteConverter.encode_container()).  Older databases stored containers
+using their python representation as well; those rows are still readable
+and get rewritten in the binary format the first time they're restored.
+We use the type ``pythonrepr`` to label all of these columns.
 """
 
 import glob
@@ -56,6 +59,8 @@ import traceback
 import time
 import os
 import sys
+import threading
+import Queue
 from cStringIO import StringIO
 
 try:
@@ -75,10 +80,11 @@ from miro import iteminfocache
 from miro import messages
 from miro import schema
 from miro import prefs
+from miro import queryplan
 from miro import util
 from miro.download_utils import next_free_filename
 from miro.gtcache import gettext as _
-from miro.plat.utils import FilenameType, filename_to_unicode
+from miro.plat.utils import FilenameType, filename_to_unicode, thread_body
 
 class UpgradeError(Exception):
     """While upgrading the database, we ran out of disk space."""
@@ -129,6 +135,24 @@ class LiveStorage:
     1. Loads the initial object list (and runs database upgrades)
     2. Handles updating the database based on changes to DDBObjects.
     """
+
+    # size of SQLite's page cache (in pages)
+    CACHE_SIZE = 4000
+    # how much of the database file SQLite can memory map (in bytes)
+    MMAP_SIZE = 64 * 1024 * 1024
+    # how long to wait for other connections to release the write lock (in
+    # seconds).  ItemInfoCacheWriter uses the same value, so that neither
+    # connection gives up while the other one is writing.
+    BUSY_TIMEOUT = 60
+    # how often should we check if the database needs vacuuming? (in seconds)
+    VACUUM_CHECK_INTERVAL = 600
+    # run an incremental vacuum once the freelist is at least this many pages
+    # and this fraction of the database.
+    VACUUM_MIN_FREE_PAGES = 256
+    VACUUM_MIN_FREE_RATIO = 0.1
+    # how many pages to free up each time we run incremental_vacuum
+    VACUUM_PAGES_PER_STEP = 128
+
     def __init__(self, path=None, object_schemas=None, schema_version=None):
         if path is None:
             path = app.config.get(prefs.SQLITE_PATHNAME)
@@ -153,6 +177,12 @@ class LiveStorage:
         self.raise_load_errors = False # only gets set in unittests
         self._dc = None
         self._query_times = {}
+        self._reader = None
+        self._use_wal = False
+        if app.debugmode:
+            self._plan_auditor = queryplan.QueryPlanAuditor()
+        else:
+            self._plan_auditor = None
         self.path = path
         self.open_connection()
         self._quitting_from_operational_error = False
@@ -163,7 +193,11 @@ class LiveStorage:
         self._all_schemas = []
         self._object_map = {} # maps object id -> DDBObjects in memory
         self._ids_loaded = set()
+        # maps object id -> (DDBObject, set of columns) for objects that we
+        # need to run an UPDATE for.
+        self._dirty_objects = {}
         self._statements_in_transaction = []
+        self._finish_transaction_callbacks = []
         eventloop.connect("event-finished", self.on_event_finished)
         for oschema in object_schemas:
             self._all_schemas.append(oschema)
@@ -184,24 +218,118 @@ class LiveStorage:
         logging.info("opening database %s", path)
         self.connection = sqlite3.connect(path,
                 isolation_level=None,
-                detect_types=sqlite3.PARSE_DECLTYPES)
+                detect_types=sqlite3.PARSE_DECLTYPES,
+                timeout=self.BUSY_TIMEOUT)
         self.cursor = self.connection.cursor()
+        try:
+            self._tune_connection(path)
+        except sqlite3.DatabaseError, e:
+            # The file is probably corrupt.  Don't fail here,
+            # upgrade_database() will notice and handle the error.
+            logging.warn("error setting up database connection: %s", e)
+
+    def _tune_connection(self, path):
+        """Set the PRAGMAs that we use for our connection."""
+        # auto_vacuum only takes effect on a new database.  Existing ones
+        # get converted in upgrade129().
+        self.cursor.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        if path != ":memory:" and sqlite3.sqlite_version_info >= (3, 7, 0):
+            # With a write-ahead log, readers don't block the writer and
+            # commits only need to sync the log.  NORMAL is safe in that
+            # case, we can only lose the last transactions on a power
+            # failure.
+            self.cursor.execute("PRAGMA journal_mode=WAL")
+            journal_mode = self.cursor.fetchone()[0]
+            logging.info("journal mode: %s", journal_mode)
+            self._use_wal = (journal_mode.lower() == 'wal')
+            self.cursor.execute("PRAGMA synchronous=NORMAL")
+        self.cursor.execute("PRAGMA cache_size=%d" % self.CACHE_SIZE)
+        # mmap_size needs SQLite 3.7.17.  Older versions ignore it.
+        self.cursor.execute("PRAGMA mmap_size=%d" % self.MMAP_SIZE)
+        self.cursor.fetchall()
+
+    def supports_worker_connections(self):
+        """Can other threads open their own connections to our database?
+
+        This is only true for on-disk databases that use a write-ahead log.
+        Otherwise those connections would block ours (or not be able to see
+        our data at all for in-memory databases).
+        """
+        return self._use_wal
+
+    def start_idle_vacuum(self):
+        """Start periodically checking if the database needs vacuuming.
+
+        Rather than running VACUUM at shutdown, we watch the size of the
+        freelist and run "PRAGMA incremental_vacuum" in small steps from
+        idle callbacks.  This only works for databases with
+        auto_vacuum=INCREMENTAL.
+        """
+        if self.path == ":memory:":
+            return
+        self.cursor.execute("PRAGMA auto_vacuum")
+        if self.cursor.fetchone()[0] != 2:
+            logging.info("auto_vacuum not incremental, not vacuuming")
+            return
+        self._schedule_vacuum_check()
+
+    def _schedule_vacuum_check(self):
+        self._dc = eventloop.add_timeout(self.VACUUM_CHECK_INTERVAL,
+                self._check_freelist, "check database freelist")
+
+    def _needs_vacuum(self):
+        self.cursor.execute("PRAGMA freelist_count")
+        free_pages = self.cursor.fetchone()[0]
+        self.cursor.execute("PRAGMA page_count")
+        total_pages = self.cursor.fetchone()[0]
+        return (free_pages >= self.VACUUM_MIN_FREE_PAGES and
+                free_pages >= total_pages * self.VACUUM_MIN_FREE_RATIO)
+
+    def _check_freelist(self):
+        if self._needs_vacuum():
+            logging.info("starting incremental vacuum")
+            self._dc = eventloop.add_idle(self._incremental_vacuum_step,
+                    "incremental vacuum")
+        else:
+            self._schedule_vacuum_check()
+
+    def _incremental_vacuum_step(self):
+        if (self._statements_in_transaction or
+                self._quitting_from_operational_error):
+            # incremental_vacuum would become part of our transaction, try
+            # again later.
+            self._schedule_vacuum_check()
+            return
+        try:
+            self.cursor.execute("PRAGMA incremental_vacuum(%d)" %
+                    self.VACUUM_PAGES_PER_STEP)
+            self.cursor.fetchall()
+        except sqlite3.DatabaseError, sdbe:
+            logging.info("incremental vacuum failed: %s", sdbe)
+            self._schedule_vacuum_check()
+            return
+        self.cursor.execute("PRAGMA freelist_count")
+        if self.cursor.fetchone()[0] > 0:
+            self._dc = eventloop.add_idle(self._incremental_vacuum_step,
+                    "incremental vacuum")
+        else:
+            logging.info("incremental vacuum finished")
+            self._schedule_vacuum_check()
 
     def close(self):
         logging.info("closing database")
         if self._dc:
             self._dc.cancel()
             self._dc = None
+        if self._reader is not None:
+            self._reader.shutdown()
+            self._reader = None
         self.finish_transaction()
-
-        # the unittests run in memory and vacuum causes a segfault if
-        # the db is in memory.
-        if self.path != ":memory:" and self.connection and self.cursor:
-            logging.info("Vacuuming the db before shutting down.")
-            try:
-                self.cursor.execute("vacuum")
-            except sqlite3.DatabaseError, sdbe:
-                logging.info("... Vacuuming failed with DatabaseError: %s", sdbe)
+        if self._plan_auditor is not None:
+            logging.info(self.query_plan_report())
+            self._plan_auditor = None
+        # We don't VACUUM here, start_idle_vacuum() handles that.  Closing
+        # the last connection checkpoints the write-ahead log.
         self.connection.close()
 
     def get_backup_directory(self):
@@ -240,9 +368,30 @@ class LiveStorage:
             logging.exception('error when upgrading database: %s', e)
             self._handle_upgrade_error()
 
+    def _checkpoint_wal(self):
+        """Copy everything in the write-ahead log into the database file.
+
+        :returns: True if the log is now empty
+        """
+        if not self._use_wal:
+            return True
+        try:
+            self.cursor.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+            busy = self.cursor.fetchone()[0]
+        except sqlite3.DatabaseError, e:
+            logging.warn("error checkpointing the database: %s", e)
+            return False
+        return not busy
+
     def _backup_failed_upgrade_db(self):
         save_name = self._find_unused_db_name(self.path, "failed_upgrade_database")
         path = os.path.join(os.path.dirname(self.path), save_name)
+        if not self._checkpoint_wal():
+            # Some pages are still only in the log, save it with the
+            # backup so that opening the backup replays them.
+            wal_path = self.path + '-wal'
+            if os.path.exists(wal_path):
+                shutil.copyfile(wal_path, path + '-wal')
         shutil.copyfile(self.path, path)
         logging.warn("upgrade failed. Backing up database to %s", path)
 
@@ -397,6 +546,7 @@ class LiveStorage:
     def forget_object(self, obj):
         del self._object_map[obj.id]
         self._ids_loaded.remove(obj.id)
+        self._dirty_objects.pop(obj.id, None)
 
     def _insert_sql_for_schema(self, obj_schema):
         return "INSERT INTO %s (%s) VALUES(%s)" % (obj_schema.table_name,
@@ -446,16 +596,21 @@ class LiveStorage:
             obj.reset_changed_attributes()
 
     def update_obj(self, obj):
-        """Update a DDBObject on disk."""
+        """Update a DDBObject on disk.
+
+        We don't run the UPDATE statement right away.  Instead we remember
+        which columns have changed and write them out in
+        finish_transaction() (or before the next SELECT).  This way an
+        object that changes many times during an event only gets one
+        UPDATE.
+        """
 
         obj_schema = self._schema_map[obj.__class__]
-        setters = []
-        values = []
+        columns = []
         for name, schema_item in obj_schema.fields:
             if (isinstance(schema_item, schema.SchemaSimpleItem) and
                     name not in obj.changed_attributes):
                 continue
-            setters.append('%s=?' % name)
             value = getattr(obj, name)
             try:
                 schema_item.validate(value)
@@ -463,17 +618,48 @@ class LiveStorage:
                 if util.chatter:
                     logging.warn("error validating %s for %s", name, obj)
                 raise
-            values.append(self._converter.to_sql(obj_schema, name,
-                schema_item, value))
+            columns.append(name)
         obj.reset_changed_attributes()
-        if values:
-            sql = "UPDATE %s SET %s WHERE id=%s" % (obj_schema.table_name,
-                    ', '.join(setters), obj.id)
-            self._execute(sql, values, is_update=True)
-            if (self.cursor.rowcount != 1 and not
+        if columns:
+            self._mark_dirty(obj, columns)
+
+    def _mark_dirty(self, obj, columns):
+        try:
+            self._dirty_objects[obj.id][1].update(columns)
+        except KeyError:
+            self._dirty_objects[obj.id] = (obj, set(columns))
+
+    def _flush_dirty_objects(self):
+        """Run the UPDATE statements for objects passed to update_obj().
+
+        Objects are grouped by table and the columns that changed, so that
+        each group can be written with a single executemany() call.
+        """
+        if not self._dirty_objects:
+            return
+        dirty_objects = self._dirty_objects
+        self._dirty_objects = {}
+        batches = {}
+        for obj, changed in dirty_objects.itervalues():
+            obj_schema = self._schema_map[obj.__class__]
+            columns = tuple(name for name, schema_item in obj_schema.fields
+                    if name in changed)
+            values = []
+            for name in columns:
+                schema_item = self._schema_column_map[obj_schema, name]
+                values.append(self._converter.to_sql(obj_schema, name,
+                    schema_item, getattr(obj, name)))
+            values.append(obj.id)
+            batches.setdefault((obj_schema.table_name, columns),
+                    []).append(values)
+        for (table_name, columns), value_list in batches.iteritems():
+            sql = "UPDATE %s SET %s WHERE id=?" % (table_name,
+                    ', '.join('%s=?' % name for name in columns))
+            self._execute(sql, value_list, is_update=True, many=True)
+            if (self.cursor.rowcount != len(value_list) and not
                     self._quitting_from_operational_error):
-                raise AssertionError("update_obj changed %s rows" %
-                        self.cursor.rowcount)
+                raise AssertionError("UPDATE for %s objects changed %s rows"
+                        % (len(value_list), self.cursor.rowcount))
 
     def remove_obj(self, obj):
         """Remove a DDBObject from disk."""
@@ -538,6 +724,16 @@ class LiveStorage:
     def table_name(self, klass):
         return self._schema_map[klass].table_name
 
+    def columns_for_table(self, table_name):
+        """Get the column names for a table.
+
+        Throws a KeyError if table_name isn't one of our tables.
+        """
+        for oschema in self._all_schemas:
+            if oschema.table_name == table_name:
+                return [name for name, schema_item in oschema.fields]
+        raise KeyError(table_name)
+
     def object_from_class_table(self, obj, klass):
         return self._schema_map[klass] is self._schema_map[obj.__class__]
 
@@ -583,12 +779,12 @@ class LiveStorage:
 
     def query_ids(self, table_name, where, values=None, order_by=None,
             joins=None, limit=None):
+        self._flush_dirty_objects()
         sql = StringIO()
         sql.write("SELECT %s.id " % table_name)
         sql.write(self._get_query_bottom(table_name, where, joins,
             order_by, limit))
-        self.cursor.execute(sql.getvalue(), values)
-        return (row[0] for row in self.cursor.fetchall())
+        return (row[0] for row in self._execute(sql.getvalue(), values))
 
     def _restore_objects(self, schema, id_set):
         column_names = ['%s.%s' % (schema.table_name, f[0])
@@ -611,8 +807,10 @@ class LiveStorage:
         restored_data = {}
         columns_to_update = []
         values_to_update = []
-        for (name, schema_item), value in \
+        legacy_columns = []
+        for (name, schema_item), db_value in \
                 itertools.izip(schema.fields, db_row):
+            value = db_value
             try:
                 value = self._converter.from_sql(schema, name, schema_item,
                         value)
@@ -632,16 +830,25 @@ class LiveStorage:
                 columns_to_update.append(name)
                 values_to_update.append(self._converter.to_sql(schema, name,
                     schema_item, value))
+            else:
+                if self._converter.is_legacy_value(schema_item, db_value):
+                    legacy_columns.append(name)
             restored_data[name] = value
         if columns_to_update:
             # We are using some values that are different than what's stored
             # in disk.  Update the database to make things match.
             setters = ['%s=?' % c for c in columns_to_update]
-            sql = "UPDATE %s SET %s WHERE id=%s" % (schema.table_name,
-                    ', '.join(setters), restored_data['id'])
-            self._execute(sql, values_to_update)
+            sql = "UPDATE %s SET %s WHERE id=?" % (schema.table_name,
+                    ', '.join(setters))
+            self._execute(sql, values_to_update + [restored_data['id']])
         klass = schema.get_ddb_class(restored_data)
-        return klass(restored_data=restored_data)
+        obj = klass(restored_data=restored_data)
+        if legacy_columns and obj.id in self._object_map:
+            # The row was written by an older version using repr() for
+            # container columns.  Queue it up to be re-written in the binary
+            # format along with the rest of this event's updates.
+            self._mark_dirty(obj, legacy_columns)
+        return obj
 
     def persistent_object_count(self):
         return len(self._object_map)
@@ -672,6 +879,9 @@ class LiveStorage:
         results = self._execute(sql.getvalue(), values)
         if not convert:
             return results
+        return self._convert_rows(schema, columns, results)
+
+    def _convert_rows(self, schema, columns, results):
         schema_items = [self._schema_column_map[schema, c] for c in columns]
         rows = []
         for row in results:
@@ -683,10 +893,74 @@ class LiveStorage:
             rows.append(converted_row)
         return rows
 
+    def query_async(self, sql, values, callback, errback=None):
+        """Run a SELECT statement without blocking the event loop.
+
+        The query runs on a separate read-only connection in a worker
+        thread.  When it finishes, callback is called with the list of
+        result rows from an idle callback.  If it fails, errback is called
+        with the exception (or the error is logged if errback is None).
+
+        The worker connection sees the database as of the last commit, so
+        changes made in the current event aren't visible.  Only use this
+        for queries where a slightly stale snapshot is okay.
+
+        For in-memory databases, or if we couldn't enable the write-ahead
+        log, we run the query right away on the main connection, but still
+        deliver the results from an idle callback.
+        """
+        if values is None:
+            values = ()
+        if not self.supports_worker_connections():
+            try:
+                self._flush_dirty_objects()
+                self.cursor.execute(sql, values)
+                rows = self.cursor.fetchall()
+            except StandardError, e:
+                _deliver_async_error(sql, errback, e)
+            else:
+                eventloop.add_idle(callback, 'async query results',
+                        args=(rows,))
+            return
+        if self._reader is None:
+            self._reader = AsyncQueryThread(self.path)
+            self._reader.start_thread()
+        self._reader.add_query(sql, values, callback, errback)
+
+    def select_async(self, klass, columns, where, values, callback,
+            errback=None, joins=None, limit=None):
+        """Version of select() that uses query_async().
+
+        Rows are converted on the event loop thread before being passed to
+        callback.
+        """
+        schema = self._schema_map[klass]
+        sql = StringIO()
+        sql.write('SELECT %s ' % ', '.join(columns))
+        sql.write(self._get_query_bottom(schema.table_name, where, joins, None,
+            limit))
+        def convert_callback(results):
+            try:
+                rows = self._convert_rows(schema, columns, results)
+            except StandardError, e:
+                if errback is None:
+                    raise
+                errback(e)
+            else:
+                callback(rows)
+        self.query_async(sql.getvalue(), values, convert_callback, errback)
+
     def on_event_finished(self, eventloop, success):
         self.finish_transaction(commit=success)
 
     def finish_transaction(self, commit=True):
+        if commit:
+            self._flush_dirty_objects()
+        else:
+            # the UPDATEs would have been rolled back anyway
+            self._dirty_objects = {}
+        for callback in self._finish_transaction_callbacks:
+            callback(commit)
         if len(self._statements_in_transaction) == 0:
             return
         if not self._quitting_from_operational_error:
@@ -696,17 +970,44 @@ class LiveStorage:
                 self.cursor.execute("ROLLBACK TRANSACTION")
         self._statements_in_transaction = []
 
+    def add_finish_transaction_callback(self, callback):
+        """Call callback(commit) each time finish_transaction() runs.
+
+        The callback runs before we COMMIT or ROLLBACK, so it can use
+        execute_update() to make its own writes part of the transaction.
+        """
+        self._finish_transaction_callbacks.append(callback)
+
+    def remove_finish_transaction_callback(self, callback):
+        self._finish_transaction_callbacks.remove(callback)
+
+    def execute_update(self, sql, values=None, many=False):
+        """Run an INSERT/UPDATE/DELETE statement in the current transaction.
+
+        The statement gets committed or rolled back along with the rest of
+        the current event's changes, in finish_transaction().
+        """
+        self._execute(sql, values, is_update=True, many=many)
+
     def _execute(self, sql, values, is_update=False, many=False):
         if is_update and self._quitting_from_operational_error:
             # We want to avoid updating the database at this point.
             return
 
+        if not is_update:
+            # make sure the SELECT sees any changes that we haven't written
+            # out yet.
+            self._flush_dirty_objects()
+
         if is_update and len(self._statements_in_transaction) == 0:
             self.cursor.execute("BEGIN TRANSACTION")
 
         if values is None:
             values = ()
 
+        if not is_update and self._plan_auditor is not None:
+            self._plan_auditor.audit(self.cursor, sql, values)
+
         failed = False
         if is_update:
             self._statements_in_transaction.append((sql, values, many))
@@ -739,6 +1040,16 @@ class LiveStorage:
         else:
             return self.cursor.fetchall()
 
+    def query_plan_report(self):
+        """Get a report of the statements that scanned entire tables and
+        the indexes that would avoid those scans.
+
+        This is only available in debug mode, otherwise we return None.
+        """
+        if self._plan_auditor is None:
+            return None
+        return queryplan.make_report(self._plan_auditor, self.cursor)
+
     def _time_execute(self, sql, values, many):
         start = time.time()
         if many:
@@ -881,7 +1192,11 @@ class LiveStorage:
         """Saves the current database then starts fresh with an empty
         database.
         """
+        if self._reader is not None:
+            self._reader.shutdown()
+            self._reader = None
         self.connection.close()
+        self._dirty_objects = {}
         self.save_invalid_db()
         self.open_connection()
         self._init_database()
@@ -901,7 +1216,13 @@ class LiveStorage:
         target_path = os.path.dirname(self.path)
         save_name = self._find_unused_db_name(
             target_path, "corrupt_database")
-        os.rename(self.path, os.path.join(target_path, save_name))
+        save_path = os.path.join(target_path, save_name)
+        os.rename(self.path, save_path)
+        # Move the write-ahead log files too.  If we left them behind,
+        # SQLite could replay them into the new database at self.path.
+        for suffix in ('-wal', '-shm'):
+            if os.path.exists(self.path + suffix):
+                os.rename(self.path + suffix, save_path + suffix)
 
     def _find_unused_db_name(self, target_path, save_name):
         org_save_name = save_name
@@ -934,30 +1255,116 @@ class LiveStorage:
             indent(1)
             output.write ('</%s>\n' % (table_name))
         output.write ('<?xml version="1.0"?>\n')
+        self._flush_dirty_objects()
         output.write ('<database schema="%d">\n' % (self._schema_version,))
         for schema in self._object_schemas:
             self.cursor.execute("SELECT * FROM %s" % schema.table_name)
             column_names = [d[0] for d in self.cursor.description]
             for row in self.cursor:
-                output_object(schema.table_name.replace('_', '-'),
-                        dict(zip(column_names, row)))
+                values = dict(zip(column_names, row))
+                for name, schema_item in schema.fields:
+                    if (isinstance(schema_item,
+                            SQLiteConverter.container_types) and
+                            values.get(name) is not None):
+                        # write containers out in a human-readable form
+                        values[name] = repr(
+                                self._converter.decode_container(values[name]))
+                output_object(schema.table_name.replace('_', '-'), values)
         output.write ('</database>\n')
         output.close()
 
+def _deliver_async_error(sql, errback, error):
+    if errback is not None:
+        eventloop.add_idle(errback, 'async query error', args=(error,))
+    else:
+        logging.warn("error running async query: %s (%s)", sql, error)
+
+class AsyncQueryThread(object):
+    """Runs SELECT statements for LiveStorage.query_async().
+
+    The thread has its own connection to the database which it only reads
+    from.  Since the database uses a write-ahead log, the reads don't block
+    (and aren't blocked by) the event loop's connection.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.queue = Queue.Queue()
+        self.thread = None
+
+    def start_thread(self):
+        self.thread = threading.Thread(name='DB Query Thread',
+                                       target=thread_body,
+                                       args=[self.thread_loop])
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def add_query(self, sql, values, callback, errback):
+        self.queue.put((sql, values, callback, errback))
+
+    def shutdown(self):
+        # wake up our thread
+        self.queue.put(None)
+        if self.thread is not None:
+            self.thread.join()
+
+    def open_connection(self):
+        connection = sqlite3.connect(self.path, isolation_level=None,
+                detect_types=sqlite3.PARSE_DECLTYPES)
+        try:
+            # query_only needs SQLite 3.8.0.  Older versions ignore it.
+            connection.execute("PRAGMA query_only=ON")
+            connection.execute("PRAGMA cache_size=%d" % LiveStorage.CACHE_SIZE)
+            connection.execute("PRAGMA mmap_size=%d" % LiveStorage.MMAP_SIZE)
+        except sqlite3.Error:
+            logging.warn("error setting up async query connection",
+                    exc_info=True)
+        return connection
+
+    def thread_loop(self):
+        connection = self.open_connection()
+        try:
+            while True:
+                query = self.queue.get(block=True)
+                if query is None:
+                    # shutdown() was called
+                    break
+                sql, values, callback, errback = query
+                try:
+                    rows = connection.execute(sql, values).fetchall()
+                except StandardError, e:
+                    # not just sqlite3.Error, callers count on hearing back
+                    # either way
+                    _deliver_async_error(sql, errback, e)
+                else:
+                    eventloop.add_idle(callback, 'async query results',
+                            args=(rows,))
+        finally:
+            connection.close()
+
 class SQLiteConverter(object):
+    # Container columns are stored as CONTAINER_MAGIC, followed by a version
+    # byte, followed by the payload.  Version 1 is a protocol 2 pickle of the
+    # value.  The leading NUL byte can never start a repr() string, which is
+    # how we tell new values from ones written by older versions.
+    CONTAINER_MAGIC = '\x00'
+    CONTAINER_VERSION = 1
+
+    container_types = (schema.SchemaReprContainer,
+            schema.SchemaTuple,
+            schema.SchemaDict,
+            schema.SchemaList,
+            schema.SchemaStatusContainer,
+            )
+
     def __init__(self):
         self._to_sql_converters = {}
         self._from_sql_converters = {}
 
-        repr_types = (schema.SchemaTimeDelta,
-                schema.SchemaReprContainer,
-                schema.SchemaTuple,
-                schema.SchemaDict,
-                schema.SchemaList,
-                )
-        for schema_class in repr_types:
-            self._to_sql_converters[schema_class] = repr
-            self._from_sql_converters[schema_class] = self._convert_repr
+        self._to_sql_converters[schema.SchemaTimeDelta] = repr
+        self._from_sql_converters[schema.SchemaTimeDelta] = self._convert_repr
+        for schema_class in self.container_types:
+            self._to_sql_converters[schema_class] = self.encode_container
+            self._from_sql_converters[schema_class] = self.decode_container
         self._to_sql_converters[schema.SchemaStatusContainer] = \
                 self._convert_status_to_sql
         self._from_sql_converters[schema.SchemaStatusContainer] = \
@@ -987,6 +1394,13 @@ class SQLiteConverter(object):
                 self._null_convert)
         return converter(value)
 
+    def is_legacy_value(self, schema_item, value):
+        """Check if a value read from the database is a container stored
+        with repr() by an older version of Miro.
+        """
+        return (isinstance(value, basestring) and
+                isinstance(schema_item, self.container_types))
+
     def get_malformed_data_handler(self, schema, name, schema_item, value):
         handler_name = 'handle_malformed_%s' % name
         if hasattr(schema, handler_name):
@@ -1011,8 +1425,23 @@ class SQLiteConverter(object):
     def _convert_repr(self, value):
         return eval(value, __builtins__, {'datetime': datetime, 'time': _TIME_MODULE_SHADOW})
 
-    def _convert_status(self, repr_value):
-        status_dict = self._convert_repr(repr_value)
+    def encode_container(self, value):
+        return buffer(self.CONTAINER_MAGIC + chr(self.CONTAINER_VERSION) +
+                cPickle.dumps(value, 2))
+
+    def decode_container(self, value):
+        if isinstance(value, unicode):
+            # written by an older version using repr()
+            return self._convert_repr(value)
+        value = str(value)
+        if not value.startswith(self.CONTAINER_MAGIC):
+            return self._convert_repr(value)
+        if value[1:2] != chr(self.CONTAINER_VERSION):
+            raise ValueError("Unknown container format: %r" % value[1:2])
+        return cPickle.loads(value[2:])
+
+    def _convert_status(self, sql_value):
+        status_dict = self.decode_container(sql_value)
         filename_fields = schema.SchemaStatusContainer.filename_fields
         for key in filename_fields:
             value = status_dict.get(key)
@@ -1027,7 +1456,7 @@ class SQLiteConverter(object):
             value = to_save.get(key)
             if value is not None:
                 to_save[key] = filename_to_unicode(value)
-        return repr(to_save)
+        return self.encode_container(to_save)
 
 class TimeModuleShadow:
     """In Python 2.6, time.struct_time is a named tuple and evals poorly,
@@ -54,6 +54,8 @@ from miro.test.databasesanitytest import *
 from miro.test.subscriptiontest import *
 from miro.test.opmltest import *
 from miro.test.schedulertest import *
+from miro.test.pollertest import *
+from miro.test.eventloopstatstest import *
 from miro.test.networktest import *
 from miro.test.httpclienttest import *
 from miro.test.httpdownloadertest import *
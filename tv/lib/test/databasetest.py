@@ -1,4 +1,5 @@
 import logging
+from datetime import datetime
 
 from miro.test.framework import MiroTestCase
 from miro import app
@@ -6,7 +7,9 @@ from miro import database
 from miro import databaselog
 from miro import item
 from miro import feed
+from miro import folder
 from miro import schema
+from miro import viewpredicate
 
 class DatabaseTestCase(MiroTestCase):
     def setUp(self):
@@ -146,6 +149,31 @@ class ViewTrackerTest(DatabaseTestCase):
         self.assertEquals(self.remove_callbacks, [self.i2])
         self.assertEquals(self.change_callbacks, [self.i1])
 
+    def check_bulk_insert(self, view, expected_adds):
+        self.setup_view(view)
+        app.bulk_sql_manager.start()
+        self.i4 = item.Item(item.FeedParserValues({'title': u'item4'}),
+                feed_id=self.feed.id)
+        self.i5 = item.Item(item.FeedParserValues({'title': u'item5'}),
+                feed_id=self.feed2.id)
+        self.i4.set_title(u'item4')
+        self.i5.set_title(u'item5')
+        app.bulk_sql_manager.finish()
+        self.assertSameSet(self.add_callbacks,
+                [getattr(self, name) for name in expected_adds])
+        self.assertEquals(self.remove_callbacks, [])
+        # items that were already in the view didn't change, so we
+        # shouldn't send them again
+        self.assertEquals(self.change_callbacks, [])
+
+    def test_bulk_insert_delta(self):
+        self.check_bulk_insert(item.Item.make_view('feed_id=?',
+            (self.feed.id,)), ['i4'])
+
+    def test_bulk_insert_delta_uncompiled(self):
+        self.check_bulk_insert(item.Item.make_view("title LIKE 'item%'"),
+                ['i4', 'i5'])
+
     def test_unlink(self):
         self.tracker.unlink()
         self.feed2.set_title(u"booya")
@@ -167,6 +195,194 @@ class ViewTrackerTest(DatabaseTestCase):
         self.clear_ddb_object_cache()
         tracker.check_all_objects()
 
+class ViewPredicateTest(DatabaseTestCase):
+    def setUp(self):
+        DatabaseTestCase.setUp(self)
+        self.feed.set_title(u"booya")
+        self.i1.mark_item_seen()
+
+    def check_predicate_matches_sql(self, view):
+        tracker = view.make_tracker()
+        self.assertNotEquals(tracker.predicate, None)
+        for obj in (self.i1, self.i2, self.i3):
+            self.assertEquals(tracker.predicate.evaluate(obj, view.values),
+                    tracker._obj_in_view_sql(obj))
+        tracker.unlink()
+
+    def test_simple(self):
+        self.check_predicate_matches_sql(item.Item.make_view('NOT seen'))
+        self.check_predicate_matches_sql(item.Item.make_view(
+            'feed_id=? AND (deleted IS NULL or not deleted)',
+            (self.feed.id,)))
+
+    def test_join(self):
+        self.check_predicate_matches_sql(item.Item.make_view(
+            "feed.userTitle='booya'", joins={'feed': 'feed.id=item.feed_id'}))
+        self.check_predicate_matches_sql(item.Item.newly_downloaded_view())
+        self.check_predicate_matches_sql(item.Item.download_tab_view())
+        self.check_predicate_matches_sql(item.Item.auto_pending_view())
+
+    def test_uncompilable(self):
+        for view in (item.Item.orphaned_from_feed_view(),
+                item.Item.playlist_view(0),
+                feed.Feed.make_view("userTitle LIKE 'booya%'")):
+            tracker = view.make_tracker()
+            self.assertEquals(tracker.predicate, None)
+            tracker.unlink()
+
+    def test_not_in_memory(self):
+        tracker = item.Item.make_view("feed.userTitle='booya'",
+                joins={'feed': 'feed.id=item.feed_id'}).make_tracker()
+        app.db.forget_object(self.feed)
+        self.assertRaises(viewpredicate.NotInMemory,
+                tracker.predicate.evaluate, self.i1, ())
+        # falling back to SQL should still work
+        self.assertEquals(tracker._obj_in_view(self.i1), True)
+
+class TrackerRoutingTest(DatabaseTestCase):
+    def setUp(self):
+        DatabaseTestCase.setUp(self)
+        self.feed.set_title(u"booya")
+        self.tracker = item.Item.make_view(
+                "feed.userTitle='booya' AND NOT item.keep",
+                joins={'feed': 'feed.id=item.feed_id'}).make_tracker()
+        self.checked = []
+        self.removed = []
+        self.changed = []
+        self.tracker.object_changed = self.checked.append
+        self.tracker.connect('removed',
+                lambda tracker, obj: self.removed.append(obj))
+        self.tracker.connect('changed',
+                lambda tracker, obj: self.changed.append(obj))
+        # make sure our items have been checked once
+        self.i1.signal_change()
+        self.i2.signal_change()
+        self.checked[:] = []
+        self.changed[:] = []
+
+    def test_dependencies(self):
+        self.assertEquals(self.tracker.dependencies,
+                set(['keep', 'feed_id']))
+        self.assertEquals(self.tracker.joined_dependencies,
+                {'feed': set(['userTitle'])})
+
+    def test_unrelated_change(self):
+        self.i1.set_title(u"new title")
+        self.assertEquals(self.checked, [])
+        self.assertEquals(self.changed, [self.i1])
+
+    def test_related_change(self):
+        del self.tracker.object_changed
+        self.i1.keep = True
+        self.i1.signal_change()
+        self.assertEquals(self.removed, [self.i1])
+
+    def test_joined_change(self):
+        self.feed.set_title(u"other")
+        self.i1.signal_change(needs_save=False)
+        self.assertEquals(self.checked, [self.i1])
+        # the feed change was already handled for i1
+        self.i1.signal_change(needs_save=False)
+        self.assertEquals(self.checked, [self.i1])
+        self.i2.signal_change(needs_save=False)
+        self.assertEquals(self.checked, [self.i1, self.i2])
+        self.i3.signal_change(needs_save=False)
+        self.assertEquals(self.checked, [self.i1, self.i2])
+
+class CountTrackerTest(DatabaseTestCase):
+    def setUp(self):
+        DatabaseTestCase.setUp(self)
+        # auto-pending items don't count as available
+        self.feed.set_auto_download_mode(u'off')
+        self.feed2.set_auto_download_mode(u'off')
+
+    def check_counts(self):
+        for f in (self.feed, self.feed2):
+            self.assertEquals(f.num_available(), f.available_items.count() -
+                    f.auto_pending_items.count())
+            self.assertEquals(f.num_unwatched(), f.unwatched_items.count())
+            self.assertEquals(f.num_downloaded(), f.downloaded_items.count())
+            self.assertEquals(f.num_downloading(),
+                    f.downloading_items.count())
+        self.assert_(app.view_tracker_manager.check_count_trackers())
+
+    def test_item_changes(self):
+        self.check_counts()
+        self.assertEquals(self.feed.num_available(), 2)
+        self.i1.downloadedTime = datetime.now()
+        self.i1.signal_change()
+        self.assertEquals(self.feed.num_available(), 1)
+        self.check_counts()
+        i4 = item.Item(item.FeedParserValues({'title': u'item4'}),
+                feed_id=self.feed.id)
+        self.assertEquals(self.feed.num_available(), 2)
+        i4.remove()
+        self.assertEquals(self.feed.num_available(), 1)
+        self.check_counts()
+
+    def test_item_moves(self):
+        self.check_counts()
+        self.i2.feed_id = self.feed2.id
+        self.i2.signal_change()
+        self.assertEquals(self.feed.num_available(), 1)
+        self.assertEquals(self.feed2.num_available(), 2)
+        self.check_counts()
+
+    def test_feed_changes(self):
+        self.check_counts()
+        self.feed.mark_as_viewed()
+        self.assertEquals(self.feed.num_available(), 0)
+        self.assertEquals(self.feed2.num_available(), 1)
+        self.check_counts()
+
+    def test_consistency_check(self):
+        self.check_counts()
+        tracker = self.feed._count_tracker(self.feed.available_items)
+        tracker.ids[self.feed.id].clear()
+        self.assertEquals(self.feed.num_available(), 0)
+        self.assert_(not app.view_tracker_manager.check_count_trackers())
+        self.assertEquals(self.feed.num_available(), 2)
+
+    def test_folder_counts(self):
+        f = folder.ChannelFolder(u'folder')
+        self.feed.set_folder(f)
+        self.feed2.set_folder(f)
+        self.assertEquals(f.num_available(), 3)
+        self.assertEquals(f.num_unwatched(), 0)
+        # after the first call, the totals shouldn't need the folder's
+        # children
+        def folder_view(folder_id):
+            raise AssertionError("folder_view called")
+        old_folder_view = feed.Feed.folder_view
+        feed.Feed.folder_view = staticmethod(folder_view)
+        try:
+            self.i1.downloadedTime = datetime.now()
+            self.i1.signal_change()
+            self.assertEquals(f.num_available(), 2)
+            i4 = item.Item(item.FeedParserValues({'title': u'item4'}),
+                    feed_id=self.feed2.id)
+            self.assertEquals(f.num_available(), 3)
+            i4.remove()
+            self.assertEquals(f.num_available(), 2)
+        finally:
+            feed.Feed.folder_view = old_folder_view
+        self.assert_(app.view_tracker_manager.check_count_trackers())
+        self.feed2.set_folder(None)
+        self.assertEquals(f.num_available(), 1)
+        self.feed.mark_as_viewed()
+        self.assertEquals(f.num_available(), 0)
+        self.assert_(app.view_tracker_manager.check_count_trackers())
+
+    def test_folder_consistency_check(self):
+        f = folder.ChannelFolder(u'folder')
+        self.feed.set_folder(f)
+        self.assertEquals(f.num_available(), 2)
+        tracker = self.feed._count_tracker(self.feed.available_items)
+        tracker.group_totals[f.id] = 5
+        self.assertEquals(f.num_available(), 5)
+        self.assert_(not app.view_tracker_manager.check_count_trackers())
+        self.assertEquals(f.num_available(), 2)
+
 # class TestViewLimiter(database.ViewLimiter):
 #     def __init__(self, *feeds_to_include):
 #         self.feeds_to_include = feeds_to_include
@@ -216,6 +432,32 @@ class DDBObjectTestCase(MiroTestCase):
         testobj.bar = 2
         self.assertEquals(testobj.changed_attributes, set(['foo']))
 
+class CompactStorageTest(DatabaseTestCase):
+    def test_restored_object(self):
+        restored = self.reload_object(self.i1)
+        self.assertEquals(restored.feed_id, self.feed.id)
+        self.assertEquals(restored.creationTime, self.i1.creationTime)
+        self.assertEquals(restored.changed_attributes, set())
+        # tracked attributes and signal state shouldn't be in __dict__
+        self.assert_('feed_id' not in restored.__dict__)
+        self.assert_('signal_callbacks' not in restored.__dict__)
+
+    def test_changes_saved(self):
+        restored = self.reload_object(self.i1)
+        restored.title = u'new title'
+        self.assertEquals(restored.changed_attributes, set(['title']))
+        restored.signal_change()
+        self.assertEquals(restored.changed_attributes, set())
+        self.assertEquals(self.reload_object(restored).title, u'new title')
+
+    def test_lazy_signals(self):
+        restored = self.reload_object(self.i1)
+        removed = []
+        restored.connect('removed', lambda obj: removed.append(obj))
+        self.assert_('signal_callbacks' in restored.__dict__)
+        restored.remove()
+        self.assertEquals(removed, [restored])
+
 class LogFilter(logging.Filter):
     def __init__(self):
         self.allow = False
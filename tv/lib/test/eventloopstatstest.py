@@ -0,0 +1,88 @@
+import json
+import os
+
+from miro import eventloop
+from miro import eventloopstats
+from miro.test.framework import MiroTestCase, EventLoopTest
+
+class HistogramTest(MiroTestCase):
+    def test_stats(self):
+        histogram = eventloopstats.Histogram()
+        for i in range(95):
+            histogram.add(0.001)
+        for i in range(5):
+            histogram.add(1.0)
+        stats = histogram.get_stats()
+        self.assertEquals(stats['count'], 100)
+        self.assertAlmostEqual(stats['total'], 5.095)
+        self.assertEquals(stats['max'], 1.0)
+        # percentiles are rounded up to the bucket size
+        self.assert_(0.001 <= stats['p50'] < 0.002)
+        self.assert_(0.001 <= stats['p95'] < 0.002)
+        histogram.add(1.0)
+        self.assertEquals(histogram.percentile(95), 1.0)
+
+    def test_empty(self):
+        stats = eventloopstats.Histogram().get_stats()
+        self.assertEquals(stats['count'], 0)
+        self.assertEquals(stats['p50'], 0.0)
+
+class LoopStatsTest(MiroTestCase):
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        self.stats = eventloopstats.LoopStats()
+
+    def test_record(self):
+        self.stats.record_call('foo', 'idle', 10.0, 10.5)
+        self.stats.record_call('foo', 'idle', 11.0, 11.25)
+        self.stats.record_wait('idle', 0.1)
+        self.stats.record_iteration(10.0, 12.0)
+        stats = self.stats.get_stats()
+        self.assertEquals(stats['callbacks']['foo']['count'], 2)
+        self.assertEquals(stats['callbacks']['foo']['total'], 0.75)
+        self.assertEquals(stats['waits']['idle']['count'], 1)
+        self.assertEquals(stats['iterations']['max'], 2.0)
+        self.assert_('foo' in self.stats.format_report())
+
+    def test_name_limit(self):
+        self.stats.MAX_NAMES = 2
+        for name in ('foo', 'bar', 'baz', 'qux', 'foo'):
+            self.stats.record_call(name, 'idle', 0, 1)
+        callbacks = self.stats.get_stats()['callbacks']
+        self.assertEquals(sorted(callbacks.keys()),
+                          ['(other)', 'bar', 'foo'])
+        self.assertEquals(callbacks['(other)']['count'], 2)
+
+    def test_chrome_trace(self):
+        self.stats.MAX_TRACE_EVENTS = 2
+        self.stats.reset()
+        self.stats.record_call('foo', 'idle', 1.0, 1.5)
+        self.stats.record_call('bar', 'timeout', 2.0, 2.25)
+        self.stats.record_call('baz', 'timeout', 3.0, 3.5)
+        path = os.path.join(self.tempdir, 'trace.json')
+        self.stats.write_chrome_trace(path)
+        events = json.load(open(path))['traceEvents']
+        # only the most recent events are kept
+        self.assertEquals([e['name'] for e in events], ['bar', 'baz'])
+        self.assertEquals(events[0]['cat'], 'timeout')
+        self.assertEquals(events[0]['ph'], 'X')
+        self.assertEquals(events[0]['ts'], 2000000)
+        self.assertEquals(events[0]['dur'], 250000)
+
+class EventLoopStatsTest(EventLoopTest):
+    def setUp(self):
+        EventLoopTest.setUp(self)
+        eventloopstats.loop_stats.reset()
+
+    def test_event_loop_records(self):
+        eventloop.add_idle(lambda: None, "stats test idle")
+        eventloop.add_urgent_call(lambda: None, "stats test urgent")
+        eventloop.add_timeout(0.1, eventloop.shutdown, "stats test timeout")
+        self.runEventLoop()
+        stats = eventloopstats.loop_stats.get_stats()
+        self.assert_('idle (stats test idle)' in stats['callbacks'])
+        self.assert_('urgent (stats test urgent)' in stats['callbacks'])
+        self.assert_('timeout (stats test timeout)' in stats['callbacks'])
+        for queue in ('idle', 'urgent', 'timeout'):
+            self.assertEquals(stats['waits'][queue]['count'], 1)
+        self.assert_(stats['iterations']['count'] > 0)
@@ -2,11 +2,14 @@ import logging
 import os
 import unittest
 import pprint
+import time
 
+from miro import eventloop
+from miro import feedparserpool
 from miro import feedparserutil
 from miro.item import FeedParserValues
 from miro.plat import resources
-from miro.test.framework import MiroTestCase
+from miro.test.framework import MiroTestCase, EventLoopTest
 
 FPTESTINPUT = resources.path("testdata/feedparsertests/feeds")
 FPTESTOUTPUT = resources.path("testdata/feedparsertests/output")
@@ -69,6 +72,131 @@ class FeedParserDictTest(MiroTestCase):
         self.assertEqual(a.equal(d), False)
         self.assertEqual(d.equal(a), False)
 
+    def test_restore(self):
+        for inputfile in os.listdir(FPTESTINPUT):
+            parsed = _parse_feed(inputfile)
+            parsed.pop('bozo_exception', None)
+            normalized = feedparserutil.normalize_feedparser_dict(parsed)
+            restored = feedparserutil.restore_feedparser_dict(normalized)
+            self.assertEquals(
+                    feedparserutil.normalize_feedparser_dict(restored),
+                    normalized)
+            self.assertEquals(restored.channel.title, parsed.feed.title)
+            self.assertEquals(len(restored.entries), len(parsed.entries))
+
+class FeedParserPoolTest(EventLoopTest):
+    def setUp(self):
+        EventLoopTest.setUp(self)
+        self.results = []
+        self.pool = None
+
+    def tearDown(self):
+        if self.pool is not None:
+            self.pool.close()
+        EventLoopTest.tearDown(self)
+
+    def callback(self, parsed):
+        self.results.append(parsed)
+        if len(self.results) == self.expected_results:
+            eventloop.shutdown()
+
+    def errback(self, exc):
+        self.results.append(exc)
+        eventloop.shutdown()
+
+    def check_results(self):
+        for parsed in self.results:
+            self.check_results_for(parsed)
+
+    def check_results_for(self, parsed):
+        expected = _parse_feed("usvideo.xml")
+        self.assert_(isinstance(parsed, feedparserutil.FeedParserDict))
+        self.assertEquals(parsed.feed.title, expected.feed.title)
+        self.assertEquals([e.title for e in parsed.entries],
+                          [e.title for e in expected.entries])
+
+    def test_pool(self):
+        if not feedparserpool.can_use_processes():
+            return
+        html = open(os.path.join(FPTESTINPUT, "usvideo.xml")).read()
+        # replace the worker after each parse
+        self.pool = feedparserpool.FeedParserPool(1, 1)
+        self.expected_results = 2
+        self.pool.parse(self.callback, self.errback, html, "usvideo 1")
+        self.pool.parse(self.callback, self.errback, html, "usvideo 2")
+        self.runEventLoop()
+        self.assertEquals(len(self.results), 2)
+        self.check_results()
+        self.assertEquals(self.pool.pending, {})
+
+    def test_pool_normalize_error(self):
+        if not feedparserpool.can_use_processes():
+            return
+        html = open(os.path.join(FPTESTINPUT, "usvideo.xml")).read()
+        # break normalizing in the worker process
+        def raise_error(value):
+            raise ValueError("can't normalize")
+        old_normalize = feedparserutil.normalize_feedparser_dict
+        feedparserutil.normalize_feedparser_dict = raise_error
+        try:
+            self.pool = feedparserpool.FeedParserPool(1, 0)
+        finally:
+            feedparserutil.normalize_feedparser_dict = old_normalize
+        # the feed should get parsed in the cpu lane instead
+        self.expected_results = 1
+        self.pool.parse(self.callback, self.errback, html, "usvideo")
+        self.runEventLoop()
+        self.check_results()
+        self.assertEquals(self.pool.pending, {})
+
+    def test_timeout(self):
+        if not feedparserpool.can_use_processes():
+            return
+        html = open(os.path.join(FPTESTINPUT, "usvideo.xml")).read()
+        # make the worker process get stuck on one feed
+        old_parse = feedparserutil.parse
+        def parse(html):
+            if html == 'hang':
+                time.sleep(1000)
+            return old_parse(html)
+        feedparserutil.parse = parse
+        try:
+            self.pool = feedparserpool.FeedParserPool(1, 0)
+        finally:
+            feedparserutil.parse = old_parse
+        in_thread = []
+        old_parse_in_thread = feedparserpool._parse_in_thread
+        def parse_in_thread(callback, errback, html, name):
+            in_thread.append(name)
+            old_parse_in_thread(callback, errback, html, name)
+        feedparserpool._parse_in_thread = parse_in_thread
+        try:
+            self.pool.PARSE_TIMEOUT = 0.5
+            # the second feed is stuck behind the first one, so both should
+            # get parsed in the cpu lane
+            self.expected_results = 2
+            self.pool.parse(self.callback, self.errback, 'hang', "hang")
+            self.pool.parse(self.callback, self.errback, html, "usvideo")
+            self.runEventLoop()
+            self.assertSameSet(in_thread, ["hang", "usvideo"])
+            self.assertEquals(self.pool.pending, {})
+            # the pool parent should have started fresh workers
+            self.expected_results = 3
+            self.pool.parse(self.callback, self.errback, html, "usvideo 2")
+            self.runEventLoop()
+            self.assertSameSet(in_thread, ["hang", "usvideo"])
+            self.assertEquals(self.pool.pending, {})
+            self.check_results_for(self.results[-1])
+        finally:
+            feedparserpool._parse_in_thread = old_parse_in_thread
+
+    def test_thread_fallback(self):
+        html = open(os.path.join(FPTESTINPUT, "usvideo.xml")).read()
+        self.expected_results = 1
+        feedparserpool.parse(self.callback, self.errback, html, "usvideo")
+        self.runEventLoop()
+        self.check_results()
+
 class FeedParserTest(MiroTestCase):
     def test_ooze(self):
         feedparserutil.parse(os.path.join(FPTESTINPUT, "ooze.rss"))
@@ -10,7 +10,8 @@ from miro import database
 from miro import storedatabase
 from miro import feedparserutil
 from miro.plat import resources
-from miro.item import Item
+from miro.item import Item, FileItem
+from miro.plat.utils import make_url_safe
 from miro.feed import validate_feed_url, normalize_feed_url, Feed
 
 from miro.test.framework import MiroTestCase, EventLoopTest
@@ -514,3 +515,37 @@ class FeedParserAttributesTestCase(FeedTestCase):
 
 if __name__ == "__main__":
     unittest.main()
+
+class DirectoryFeedTest(FeedTestCase):
+    def setUp(self):
+        FeedTestCase.setUp(self)
+        self.directory = os.path.join(self.tempdir, 'watched')
+        os.mkdir(self.directory)
+        self.media_path = os.path.join(self.directory, 'movie.mp4')
+        open(self.media_path, 'wb').close()
+        self.feed = Feed(u'dtv:directoryfeed:%s' %
+                         make_url_safe(self.directory))
+        self.manual_feed = Feed(u'dtv:manualFeed')
+
+    def test_file_added_during_scan(self):
+        # The known files query and the directory scan run in the
+        # background.  An item that gets the filename while they run
+        # shouldn't be duplicated.
+        self.feed.actualFeed.update()
+        FileItem(self.media_path, feed_id=self.manual_feed.id)
+        self.process_idles()
+        self.processThreads()
+        self.process_idles()
+        self.assert_(not self.feed.actualFeed.updating)
+        self.assertEquals(self.feed.items.count(), 0)
+        self.assertEquals(
+            FileItem.make_view('filename=?', (self.media_path,)).count(), 1)
+
+    def test_scan(self):
+        self.feed.actualFeed.update()
+        self.process_idles()
+        self.processThreads()
+        self.process_idles()
+        self.assert_(not self.feed.actualFeed.updating)
+        self.assertEquals([i.get_filename() for i in self.feed.items],
+                          [os.path.normcase(self.media_path)])
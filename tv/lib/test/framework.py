@@ -196,6 +196,7 @@ class MiroTestCase(unittest.TestCase):
         self.stop_http_server()
 
         # Remove any leftover database
+        self.stop_item_info_cache_writer()
         app.db.close()
         app.db = None
         database.setup_managers()
@@ -252,8 +253,10 @@ class MiroTestCase(unittest.TestCase):
             self.httpserver = None
 
     def setup_new_item_info_cache(self):
+        self.stop_item_info_cache_writer()
         app.item_info_cache = iteminfocache.ItemInfoCache()
         app.item_info_cache.load()
+        app.item_fts_index = None
 
     def reload_database(self, path=':memory:', schema_version=None,
                         object_schemas=None, upgrade=True):
@@ -276,7 +279,14 @@ class MiroTestCase(unittest.TestCase):
     def allow_db_load_errors(self, allow):
         app.db.raise_load_errors = self.raise_db_load_errors = not allow
 
+    def stop_item_info_cache_writer(self):
+        # make sure the old cache isn't still writing to the database
+        if app.db and app.item_info_cache is not None:
+            app.db.finish_transaction()
+            app.item_info_cache.stop_writer()
+
     def shutdown_database(self):
+        self.stop_item_info_cache_writer()
         if app.db:
             try:
                 app.db.close()
@@ -370,7 +380,7 @@ class EventLoopTest(MiroTestCase):
 
     def processThreads(self):
         eventloop._eventloop.threadpool.init_threads()
-        while not eventloop._eventloop.threadpool.queue.empty():
+        while not eventloop._eventloop.threadpool.queues_empty():
             sleep(0.05)
         eventloop._eventloop.threadpool.close_threads()
 
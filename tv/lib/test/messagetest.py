@@ -1,5 +1,7 @@
-import cPickle
 import functools
+import itertools
+import os
+from random import Random
 
 from miro import app
 from miro import prefs
@@ -14,6 +16,7 @@ from miro.tabs import TabOrder
 from miro import itemsource
 from miro import messages
 from miro import messagehandler
+from miro import util
 
 from miro.test.framework import MiroTestCase, EventLoopTest, uses_httpclient
 
@@ -462,6 +465,70 @@ class FeedItemTrackTest(TrackerTest):
         self.assertEquals(len(self.test_handler.messages), 7)
         self.check_changed_message(6, added=[self.items[1]])
 
+    def test_search_refinement(self):
+        # "m" matches both items, typing more letters narrows the results
+        # down.  Those searches should only check the items that matched
+        # the last search.
+        source = self.backend_message_handler.item_trackers[
+                ('feed', self.feed.id)].trackers[0]
+        messages.SetTrackItemsSearch('feed', self.feed.id,
+                'm').send_to_backend()
+        self.runUrgentCalls()
+        self.check_message_count(1)
+        source.fetch_all = lambda: self.fail("fetch_all() called")
+        messages.SetTrackItemsSearch('feed', self.feed.id,
+                'my fir').send_to_backend()
+        self.runUrgentCalls()
+        self.check_changed_message(1, removed=[self.items[1]])
+        # items that change still get checked against the new search
+        self.items[0].set_title(u'my second item')
+        self.runUrgentCalls()
+        self.check_changed_message(2, removed=[self.items[0]])
+        self.items[0].set_title(u'my first item')
+        self.runUrgentCalls()
+        self.check_changed_message(3, added=[self.items[0]])
+        messages.SetTrackItemsSearch('feed', self.feed.id,
+                'my first -second').send_to_backend()
+        self.runUrgentCalls()
+        self.check_message_count(4)
+        # broadening the search needs to look at all the items again
+        del source.fetch_all
+        messages.SetTrackItemsSearch('feed', self.feed.id,
+                'my').send_to_backend()
+        self.runUrgentCalls()
+        self.check_changed_message(4, added=[self.items[1]])
+
+    def test_ranked_items(self):
+        self.make_item(u'http://example.com/3', u'item item item')
+        self.runUrgentCalls()
+        messages.QueryRankedItems('feed', self.feed.id, 'item',
+                                  page_size=2).send_to_backend()
+        self.runUrgentCalls()
+        message = self.test_handler.messages[-1]
+        self.assertEquals(type(message), messages.RankedItemList)
+        self.assertEquals(message.page, 0)
+        self.assert_(message.more)
+        self.assertEquals(message.items[0].id, self.items[2].id)
+        self.assertEquals(len(message.items), 2)
+        first_page_ids = set(info.id for info in message.items)
+        # the next page comes from the same ranking
+        item_tracker = self.backend_message_handler.item_trackers[
+                ('feed', self.feed.id)]
+        ranked = item_tracker.ranked_search('item', 2)
+        messages.QueryRankedItems('feed', self.feed.id, 'item', page=1,
+                                  page_size=2).send_to_backend()
+        self.runUrgentCalls()
+        self.assert_(item_tracker.ranked_search('item', 2) is ranked)
+        message = self.test_handler.messages[-1]
+        self.assertEquals(message.page, 1)
+        self.assert_(not message.more)
+        self.assertEquals(len(message.items), 1)
+        self.assert_(message.items[0].id not in first_page_ids)
+        # changing the list throws the ranking away
+        self.items[0].set_title(u'item')
+        self.runUrgentCalls()
+        self.assert_(item_tracker.ranked_search('item', 2) is not ranked)
+
     def test_initial_search(self):
         # add a search that only matches our first item
         messages.StopTrackingItems('feed', self.feed.id).send_to_backend()
@@ -592,6 +659,154 @@ class ItemInfoCacheTest(FeedItemTrackTest):
         app.item_info_cache.save()
         self.setup_new_item_info_cache()
 
+class ItemInfoUpdateTest(MiroTestCase):
+    # Test that ItemInfoCache only recalculates the attributes that depend on
+    # what changed.
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        self.feed = Feed(u'dtv:manualFeed')
+        entry = _build_entry(u'http://example.com/', 'video/x-unknown',
+                {'title': u'my item', 'description': u'<b>some</b> text'})
+        self.item = Item(FeedParserValues(entry), feed_id=self.feed.id)
+
+    def get_info(self):
+        return app.item_info_cache.id_to_info[self.item.id]
+
+    def check_info(self):
+        real_info = itemsource.DatabaseItemSource._item_info_for(self.item)
+        self.assertEquals(self.get_info().__dict__, real_info.__dict__)
+
+    def test_simple_change(self):
+        old_info = self.get_info()
+        self.item.resumeTime = 10
+        self.item.signal_change()
+        new_info = self.get_info()
+        self.check_info()
+        # the old info shouldn't be touched
+        self.assertEquals(old_info.resume_time, 0)
+        self.assertEquals(new_info.resume_time, 10)
+        # derived attributes shouldn't be recalculated
+        self.assert_(new_info.description_stripped is
+                     old_info.description_stripped)
+        self.assert_(new_info.search_ngrams is old_info.search_ngrams)
+
+    def test_title_change(self):
+        old_info = self.get_info()
+        self.item.title = u'new title'
+        self.item.signal_change()
+        new_info = self.get_info()
+        self.check_info()
+        self.assertEquals(new_info.name, u'new title')
+        self.assertNotEquals(new_info.search_ngrams, old_info.search_ngrams)
+        self.assert_(new_info.description_stripped is
+                     old_info.description_stripped)
+
+    def test_description_change(self):
+        old_info = self.get_info()
+        self.item.description = u'<i>other</i> stuff'
+        self.item.signal_change()
+        self.check_info()
+        self.assertNotEquals(self.get_info().description_stripped,
+                             old_info.description_stripped)
+
+    def test_volatile_change(self):
+        # Changing something other than the item's columns should still
+        # update the info.
+        self.item.expired = True
+        self.item.signal_change()
+        self.item.signal_change(needs_save=False)
+        self.check_info()
+
+    def test_unknown_column(self):
+        self.item.linkNumber = 5
+        self.item.entry_description = u'new description'
+        self.item.signal_change()
+        self.check_info()
+
+class ItemInfoCacheWriterTest(MiroTestCase):
+    # Test saving the item info cache from the writer thread
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        # The writer thread needs an on-disk database
+        path = self.make_temp_path(extension=".db")
+        os.unlink(path)
+        self.reload_database(path)
+        self.assert_(app.db.supports_worker_connections())
+        self.setup_new_item_info_cache()
+        self.feed = Feed(u'dtv:manualFeed')
+        self.items = []
+        self.counter = itertools.count()
+
+    def make_item(self):
+        url = u'http://example.com/%d' % self.counter.next()
+        entry = _build_entry(url, 'video/x-unknown')
+        self.items.append(Item(FeedParserValues(entry), feed_id=self.feed.id))
+
+    def check_saved_infos(self):
+        app.db.cursor.execute("SELECT id, pickle FROM item_info_cache")
+        rows = app.db.cursor.fetchall()
+        self.assertSameSet([row[0] for row in rows],
+                           [item.id for item in self.items])
+        for id_, blob in rows:
+            saved_info = app.item_info_cache._blob_to_info(blob)
+            current_info = app.item_info_cache.id_to_info[id_]
+            self.assert_(not saved_info.differs_from(current_info))
+        # the cache version should still be valid
+        self.assertEquals(app.db.get_variable(
+            app.item_info_cache.VERSION_KEY), app.item_info_cache.version())
+
+    def test_stress(self):
+        # make lots of changes, saving between them without waiting for the
+        # writer thread to catch up
+        random = Random(1234)
+        for i in xrange(20):
+            self.make_item()
+        for i in xrange(200):
+            choice = random.randrange(4)
+            if choice == 0 or len(self.items) < 5:
+                self.make_item()
+            elif choice == 1:
+                self.items.pop(random.randrange(len(self.items))).remove()
+            else:
+                item = random.choice(self.items)
+                item.set_title(u'title %d' % self.counter.next())
+            app.db.finish_transaction()
+            if random.randrange(3) == 0:
+                app.item_info_cache.save()
+        app.item_info_cache.flush()
+        self.check_saved_infos()
+
+    def test_write_error(self):
+        for i in xrange(5):
+            self.make_item()
+        app.db.finish_transaction()
+        def raise_error(info):
+            raise TypeError("can't pickle")
+        app.item_info_cache._info_to_blob = raise_error
+        # the writer should handle errors that don't come from sqlite too
+        app.item_info_cache.flush()
+        # we lost changes, so the saved data shouldn't be used next time
+        self.assertRaises(KeyError, app.db.get_variable,
+                          app.item_info_cache.VERSION_KEY)
+
+    def test_shutdown_flush(self):
+        for i in xrange(10):
+            self.make_item()
+        app.item_info_cache.save()
+        self.items[0].set_title(u'new title')
+        self.items.pop().remove()
+        app.db.finish_transaction()
+        # shutdown() should write out the last changes, even though we never
+        # called save() for them
+        app.item_info_cache.shutdown()
+        self.check_saved_infos()
+        # we should be able to do a quick load with the saved data
+        old_infos = app.item_info_cache.id_to_info
+        self.setup_new_item_info_cache()
+        for id_, info in old_infos.items():
+            self.assert_(not app.item_info_cache.get_info(id_).differs_from(
+                info))
+
 class ItemInfoCacheErrorTest(MiroTestCase):
     # Test errors when loading the Item info cache
     def setUp(self):
@@ -629,10 +844,43 @@ class ItemInfoCacheErrorTest(MiroTestCase):
         for item in self.items:
             app.db.cursor.execute("SELECT pickle FROM item_info_cache "
                     "WHERE id=%s" % item.id)
-            db_info = cPickle.loads(str(app.db.cursor.fetchone()[0]))
+            db_info = app.item_info_cache._blob_to_info(
+                    app.db.cursor.fetchone()[0])
             real_info = itemsource.DatabaseItemSource._item_info_for(item)
+            self.check_derived_attributes(db_info, real_info)
             self.assertEquals(db_info.__dict__, real_info.__dict__)
 
+    def check_derived_attributes(self, cache_info, real_info):
+        # description_stripped and search_ngrams aren't stored in the cache,
+        # they should get calculated when they're first used
+        self.assert_('description_stripped' not in cache_info.__dict__)
+        self.assert_('search_ngrams' not in cache_info.__dict__)
+        self.assertEquals(cache_info.description_stripped,
+                          real_info.description_stripped)
+        self.assertEquals(cache_info.search_ngrams, real_info.search_ngrams)
+
+    def test_quick_load(self):
+        app.db.finish_transaction()
+        app.item_info_cache.save()
+        self.setup_new_item_info_cache()
+        for item in self.items:
+            cache_info = app.item_info_cache.id_to_info[item.id]
+            real_info = itemsource.DatabaseItemSource._item_info_for(item)
+            self.check_derived_attributes(cache_info, real_info)
+            self.assertEquals(cache_info.__dict__, real_info.__dict__)
+
+    def test_interned_strings(self):
+        app.db.finish_transaction()
+        app.item_info_cache.save()
+        self.setup_new_item_info_cache()
+        info1, info2 = [app.item_info_cache.id_to_info[item.id]
+                        for item in self.items]
+        self.assertNotEquals(info1.mime_type, None)
+        for name in itemsource.INTERNED_FIELDS:
+            self.assert_(getattr(info1, name) is getattr(info2, name))
+        self.assert_(info1.mime_type is
+                     util.intern_string(u'video/x-unknown'))
+
     def test_failsafe_load_item_change(self):
         # Test Items calling signal_change() when we do a failsafe load
 
@@ -1,12 +1,27 @@
+import cPickle
 import shutil
 import os
 import pstats
 import cProfile
+import datetime
+import itertools
+import random
+import sys
+import time
 
 from miro import app
+from miro import database
+from miro import downloader
+from miro import ftsindex
+from miro import iteminfocache
+from miro import itemsource
 from miro import messagehandler
 from miro import messages
 from miro import models
+from miro import schema
+from miro import search
+from miro.item import FeedParserValues
+from miro.singleclick import _build_entry
 from miro.test.framework import EventLoopTest
 from miro.test import messagetest
 from miro.plat.utils import FilenameType
@@ -66,3 +81,310 @@ class PerformanceTest(EventLoopTest):
     def track_item_count(self):
         messages.TrackNewVideoCount().send_to_backend()
         self.runUrgentCalls()
+
+class ContainerRestorePerformanceTest(EventLoopTest):
+    """Compare restoring RemoteDownloaders whose status column is in the
+    binary container format vs. the old repr() format.
+    """
+    DOWNLOADER_COUNT = 10000
+
+    def setUp(self):
+        EventLoopTest.setUp(self)
+        self.save_path = FilenameType(self.make_temp_path(extension=".db"))
+        if os.path.exists(self.save_path):
+            os.unlink(self.save_path)
+        self.reload_database(self.save_path)
+        status = {
+            'state': u'finished',
+            'filename': FilenameType('/home/ben/movie.mpeg'),
+            'shortFilename': FilenameType('movie.mpeg'),
+            'currentSize': 123456789,
+            'totalSize': 123456789,
+            'startTime': 1234567890.5,
+            'endTime': 1234569999.5,
+            'retryTime': None,
+            'infohash': None,
+            'activity': None,
+            'reasonFailed': u'No Error',
+            'channelName': None,
+            'dlerType': u'HTTP',
+            'rate': 0,
+            'upRate': 0,
+            'eta': 0,
+            'uploaded': 0,
+            'url': u'http://example.com/movie.mpeg',
+            'lastUpdated': datetime.datetime(2011, 1, 1),
+        }
+        status_column = schema.SchemaStatusContainer()
+        self.binary_rows = []
+        self.repr_rows = []
+        for i in xrange(self.DOWNLOADER_COUNT):
+            id_ = 100000 + i
+            url = u'http://example.com/%d/movie.mpeg' % i
+            status['url'] = url
+            row = (id_, url, url, u'dlid%d' % i, u'video/mpeg', u'finished')
+            binary_status = app.db._converter.to_sql(None, 'status',
+                    status_column, status)
+            # this is how older versions stored the status dict
+            repr_status = status.copy()
+            for key in schema.SchemaStatusContainer.filename_fields:
+                if repr_status.get(key) is not None:
+                    repr_status[key] = repr_status[key].decode('utf-8')
+            self.binary_rows.append(row + (binary_status,))
+            self.repr_rows.append(row + (repr(repr_status),))
+        database.update_last_id()
+
+    def _insert_rows(self, rows):
+        app.db.cursor.execute("DELETE FROM remote_downloader")
+        app.db.cursor.executemany("INSERT INTO remote_downloader "
+                "(id, url, origURL, dlid, contentType, state, status, "
+                "manualUpload, child_deleted) VALUES (?, ?, ?, ?, ?, ?, ?, "
+                "0, 0)", rows)
+        self.reload_database(self.save_path)
+
+    def _time_restore(self, rows):
+        self._insert_rows(rows)
+        start = time.time()
+        downloaders = list(downloader.RemoteDownloader.make_view())
+        restore_time = time.time() - start
+        self.assertEquals(len(downloaders), self.DOWNLOADER_COUNT)
+        start = time.time()
+        app.db.finish_transaction()
+        return restore_time, time.time() - start
+
+    def test_restore_status(self):
+        repr_time, migrate_time = self._time_restore(self.repr_rows)
+        binary_time, flush_time = self._time_restore(self.binary_rows)
+        print
+        print 'restored %d downloaders' % self.DOWNLOADER_COUNT
+        print 'repr:   %0.3fs (%0.0f rows/s), %0.3fs to migrate' % (
+                repr_time, self.DOWNLOADER_COUNT / repr_time, migrate_time)
+        print 'binary: %0.3fs (%0.0f rows/s)' % (binary_time,
+                self.DOWNLOADER_COUNT / binary_time)
+
+class ItemInfoCacheLoadPerformanceTest(EventLoopTest):
+    """Compare loading the item info cache in the compact record format
+    vs. the old format, which pickled each ItemInfo object.
+    """
+    ITEM_COUNT = 10000
+
+    def setUp(self):
+        EventLoopTest.setUp(self)
+        self.save_path = FilenameType(self.make_temp_path(extension=".db"))
+        if os.path.exists(self.save_path):
+            os.unlink(self.save_path)
+        self.reload_database(self.save_path)
+        self.setup_new_item_info_cache()
+        feed = models.Feed(u'dtv:manualFeed')
+        app.bulk_sql_manager.start()
+        for i in xrange(self.ITEM_COUNT):
+            entry = _build_entry(u'http://example.com/%d.mpeg' % i,
+                    'video/mpeg', {
+                        'title': u'Item number %d' % i,
+                        'description': (u'<p>This is the <b>description</b> '
+                            'for item %d, with a <a href="http://example.com/'
+                            '">link</a></p>' % i),
+                    })
+            models.Item(FeedParserValues(entry), feed_id=feed.id)
+        app.bulk_sql_manager.finish()
+        app.db.finish_transaction()
+        app.item_info_cache.flush()
+        self.infos = app.item_info_cache.all_infos()
+
+    def test_load(self):
+        old_blobs = [cPickle.dumps(info) for info in self.infos]
+        start = time.time()
+        for blob in old_blobs:
+            cPickle.loads(blob)
+        old_time = time.time() - start
+
+        app.db.cursor.execute("SELECT SUM(LENGTH(pickle)) "
+                "FROM item_info_cache")
+        new_size = app.db.cursor.fetchone()[0]
+        cache = iteminfocache.ItemInfoCache()
+        start = time.time()
+        cache.load()
+        new_time = time.time() - start
+        self.assertEquals(len(cache.id_to_info), self.ITEM_COUNT)
+        print
+        print 'loaded %d ItemInfos' % self.ITEM_COUNT
+        print 'pickled ItemInfos: %0.3fs (unpickling only), %d bytes' % (
+                old_time, sum(len(blob) for blob in old_blobs))
+        print 'compact records:   %0.3fs (including SELECT), %d bytes' % (
+                new_time, new_size)
+
+class _ListItemSource(itemsource.ItemSource):
+    def __init__(self, infos):
+        itemsource.ItemSource.__init__(self)
+        self.infos = infos
+        self.id_to_info = dict((info.id, info) for info in infos)
+
+    def fetch_all(self):
+        return self.infos
+
+    def fetch_current(self):
+        # like DatabaseItemSource, look up current_ids in the item info
+        # cache rather than checking all items
+        return [self.id_to_info[id_] for id_ in self.current_ids]
+
+class _UnrefinedSearchLimiter(messagehandler.ItemSearchLimiter):
+    def refines(self, other):
+        return False
+
+def _limiter_class_for_index(index, refine=True):
+    """Make an ItemSearchLimiter class that searches index."""
+    if refine:
+        base = messagehandler.ItemSearchLimiter
+    else:
+        base = _UnrefinedSearchLimiter
+    class IndexSearchLimiter(base):
+        def __init__(self, query):
+            base.__init__(self, query, use_index=True)
+
+        def _search_index(self):
+            return index
+    return IndexSearchLimiter
+
+class SearchKeystrokePerformanceTest(EventLoopTest):
+    """Time how long it takes to update the search results after each
+    keystroke, with and without the refinement cache.
+
+    We time matching each ItemInfo, the n-gram index and the FTS index.  For
+    the indexes, refining only checks the ids that matched the last query.
+    """
+    ITEM_COUNT = 100000
+    WORDS = [u'democracy', u'demolition', u'video', u'podcast', u'news',
+             u'music', u'episode', u'interview', u'weekly', u'show']
+    SEARCH = 'democracy now'
+
+    def setUp(self):
+        EventLoopTest.setUp(self)
+        feed = models.Feed(u'dtv:manualFeed')
+        entry = _build_entry(u'http://example.com/1.mpeg', 'video/mpeg',
+                {'title': u'template'})
+        template = itemsource.DatabaseItemSource._item_info_for(
+                models.Item(FeedParserValues(entry), feed_id=feed.id))
+        rand = random.Random(1)
+        self.infos = []
+        for i in xrange(self.ITEM_COUNT):
+            name = u' '.join(rand.sample(self.WORDS, 3))
+            if i % 10 == 0:
+                name += u' now'
+            self.infos.append(template.updated({'id': i, 'name': name}))
+
+    def _time_keystrokes(self, limiter_class):
+        source = _ListItemSource(self.infos)
+        times = []
+        for i in xrange(1, len(self.SEARCH) + 1):
+            start = time.time()
+            source.set_limiter(limiter_class(self.SEARCH[:i]))
+            times.append(time.time() - start)
+        return times, len(source.current_ids)
+
+    def _make_fts_index(self):
+        index = ftsindex.ItemFTSIndex()
+        index.setup()
+        app.db.cursor.execute("DELETE FROM item_fts")
+        app.db.cursor.executemany("INSERT INTO item_fts(docid, search_text) "
+                                  "VALUES (?, ?)",
+                                  [(info.id, search.calc_search_text(info))
+                                   for info in self.infos])
+        return index
+
+    def _compare_keystrokes(self, label, full_class, refined_class):
+        full_times, full_count = self._time_keystrokes(full_class)
+        refined_times, refined_count = self._time_keystrokes(refined_class)
+        self.assertEquals(full_count, refined_count)
+        print '%s:' % label
+        print '  full scan: %0.1fms per keystroke, %0.1fms max' % (
+                sum(full_times) * 1000 / len(full_times),
+                max(full_times) * 1000)
+        print '  refined:   %0.1fms per keystroke, %0.1fms max' % (
+                sum(refined_times) * 1000 / len(refined_times),
+                max(refined_times) * 1000)
+
+    def test_keystrokes(self):
+        print
+        print 'typed %r with %d items' % (self.SEARCH, self.ITEM_COUNT)
+        self._compare_keystrokes('item_matches()', _UnrefinedSearchLimiter,
+                messagehandler.ItemSearchLimiter)
+        ngram_index = search.NGramIndex(self.infos)
+        self._compare_keystrokes('n-gram index',
+                _limiter_class_for_index(ngram_index, refine=False),
+                _limiter_class_for_index(ngram_index))
+        if ftsindex.ItemFTSIndex.is_supported(app.db.cursor):
+            fts_index = self._make_fts_index()
+            self._compare_keystrokes('FTS index',
+                    _limiter_class_for_index(fts_index, refine=False),
+                    _limiter_class_for_index(fts_index))
+
+class ItemInfoInterningPerformanceTest(EventLoopTest):
+    """Measure the memory used by repeated strings in ItemInfos loaded from
+    the item info cache, with and without interning.
+    """
+    ITEM_COUNT = 100000
+    FEED_COUNT = 500
+
+    def setUp(self):
+        EventLoopTest.setUp(self)
+        feed = models.Feed(u'dtv:manualFeed')
+        entry = _build_entry(u'http://example.com/1.mpeg', 'video/mpeg',
+                {'title': u'template'})
+        template = itemsource.DatabaseItemSource._item_info_for(
+                models.Item(FeedParserValues(entry), feed_id=feed.id))
+        genres = [u'Genre %d' % i for i in xrange(20)]
+        cache = app.item_info_cache
+        self.blobs = []
+        for i in xrange(self.ITEM_COUNT):
+            feed_number = i % self.FEED_COUNT
+            info = template.updated({
+                'id': i,
+                'feed_name': u'Feed %d' % feed_number,
+                'feed_url': u'http://example.com/feeds/%d' % feed_number,
+                'file_format': u'.mp4',
+                'file_type': u'video',
+                'mime_type': u'video/mp4',
+                'license': u'http://creativecommons.org/licenses/by/3.0/',
+                'artist': u'Artist %d' % (i % 2000),
+                'album': u'Album %d' % (i % 5000),
+                'genre': genres[i % len(genres)],
+                })
+            # the blobs are what _quick_load() reads from the database
+            self.blobs.append(cache._info_to_blob(info))
+
+    def _string_memory(self, infos):
+        seen = set()
+        total = 0
+        for info in infos:
+            for name in itemsource.INTERNED_FIELDS:
+                value = getattr(info, name)
+                if value is not None and id(value) not in seen:
+                    seen.add(id(value))
+                    total += sys.getsizeof(value)
+        return total, len(seen)
+
+    def test_memory(self):
+        cache = app.item_info_cache
+        fields = cache.RECORD_FIELDS
+        start = time.time()
+        plain_infos = []
+        for blob in self.blobs:
+            info = messages.ItemInfo.__new__(messages.ItemInfo)
+            info.__dict__ = dict(itertools.izip(fields,
+                                                cPickle.loads(str(blob))))
+            plain_infos.append(info)
+        plain_time = time.time() - start
+        plain_bytes, plain_count = self._string_memory(plain_infos)
+        del plain_infos
+
+        start = time.time()
+        interned_infos = [cache._blob_to_info(blob) for blob in self.blobs]
+        interned_time = time.time() - start
+        interned_bytes, interned_count = self._string_memory(interned_infos)
+        print
+        print 'loaded %d ItemInfos from %d feeds' % (self.ITEM_COUNT,
+                self.FEED_COUNT)
+        print 'not interned: %d strings, %d bytes, %0.3fs' % (plain_count,
+                plain_bytes, plain_time)
+        print 'interned:     %d strings, %d bytes, %0.3fs' % (interned_count,
+                interned_bytes, interned_time)
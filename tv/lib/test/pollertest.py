@@ -0,0 +1,151 @@
+import select
+import signal
+import unittest
+
+from miro import eventloop
+from miro import poller
+from miro import util
+from miro.test.framework import EventLoopTest
+
+class PollerTestBase(object):
+    def make_poller(self):
+        raise NotImplementedError()
+
+    def setUp(self):
+        self.poller = self.make_poller()
+        self.sender, self.receiver = util.make_dummy_socket_pair()
+
+    def tearDown(self):
+        self.poller.close()
+        self.sender.close()
+        self.receiver.close()
+
+    def test_read(self):
+        fd = self.receiver.fileno()
+        self.poller.register_read(fd)
+        self.assertEquals(self.poller.poll(0), ([], []))
+        self.sender.send("a")
+        self.assertEquals(self.poller.poll(1), ([fd], []))
+        # registering twice shouldn't break anything
+        self.poller.register_read(fd)
+        self.assertEquals(self.poller.poll(1), ([fd], []))
+        self.poller.unregister_read(fd)
+        self.assertEquals(self.poller.poll(0), ([], []))
+
+    def test_write(self):
+        fd = self.sender.fileno()
+        self.poller.register_write(fd)
+        self.assertEquals(self.poller.poll(1), ([], [fd]))
+        # reading as well as writing
+        self.poller.register_read(fd)
+        self.assertEquals(self.poller.poll(1), ([], [fd]))
+        self.receiver.send("a")
+        self.assertEquals(self.poller.poll(1), ([fd], [fd]))
+        self.poller.unregister_write(fd)
+        self.assertEquals(self.poller.poll(1), ([fd], []))
+
+    def test_interrupted(self):
+        if not hasattr(signal, 'setitimer'):
+            return
+        old_handler = signal.signal(signal.SIGALRM, lambda *args: None)
+        try:
+            signal.setitimer(signal.ITIMER_REAL, 0.05)
+            self.assertEquals(self.poller.poll(5), ([], []))
+            self.assert_(self.poller.interrupted)
+        finally:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+            signal.signal(signal.SIGALRM, old_handler)
+        self.assertEquals(self.poller.poll(0), ([], []))
+        self.assert_(not self.poller.interrupted)
+
+class StatelessPollerTestBase(PollerTestBase):
+    def test_set_fds(self):
+        read_fd = self.receiver.fileno()
+        write_fd = self.sender.fileno()
+        self.sender.send("a")
+        self.poller.set_fds([read_fd], [write_fd])
+        self.assertEquals(self.poller.poll(1), ([read_fd], [write_fd]))
+        self.poller.set_fds([read_fd], [])
+        self.assertEquals(self.poller.poll(1), ([read_fd], []))
+        self.poller.set_fds([], [])
+        self.assertEquals(self.poller.poll(0), ([], []))
+
+    def test_set_fds_fd_reused(self):
+        # If a socket gets closed and a new one gets the same fd, set_fds()
+        # sees the same list of fds, but still needs to watch the new socket
+        fd = self.receiver.fileno()
+        self.poller.set_fds([fd], [])
+        self.assertEquals(self.poller.poll(0), ([], []))
+        self.receiver.close()
+        self.sender.close()
+        self.sender, self.receiver = util.make_dummy_socket_pair()
+        if self.receiver.fileno() != fd:
+            return
+        self.sender.send("a")
+        self.poller.set_fds([fd], [])
+        self.assertEquals(self.poller.poll(1), ([fd], []))
+
+class SelectPollerTest(StatelessPollerTestBase, unittest.TestCase):
+    def make_poller(self):
+        return poller.SelectPoller()
+
+if hasattr(select, 'poll'):
+    class PollPollerTest(StatelessPollerTestBase, unittest.TestCase):
+        def make_poller(self):
+            return poller.PollPoller()
+
+if hasattr(select, 'epoll'):
+    class EpollPollerTest(PollerTestBase, unittest.TestCase):
+        def make_poller(self):
+            return poller.EpollPoller()
+
+        def test_fd_reused(self):
+            # epoll forgets about fds when they get closed.  Make sure we
+            # handle a new socket getting the same fd.
+            fd = self.receiver.fileno()
+            self.poller.register_read(fd)
+            self.poller.register_write(fd)
+            self.receiver.close()
+            self.sender.close()
+            self.sender, self.receiver = util.make_dummy_socket_pair()
+            self.poller.unregister_write(fd)
+            self.sender.send("a")
+            fd = self.receiver.fileno()
+            self.poller.register_read(fd)
+            self.assertEquals(self.poller.poll(1), ([fd], []))
+
+        def test_stateless_poller(self):
+            # epoll can't handle set_fds(), code that uses it should get a
+            # different poller
+            self.assertRaises(NotImplementedError, self.poller.set_fds,
+                              [], [])
+            stateless = poller.make_stateless_poller()
+            try:
+                self.assert_(not isinstance(stateless, poller.EpollPoller))
+            finally:
+                stateless.close()
+
+class EventLoopPollerTest(EventLoopTest):
+    def setUp(self):
+        EventLoopTest.setUp(self)
+        self.sender, self.receiver = util.make_dummy_socket_pair()
+        self.got_data = []
+
+    def tearDown(self):
+        self.sender.close()
+        self.receiver.close()
+        EventLoopTest.tearDown(self)
+
+    def on_readable(self):
+        self.got_data.append(self.receiver.recv(1024))
+        eventloop.remove_read_callback(self.receiver)
+        eventloop.shutdown()
+
+    def test_read_callback(self):
+        eventloop.add_read_callback(self.receiver, self.on_readable)
+        eventloop.add_timeout(0.1, self.sender.send, "send data",
+                              args=("hello",))
+        self.runEventLoop()
+        self.assertEquals(self.got_data, ["hello"])
+        self.assert_(self.receiver.fileno() not in
+                     eventloop._eventloop.poller.read_fds)
@@ -2,7 +2,10 @@ import unittest
 from time import time, sleep
 import threading
 
+from miro import app
 from miro import eventloop
+from miro import eventloopstats
+from miro import prefs
 from miro.test.framework import EventLoopTest
 
 class SchedulerTest(EventLoopTest):
@@ -58,3 +61,141 @@ class SchedulerTest(EventLoopTest):
         self.runEventLoop()
         totalCalls = len(timeouts) * threadCount + 1
         self.assertEquals(len(self.got_args), totalCalls)
+
+    def test_canceled_timeouts_dont_wake_up(self):
+        scheduler = eventloop.Scheduler()
+        dc = scheduler.add_timeout(0, self.callback, "foo")
+        scheduler.add_timeout(10, self.callback, "bar")
+        dc.cancel()
+        self.assert_(not scheduler.has_pending_timeout())
+        self.assert_(scheduler.next_timeout() > 9)
+        self.assertEquals(scheduler.get_stats()['heap_size'], 1)
+        self.assertEquals(scheduler.get_stats()['canceled'], 0)
+
+    def test_compaction(self):
+        scheduler = eventloop.Scheduler()
+        dcs = [scheduler.add_timeout(i, self.callback, "foo")
+               for i in range(100)]
+        # cancel timeouts from the middle of the heap
+        for dc in dcs[40:]:
+            dc.cancel()
+        self.assertEquals(scheduler.get_stats()['canceled'], 60)
+        scheduler.next_timeout()
+        stats = scheduler.get_stats()
+        self.assertEquals(stats['heap_size'], 40)
+        self.assertEquals(stats['canceled'], 0)
+        self.assertEquals(stats['compactions'], 1)
+        # canceling twice or after the heap dropped the timeout shouldn't
+        # throw off the count
+        dcs[50].cancel()
+        self.assertEquals(scheduler.get_stats()['canceled'], 0)
+
+    def test_cancel_while_running(self):
+        # canceling a timeout from its own callback shouldn't count it as a
+        # canceled timeout in the heap
+        scheduler = eventloop.Scheduler()
+        dcs = []
+        dcs.append(scheduler.add_timeout(0, lambda: dcs[0].cancel(),
+                                         "cancel self"))
+        scheduler.process_next_timeout()
+        self.assertEquals(scheduler.get_stats()['canceled'], 0)
+
+    def test_tolerance(self):
+        scheduler = eventloop.Scheduler()
+        scheduler.add_timeout(0, self.callback, "foo", args=(1,))
+        scheduler.add_timeout(10, self.callback, "foo", args=(2,),
+                              tolerance=20)
+        scheduler.add_timeout(20, self.callback, "foo", args=(3,),
+                              tolerance=1)
+        while scheduler.has_pending_timeout():
+            scheduler.process_next_timeout()
+        self.assertEquals(self.got_args, [(1,), (2,)])
+
+    def test_spurious_wakeups(self):
+        scheduler = eventloop.Scheduler()
+        scheduler.add_timeout(0, self.callback, "foo")
+        scheduler.note_wakeup()
+        scheduler.process_next_timeout()
+        scheduler.note_wakeup()
+        stats = scheduler.get_stats()
+        self.assertEquals(stats['wakeups'], 2)
+        self.assertEquals(stats['spurious_wakeups'], 1)
+
+class ThreadPoolTest(EventLoopTest):
+    def setUp(self):
+        EventLoopTest.setUp(self)
+        app.config.set(prefs.THREAD_POOL_CPU_THREADS, 1)
+        self.results = []
+        self.errors = []
+        self.release_cpu_lane = threading.Event()
+
+    def tearDown(self):
+        self.release_cpu_lane.set()
+        EventLoopTest.tearDown(self)
+
+    def callback(self, result):
+        self.results.append(result)
+        if len(self.results) + len(self.errors) == self.expected_calls:
+            eventloop.shutdown()
+
+    def errback(self, exc):
+        self.errors.append(exc)
+        if len(self.results) + len(self.errors) == self.expected_calls:
+            eventloop.shutdown()
+
+    def block_cpu_lane(self):
+        self.release_cpu_lane.wait()
+        return 'cpu'
+
+    def raise_error(self):
+        raise ValueError("fail")
+
+    def test_callbacks(self):
+        self.expected_calls = 2
+        future = eventloop.call_in_thread(self.callback, self.errback,
+                                          lambda x: x * 2, "double", 21)
+        error_future = eventloop.call_in_thread(self.callback, self.errback,
+                                                self.raise_error, "fail")
+        self.runEventLoop()
+        self.assertEquals(self.results, [42])
+        self.assertEquals(len(self.errors), 1)
+        self.assertEquals(future.get_result(), 42)
+        self.assertRaises(ValueError, error_future.get_result)
+        waits = eventloopstats.loop_stats.get_stats()['waits']
+        self.assert_(waits['io lane']['count'] >= 2)
+
+    def test_lanes(self):
+        # A slow call in the cpu lane shouldn't hold up the io lane
+        self.expected_calls = 2
+        eventloop.call_in_lane('cpu', self.callback, self.errback,
+                               self.block_cpu_lane, "block cpu")
+        eventloop.call_in_thread(self.callback, self.errback,
+                                 self.release_cpu_lane.set, "release cpu")
+        self.runEventLoop()
+        self.assertEquals(self.results, [None, 'cpu'])
+
+    def test_lanes_start_on_demand(self):
+        # only lanes that have had calls queued should have threads
+        threadpool = eventloop._eventloop.threadpool
+        def lanes_with_threads():
+            return [lane for lane in threadpool.LANES
+                    if threadpool.threads[lane]]
+        self.expected_calls = 1
+        eventloop.call_in_lane('fs', self.callback, self.errback,
+                               lanes_with_threads, "check lanes")
+        self.runEventLoop()
+        self.assertEquals(self.results, [['fs']])
+
+    def test_cancel(self):
+        self.expected_calls = 1
+        eventloop.call_in_lane('cpu', self.callback, self.errback,
+                               self.block_cpu_lane, "block cpu")
+        future = eventloop.call_in_lane('cpu', self.callback, self.errback,
+                                        self.raise_error, "canceled")
+        self.assert_(future.cancel())
+        self.assert_(future.is_done())
+        self.release_cpu_lane.set()
+        self.runEventLoop()
+        self.assertEquals(self.results, ['cpu'])
+        self.assertEquals(self.errors, [])
+        self.assertRaises(ValueError, future.get_result)
@@ -1,6 +1,9 @@
+import datetime
 import gc
 
 from miro import app
+from miro import ftsindex
+from miro import messagehandler
 from miro import models
 from miro import search
 from miro import ngrams
@@ -36,6 +39,39 @@ class NGramTest(MiroTestCase):
         end_count = len(gc.get_objects())
         self.assertEquals(start_count, end_count)
 
+    def check_batch_match(self, batch_match):
+        ngram_lists = [['fo', 'oo', 'foo'], ['ba', 'ar', 'bar'],
+                       ['fo', 'oo', 'foo', 'ba', 'ar', 'bar'], []]
+        self.assertEquals(batch_match(ngram_lists, ['foo'], []), [0, 2])
+        self.assertEquals(batch_match(ngram_lists, ['foo', 'bar'], []), [2])
+        self.assertEquals(batch_match(ngram_lists, [], []), [0, 1, 2, 3])
+        self.assertEquals(batch_match(ngram_lists, [], [['bar']]), [0, 3])
+        # items are filtered out if they match all the N-grams in any one of
+        # the negative groups
+        self.assertEquals(batch_match(ngram_lists, ['fo'],
+                                      [['bar', 'baz']]), [0, 2])
+        self.assertEquals(batch_match(ngram_lists, [],
+                                      [['baz'], ['fo', 'oo']]), [1, 3])
+        self.assertEquals(batch_match(iter(ngram_lists), ['oo'], []),
+                          [0, 2])
+
+    def test_batch_match(self):
+        self.check_batch_match(ngrams.batch_match)
+
+    def test_batch_match_fallback(self):
+        self.check_batch_match(search._py_batch_match)
+
+    def test_batch_match_memory(self):
+        ngram_lists = [ngrams.breakup_word('miroiscool', 1, 3)] * 10
+        gc.collect()
+        start_count = len(gc.get_objects())
+        results = ngrams.batch_match(ngram_lists, ['mir', 'cool'],
+                                     [['xyz'], ['is']])
+        del results
+        gc.collect()
+        end_count = len(gc.get_objects())
+        self.assertEquals(start_count, end_count)
+
 class SearchTest(MiroTestCase):
     def setUp(self):
         MiroTestCase.setUp(self)
@@ -94,6 +130,18 @@ class SearchTest(MiroTestCase):
         self.assertEquals(list(search.list_matches(items, 'foo')),
                           [])
 
+    def test_is_refinement(self):
+        self.assertTrue(search.is_refinement('demo', 'dem'))
+        self.assertTrue(search.is_refinement('dem', 'dem'))
+        self.assertTrue(search.is_refinement('dem foo', 'dem'))
+        self.assertTrue(search.is_refinement('foo demo', 'dem'))
+        self.assertTrue(search.is_refinement('dem -foo', 'dem'))
+        self.assertTrue(search.is_refinement('dem -foo', '-foo'))
+        self.assertFalse(search.is_refinement('de', 'dem'))
+        self.assertFalse(search.is_refinement('emo', 'dem'))
+        self.assertFalse(search.is_refinement('dem -foob', 'dem -foo'))
+        self.assertFalse(search.is_refinement('dem', 'dem -foo'))
+
     def test_ngrams_for_term(self):
         self.assertEquals(search._ngrams_for_term('a'),
                 ['a'])
@@ -101,3 +149,261 @@ class SearchTest(MiroTestCase):
                 ['five'])
         self.assertEquals(search._ngrams_for_term('verybig'),
                 ['veryb', 'erybi', 'rybig'])
+
+class RankedSearchTest(SearchTest):
+    def setUp(self):
+        SearchTest.setUp(self)
+        self.now = datetime.datetime(2011, 6, 1)
+
+    def make_ranked_item(self, title, description=u'', age_days=0):
+        info = self.make_item(u'http://example.com/', title)
+        return info.updated({
+            'description': description,
+            'release_date': self.now - datetime.timedelta(days=age_days),
+            })
+
+    def test_score(self):
+        title = self.make_ranked_item(u'foo foo', age_days=10000)
+        description = self.make_ranked_item(u'bar', u'foo foo',
+                                            age_days=10000)
+        new = self.make_ranked_item(u'bar', age_days=0)
+        self.assertAlmostEquals(search.score_match(title, 'foo', self.now),
+                                2 * search.TITLE_WEIGHT, 3)
+        self.assertAlmostEquals(search.score_match(description, 'foo',
+                                                   self.now),
+                                2 * search.DESCRIPTION_WEIGHT, 3)
+        self.assertAlmostEquals(search.score_match(new, 'foo', self.now),
+                                search.RECENCY_WEIGHT)
+        half_life = self.make_ranked_item(u'bar', age_days=30)
+        self.assertAlmostEquals(search.score_match(half_life, 'foo',
+                                                   self.now),
+                                search.RECENCY_WEIGHT / 2)
+
+    def test_pages(self):
+        infos = [self.make_ranked_item(u' '.join([u'foo'] * i))
+                 for i in xrange(1, 8)]
+        infos.append(self.make_ranked_item(u'bar'))
+        ranked = search.RankedSearch(infos, 'foo', page_size=3, now=self.now)
+        best_first = list(reversed(infos[:7]))
+        self.assertEquals(ranked.get_page(0), best_first[:3])
+        self.assertEquals(ranked.get_page(1), best_first[3:6])
+        self.assertEquals(ranked.get_page(2), best_first[6:])
+        self.assertEquals(ranked.get_page(3), [])
+        self.assertEquals(list(ranked),
+                          [best_first[:3], best_first[3:6], best_first[6:]])
+        self.assert_(ranked.has_more(1))
+        self.assert_(not ranked.has_more(2))
+
+    def test_score_once(self):
+        # each match gets scored when the search is created, getting pages
+        # shouldn't score or even look at the items again
+        infos = [self.make_ranked_item(u' '.join([u'foo'] * i))
+                 for i in xrange(1, 8)]
+        infos.append(self.make_ranked_item(u'bar'))
+        scored = []
+        real_score_match = search.score_match
+        def score_match(info, search_text, now=None):
+            scored.append(info)
+            return real_score_match(info, search_text, now)
+        search.score_match = score_match
+        try:
+            ranked = search.RankedSearch(iter(infos), 'foo', page_size=3,
+                                         now=self.now)
+            self.assertSameSet(scored, infos[:7])
+            self.assertEquals(ranked.match_count, 7)
+            for page in ranked:
+                pass
+            self.assertEquals(len(scored), 7)
+        finally:
+            search.score_match = real_score_match
+
+class NGramIndexTest(SearchTest):
+    QUERIES = ['first', 'second', 'my', 'item', 'd', 'foo', '', 'my -first',
+               '-first', 'item -seco', 'first second', '"my first"',
+               'default', '-default -item']
+
+    def setUp(self):
+        SearchTest.setUp(self)
+        self.item3 = self.make_item(u'http://example.com/3',
+                                    u'a long default item title')
+        self.infos = [self.item1, self.item2, self.item3]
+        self.index = search.NGramIndex(self.infos)
+
+    def check_index(self):
+        for query in self.QUERIES:
+            correct_ids = set(info.id for info in self.infos
+                              if search.item_matches(info, query))
+            self.assertEquals(self.index.matching_ids(query), correct_ids)
+            candidates = set([self.item1.id, self.item3.id])
+            self.assertEquals(self.index.matching_ids(query, candidates),
+                              correct_ids & candidates)
+
+    def test_matching_ids(self):
+        self.assertEquals(len(self.index), 3)
+        self.check_index()
+
+    def test_update(self):
+        new_info = self.item2.updated({'name': u'my first update'})
+        self.infos[1] = new_info
+        self.index.update_info(new_info)
+        self.check_index()
+        self.assertEquals(self.index.matching_ids('update'),
+                          set([new_info.id]))
+        self.assertEquals(self.index.matching_ids('second'), set())
+
+    def test_add_remove(self):
+        self.index.remove_info(self.item1)
+        self.infos.remove(self.item1)
+        self.assertEquals(len(self.index), 2)
+        self.check_index()
+        self.index.add_info(self.item1)
+        self.infos.append(self.item1)
+        self.check_index()
+
+class FTSIndexTest(MiroTestCase):
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        self.feed = models.Feed(u'http://example.com/')
+        self.item1 = self.make_item(u'http://example.com/1', u'my first item')
+        self.item2 = self.make_item(u'http://example.com/2', u'my second item')
+        self.index = ftsindex.ItemFTSIndex()
+        self.index.setup()
+        app.item_fts_index = self.index
+
+    def make_item(self, url, title):
+        entry = _build_entry(url, 'video/x-unknown', {'title': title})
+        return models.Item(FeedParserValues(entry), feed_id=self.feed.id)
+
+    def check_search(self, query, *items):
+        correct_ids = set(i.id for i in items)
+        self.assertEquals(self.index.matching_ids(query), correct_ids)
+        candidates = set([self.item1.id])
+        self.assertEquals(self.index.matching_ids(query, candidates),
+                          correct_ids & candidates)
+        for item in (self.item1, self.item2):
+            if item.id not in app.item_info_cache.id_to_info:
+                continue
+            info = app.item_info_cache.get_info(item.id)
+            self.assertEquals(self.index.info_matches(info, query),
+                              item.id in correct_ids)
+
+    def test_search(self):
+        self.check_search('first', self.item1)
+        self.check_search('SEC', self.item2)
+        self.check_search('my', self.item1, self.item2)
+        self.check_search('', self.item1, self.item2)
+        self.check_search('my -first', self.item2)
+        self.check_search('-first -second')
+        self.check_search('"my first"', self.item1)
+        self.check_search('"first my"')
+        self.check_search('foo')
+        self.check_search('!!!')
+
+    def test_search_many_candidates(self):
+        # with lots of candidates, we run the search on the whole table
+        old_max = ftsindex.MAX_CANDIDATE_IDS
+        ftsindex.MAX_CANDIDATE_IDS = 0
+        try:
+            self.test_search()
+        finally:
+            ftsindex.MAX_CANDIDATE_IDS = old_max
+
+    def test_item_changes(self):
+        self.item1.set_title(u'new title')
+        self.check_search('first')
+        self.check_search('new', self.item1)
+        self.item2.remove()
+        self.check_search('my')
+        item3 = self.make_item(u'http://example.com/3', u'my third item')
+        self.check_search('my', item3)
+
+    def test_writes_use_db_transaction(self):
+        app.db.finish_transaction()
+        self.item1.set_title(u'new title')
+        self.check_search('new', self.item1)
+        # searching shouldn't commit the FTS changes, they're part of the
+        # current transaction.
+        app.db.finish_transaction(commit=False)
+        app.db.cursor.execute("SELECT COUNT(*) FROM item_fts "
+                              "WHERE item_fts MATCH 'new'")
+        self.assertEquals(app.db.cursor.fetchone()[0], 0)
+        # the item still has the new title, so the change should get
+        # written again.
+        self.check_search('new', self.item1)
+        self.check_search('first')
+
+    def test_where_sql(self):
+        where, values = self.index.where_sql('item -first')
+        view = models.Item.make_view(where, values)
+        self.assertEquals([i.id for i in view], [self.item2.id])
+        self.assertEquals(self.index.where_sql(''), (None, []))
+
+    def test_limiter(self):
+        source = itemsource.DatabaseItemSource(models.Item.make_view())
+        limiter = messagehandler.ItemSearchLimiter('first', use_index=True)
+        self.assertNotEquals(limiter.where_sql(), None)
+        source.set_limiter(limiter)
+        self.assertEquals([info.id for info in source.fetch()],
+                          [self.item1.id])
+        self.assertEquals(source.current_ids, set([self.item1.id]))
+        source.unlink()
+
+    def test_limiter_refine(self):
+        source = itemsource.DatabaseItemSource(models.Item.make_view())
+        source.set_limiter(messagehandler.ItemSearchLimiter('my',
+                                                            use_index=True))
+        self.assertEquals(source.current_ids,
+                          set([self.item1.id, self.item2.id]))
+        # refining should only check the items that matched 'my'
+        checked = []
+        real_matching_ids = self.index.matching_ids
+        def matching_ids(search_text, candidates=None):
+            checked.append(candidates)
+            return real_matching_ids(search_text, candidates)
+        self.index.matching_ids = matching_ids
+        source.set_limiter(messagehandler.ItemSearchLimiter('my s',
+                                                            use_index=True))
+        self.assertEquals(checked, [set([self.item1.id, self.item2.id])])
+        self.assertEquals(source.current_ids, set([self.item2.id]))
+        source.unlink()
+
+    def test_rebuild_after_crash(self):
+        # simulate a crash, the table is out of sync and VERSION_KEY isn't
+        # set
+        self.index.flush()
+        app.db.cursor.execute("DELETE FROM item_fts")
+        self.index = ftsindex.ItemFTSIndex()
+        self.index.setup()
+        app.item_fts_index = self.index
+        self.check_search('my', self.item1, self.item2)
+
+    def test_rebuild_from_item_table(self):
+        # rebuilding reads the item table, it shouldn't need ItemInfos
+        def fail():
+            self.fail("all_infos() called")
+        app.item_info_cache.all_infos = fail
+        self.item1.set_title(u'new title')
+        self.index.flush()
+        live_texts = self.index._current_texts([self.item1.id,
+                                                self.item2.id])
+        self.index.rebuild()
+        self.check_search('my', self.item2)
+        self.check_search('new', self.item1)
+        # the feed name is searchable too
+        self.check_search('example', self.item1, self.item2)
+        # rebuild() and item changes should calculate the same text
+        self.assertEquals(self.index._current_texts([self.item1.id,
+                                                     self.item2.id]),
+                          live_texts)
+
+    def test_reuse_after_shutdown(self):
+        self.index.shutdown()
+        app.item_fts_index = None
+        self.item1.set_title(u'new title')
+        self.index = ftsindex.ItemFTSIndex()
+        self.index.setup()
+        app.item_fts_index = self.index
+        # if we rebuilt the index, it would contain the new title
+        self.assertEquals(self.index.matching_ids('first'),
+                          set([self.item1.id]))
+        self.assertEquals(self.index.matching_ids('new'), set())
@@ -14,6 +14,7 @@ from miro import feed
 from miro import folder
 from miro import displaystate
 from miro import guide
+from miro import queryplan
 from miro import schema
 from miro import signals
 from miro import tabs
@@ -149,8 +150,9 @@ class StoreDatabaseTest(EventLoopTest):
         self.remove_database()
         corrupt_path = os.path.join(os.path.dirname(self.save_path),
                                     'corrupt_database')
-        if os.path.exists(corrupt_path):
-            os.remove(corrupt_path)
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(corrupt_path + suffix):
+                os.remove(corrupt_path + suffix)
         databaseupgrade._upgrade_overide = {}
         EventLoopTest.tearDown(self)
 
@@ -180,6 +182,18 @@ class DBUpgradeTest(StoreDatabaseTest):
             pass
         StoreDatabaseTest.tearDown(self)
 
+    @skip_for_platforms('win32')
+    def test_incremental_vacuum(self):
+        self.remove_database()
+        self.reload_database(self.save_path)
+        app.db.cursor.execute("PRAGMA auto_vacuum")
+        self.assertEquals(app.db.cursor.fetchone()[0], 2)
+        shutil.copy(resources.path("testdata/olddatabase.v79"),
+                    self.save_path2)
+        self.reload_database(self.save_path2)
+        app.db.cursor.execute("PRAGMA auto_vacuum")
+        self.assertEquals(app.db.cursor.fetchone()[0], 2)
+
     @skip_for_platforms('win32')
     def test_indexes_same(self):
         # this fails on windows because it's using a non-Windows
@@ -277,6 +291,60 @@ class DiskTest(FakeSchemaTest):
         self.reload_test_database()
         self.check_database()
 
+    def test_update_coalescing(self):
+        statements = []
+        real_time_execute = app.db._time_execute
+        def time_execute(sql, values, many):
+            statements.append(sql)
+            real_time_execute(sql, values, many)
+        app.db._time_execute = time_execute
+        for i in range(5):
+            self.joe.name = u'joe %d' % i
+            self.joe.signal_change()
+        app.db.finish_transaction()
+        updates = [s for s in statements if s.startswith("UPDATE")]
+        self.assertEquals(len(updates), 1)
+        self.reload_test_database()
+        self.check_database()
+
+    def test_select_sees_update(self):
+        self.joe.name = u'JO MAMA'
+        self.joe.signal_change()
+        view = RestorableHuman.make_view('name=?', (u'JO MAMA',))
+        self.assertEquals(view.count(), 1)
+
+    def run_async_query(self, sql, values=None):
+        self.async_result = None
+        def callback(rows):
+            self.async_result = rows
+            self.stopEventLoop(abnormal=False)
+        def errback(error):
+            self.async_result = error
+            self.stopEventLoop(abnormal=False)
+        app.db.query_async(sql, values, callback, errback)
+        self.runEventLoop()
+        return self.async_result
+
+    def test_query_async(self):
+        self.lee.name = u'lee2'
+        self.lee.signal_change()
+        # the worker connection only sees committed changes
+        app.db.finish_transaction()
+        self.assertEquals(self.run_async_query("SELECT name FROM human"),
+                          [(u'lee2',)])
+        self.assertEquals(self.run_async_query(
+            "SELECT name FROM restorable_human WHERE id=?", (self.joe.id,)),
+            [(u'joe',)])
+
+    def test_query_async_error(self):
+        result = self.run_async_query("SELECT bogus FROM human")
+        self.assert_(isinstance(result, storedatabase.sqlite3.Error))
+
+    def test_query_async_non_sqlite_error(self):
+        # errors that aren't from sqlite still need to go to the errback
+        result = self.run_async_query("SELECT name FROM human", 5)
+        self.assert_(isinstance(result, ValueError))
+
     def test_binary_reload(self):
         self.joe.id_code = 'abc'
         self.joe.signal_change()
@@ -377,6 +445,40 @@ class DiskTest(FakeSchemaTest):
         self.start_fresh_on_error_dialog()
         self.check_reload_error()
 
+    def test_save_invalid_db_moves_wal(self):
+        # If another connection was still open, the write-ahead log
+        # outlives ours.  It should move with the database, otherwise
+        # SQLite could replay it into the fresh one.
+        app.db.close()
+        open(self.save_path + '-wal', 'wb').write("OLD WAL")
+        app.db.save_invalid_db()
+        corrupt_path = os.path.join(os.path.dirname(self.save_path),
+                                    'corrupt_database')
+        self.assert_(os.path.exists(corrupt_path))
+        self.assert_(not os.path.exists(self.save_path + '-wal'))
+        self.assertEquals(open(corrupt_path + '-wal', 'rb').read(),
+                "OLD WAL")
+        self.reload_test_database()
+
+    def test_backup_failed_upgrade_db(self):
+        # The objects we created in setUp() are still in the write-ahead
+        # log, the backup should include them anyway.
+        app.db.finish_transaction()
+        app.db._backup_failed_upgrade_db()
+        backup_path = os.path.join(os.path.dirname(self.save_path),
+                'failed_upgrade_database')
+        try:
+            connection = storedatabase.sqlite3.connect(backup_path)
+            cursor = connection.cursor()
+            cursor.execute("SELECT name FROM human")
+            names = [row[0] for row in cursor]
+            connection.close()
+        finally:
+            for suffix in ('', '-wal', '-shm'):
+                if os.path.exists(backup_path + suffix):
+                    os.remove(backup_path + suffix)
+        self.assert_(u'lee' in names)
+
     def test_database_data_error(self):
         app.db.cursor.execute("DROP TABLE human")
         self.check_reload_error()
@@ -510,13 +612,72 @@ class CorruptReprTest(FakeSchemaTest):
         self.assertEqual(restored_lee.stuff, 'testing123')
         app.db.cursor.execute("SELECT stuff from human WHERE name='lee'")
         row = app.db.cursor.fetchone()
-        self.assertEqual(row[0], "'testing123'")
+        self.assertEqual(app.db._converter.decode_container(row[0]),
+                         'testing123')
 
     def test_repr_failure_no_handler(self):
         app.db.cursor.execute("UPDATE pcf_programmer SET stuff='{baddata' "
                               "WHERE name='ben'")
         self.assertRaises(SyntaxError, self.reload_object, self.ben)
 
+class ContainerFormatTest(FakeSchemaTest):
+    def get_column(self, column, obj):
+        app.db.cursor.execute("SELECT %s FROM human WHERE id=?" % column,
+                              (obj.id,))
+        return app.db.cursor.fetchone()[0]
+
+    def test_stored_as_binary(self):
+        self.assert_(isinstance(self.get_column('high_scores', self.lee),
+                                buffer))
+
+    def test_legacy_rows_rewritten(self):
+        app.db.cursor.execute("UPDATE human SET high_scores=?, stuff=? "
+                "WHERE id=?", (u"{u'pong': 12}", u"(1, 'a')", self.lee.id))
+        restored_lee = self.reload_object(self.lee)
+        self.assertEquals(restored_lee.high_scores, {u'pong': 12})
+        self.assertEquals(restored_lee.stuff, (1, 'a'))
+        app.db.finish_transaction()
+        self.assert_(isinstance(self.get_column('high_scores', self.lee),
+                                buffer))
+        self.assert_(isinstance(self.get_column('stuff', self.lee), buffer))
+        restored_lee = self.reload_object(restored_lee)
+        self.assertEquals(restored_lee.high_scores, {u'pong': 12})
+        self.assertEquals(restored_lee.stuff, (1, 'a'))
+
+class QueryPlanTest(FakeSchemaTest):
+    def setUp(self):
+        self.old_debugmode = app.debugmode
+        app.debugmode = True
+        FakeSchemaTest.setUp(self)
+
+    def tearDown(self):
+        app.debugmode = self.old_debugmode
+        FakeSchemaTest.tearDown(self)
+
+    def test_parse_tables(self):
+        self.assertEquals(queryplan.parse_tables(
+            "SELECT item.id FROM item LEFT JOIN remote_downloader AS rd "
+            "ON item.downloader_id=rd.id LEFT JOIN feed ON "
+            "item.feed_id=feed.id WHERE rd.state='finished'"),
+            {'item': 'item', 'remote_downloader': 'remote_downloader',
+                'rd': 'remote_downloader', 'feed': 'feed'})
+
+    def test_full_scan(self):
+        list(Human.make_view('age=?', (25,)))
+        list(Human.make_view('id=?', (self.lee.id,)))
+        scanning = app.db._plan_auditor.scanning_statements()
+        self.assertEquals(len(scanning), 1)
+        self.assertEquals(scanning[0].full_scans, [('human', 'human')])
+
+    def test_report(self):
+        for i in xrange(3):
+            list(Human.make_view("age=? AND name LIKE 'l%'", (25,)))
+        report = app.db.query_plan_report()
+        self.assert_("3 executions, scans human" in report)
+        self.assert_("CREATE INDEX human_age ON human (age)" in report)
+        # name is in the where clause, but LIKE can't use an index on it
+        self.assert_("human_name" not in report)
+
 class ConverterTest(StoreDatabaseTest):
     def test_convert_repr(self):
         converter = storedatabase.SQLiteConverter()
@@ -531,6 +692,21 @@ class ConverterTest(StoreDatabaseTest):
         self.assertEquals(val, {"updated_parsed":
                                 (2009, 6, 5, 1, 30, 0, 4, 156, 0)})
 
+    def test_container_format(self):
+        converter = storedatabase.SQLiteConverter()
+        value = {u'title': u'\u1234', 'data': [1, 2.5, None],
+                 'when': datetime(2010, 1, 2, 3, 4, 5)}
+        encoded = converter.encode_container(value)
+        self.assert_(isinstance(encoded, buffer))
+        self.assertEquals(converter.decode_container(encoded), value)
+        # values written by older versions are still readable
+        self.assertEquals(converter.decode_container(repr(value)), value)
+        self.assertEquals(converter.decode_container(unicode(repr(value))),
+                          value)
+        # we refuse to guess at formats from newer versions
+        future = buffer('\x00\x02' + str(encoded)[2:])
+        self.assertRaises(ValueError, converter.decode_container, future)
+
 class CorruptDDBObjectReprTest(StoreDatabaseTest):
     # test corrupt SchemaReprContainer columns in real DDBObjects
     def setUp(self):
@@ -417,6 +417,46 @@ class UtilTest(unittest.TestCase):
         self.assertEqual(';2%/*()_-?+z', util.ascii_lower(';2%/*()_-?+Z'))
 
 
+class InternStringTest(unittest.TestCase):
+    def test_intern_string(self):
+        s1 = u''.join([u'intern', u' me'])
+        s2 = u''.join([u'intern', u' me'])
+        self.assert_(s1 is not s2)
+        self.assert_(util.intern_string(s1) is s1)
+        self.assert_(util.intern_string(s2) is s1)
+        self.assert_(util.intern_string(None) is None)
+
+    def test_intern_string_keeps_type(self):
+        # u'mp4' == 'mp4', but interning one shouldn't return the other
+        self.assertEquals(type(util.intern_string('intern type')), str)
+        self.assertEquals(type(util.intern_string(u'intern type')), unicode)
+        self.assertEquals(type(util.intern_string('intern type')), str)
+
+class HTMLStripperCacheTest(unittest.TestCase):
+    def setUp(self):
+        unittest.TestCase.setUp(self)
+        self.cache = util.HTMLStripperCache(4)
+
+    def test_strip(self):
+        html = u'<p>Hello <a href="http://example.com/">world</a></p>'
+        correct = util.HTMLStripper().strip(html)
+        self.assertEquals(self.cache.strip(html), correct)
+        self.assertEquals(self.cache.strip(html), correct)
+        self.assertEquals(self.cache.strip(html.encode('utf-8')), correct)
+        self.assertEquals(self.cache.strip(None), ("", []))
+        stats = self.cache.get_stats()
+        self.assertEquals(stats['hits'], 2)
+        self.assertEquals(stats['misses'], 1)
+        self.assertEquals(stats['size'], 1)
+        self.assertAlmostEquals(stats['hit_rate'], 2.0 / 3)
+
+    def test_bounded(self):
+        for i in range(10):
+            self.cache.strip(u'<b>%d</b>' % i)
+        self.assert_(self.cache.get_stats()['size'] <= 4)
+        self.assertEquals(self.cache.strip(u'<b>9</b>'), (u'9', []))
+        self.assertEquals(self.cache.get_stats()['misses'], 10)
+
 class DownloadUtilsTest(unittest.TestCase):
     def check_clean_filename(self, filename, test_against):
         self.assertEquals(download_utils.clean_filename(filename),
@@ -44,6 +44,8 @@ try:
 except ImportError:
     from sha import sha
 import string
+import sys
+import threading
 import urllib
 import socket
 import logging
@@ -475,19 +477,31 @@ def db_mem_usage_test():
             continue
 
         # make sure each object is loaded in memory and count the total
-        count = len(list(ddb_object_class.make_view()))
+        objects = list(ddb_object_class.make_view())
+        count = len(objects)
         current_usage = get_mem_usage()
         class_usage = current_usage-last_usage
+        state_size = sum(_ddb_object_state_size(obj) for obj in objects)
         if count == 0:
             count = 1 # prevent zero division errors
-        logging.info("memory usage for %s: %s (%d bytes per object)",
+        logging.info("memory usage for %s: %s (%d bytes per object, "
+                "%d bytes of attribute storage)",
                 ddb_object_class.__name__, class_usage,
-                class_usage * 1024 / count)
+                class_usage * 1024 / count, state_size / count)
         last_usage = current_usage
     logging.info("total memory usage: %s", last_usage)
     logging.info("feed count: %s", models.Feed.make_view().count())
     logging.info("item count: %s", models.Item.make_view().count())
 
+def _ddb_object_state_size(obj):
+    """Calculate how many bytes a DDBObject uses for its instance dict and
+    field values list (not counting the values themselves).
+    """
+    size = sys.getsizeof(obj) + sys.getsizeof(obj.__dict__)
+    if '_field_values' in obj.__dict__:
+        size += sys.getsizeof(obj._field_values)
+    return size
+
 def get_mem_usage():
     return int(call_command('ps', '-o', 'rss', 'hp', str(os.getpid())))
 
@@ -1100,3 +1114,104 @@ class Cache(object):
 
     def create_new_value(self, val):
         raise NotImplementedError()
+
+class HTMLStripperCache(Cache):
+    """Cache the results of HTMLStripper.strip().
+
+    Item descriptions almost never change, but we strip them each time an
+    ItemInfo is built, and again for display.  The cache is keyed by a hash
+    of the HTML, so it doesn't keep the descriptions themselves alive.
+
+    This class is threadsafe.  hits and misses count how well the cache is
+    doing, use get_stats() to look at them.
+    """
+    def __init__(self, size):
+        Cache.__init__(self, size)
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def _get_stripper(self):
+        # HTMLStripper isn't threadsafe, so use one per thread
+        try:
+            return self._local.stripper
+        except AttributeError:
+            self._local.stripper = HTMLStripper()
+            return self._local.stripper
+
+    def strip(self, s):
+        """Get the result of HTMLStripper.strip() for a string."""
+        if not isinstance(s, basestring):
+            return ("", [])
+        if isinstance(s, unicode):
+            key = sha(s.encode('utf-8')).digest()
+        else:
+            key = sha(s).digest()
+        self._lock.acquire()
+        try:
+            if key in self.dict:
+                self.hits += 1
+                self.access_times[key] = self.counter.next()
+                return self.dict[key]
+        finally:
+            self._lock.release()
+        # don't hold the lock while we parse the HTML
+        value = self._get_stripper().strip(s)
+        self._lock.acquire()
+        try:
+            self.misses += 1
+            self.set(key, value)
+        finally:
+            self._lock.release()
+        return value
+
+    def get_stats(self):
+        """Get a dict with the size, hits, misses and hit_rate of the
+        cache.
+        """
+        self._lock.acquire()
+        try:
+            total = self.hits + self.misses
+            if total:
+                hit_rate = float(self.hits) / total
+            else:
+                hit_rate = 0.0
+            return {
+                'size': len(self.dict),
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': hit_rate,
+            }
+        finally:
+            self._lock.release()
+
+# shared by ItemInfo and the frontend to strip item descriptions
+stripped_html_cache = HTMLStripperCache(5000)
+
+# strings interned by intern_string().  The keys are (type, string) tuples,
+# since u'foo' == 'foo' and we don't want to hand back a str for a unicode
+# object (or the other way around).
+_interned_strings = {}
+# If we ever intern this many strings, something is using intern_string() on
+# values that aren't repeated much.  Start over rather than growing forever.
+MAX_INTERNED_STRINGS = 100000
+
+def intern_string(s):
+    """Return a shared copy of a string.
+
+    This works like the intern() builtin, but it also handles unicode
+    objects.  Use it for values that get repeated a lot, like the feed name
+    for each item, so that they only get stored once.
+
+    Interned strings aren't freed, so don't use this for values that are
+    mostly unique.
+    """
+    key = (type(s), s)
+    try:
+        return _interned_strings[key]
+    except KeyError:
+        if len(_interned_strings) >= MAX_INTERNED_STRINGS:
+            _interned_strings.clear()
+        _interned_strings[key] = s
+        return s
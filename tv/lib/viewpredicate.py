@@ -0,0 +1,449 @@
+# Miro - an RSS based video player application
+# Copyright (C) 2005, 2006, 2007, 2008, 2009, 2010, 2011
+# Participatory Culture Foundation
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
+#
+# In addition, as a special exception, the copyright holders give
+# permission to link the code of portions of this program with the OpenSSL
+# library.
+#
+# You must obey the GNU General Public License in all respects for all of
+# the code used other than OpenSSL. If you modify file(s) with this
+# exception, you may extend this exception to your version of the file(s),
+# but you are not obligated to do so. If you do not wish to do so, delete
+# this exception statement from your version. If you delete this exception
+# statement from all source files in the program, then also delete it here.
+
+"""``miro.viewpredicate`` -- Evaluate view WHERE clauses in memory.
+
+ViewTrackers need to know if a single object is in their view every time
+that object changes.  Asking SQLite means one ``SELECT COUNT(*)`` per
+tracker per change, which adds up quickly when there are many trackers on
+the item table.
+
+This module compiles the simple SQL that our views use into python
+closures that run against the in-memory DDBObject (and the objects it
+joins to).  We only handle a small subset of SQL: AND/OR/NOT, comparisons,
+IS [NOT] NULL, [NOT] IN with a list of values, column references, literals
+and ``?`` placeholders.  Joins must be of the form
+``table.column=alias.id``.  Anything else makes compile_predicate() return
+None and the caller should stick with SQL.
+
+Expressions are evaluated using SQL's three-valued logic, with None
+standing in for NULL.
+"""
+
+import re
+
+from miro import app
+
+class CompileError(StandardError):
+    """Raised internally when a where clause can't be compiled."""
+    pass
+
+class NotInMemory(StandardError):
+    """Raised by ViewPredicate.evaluate() when it can't calculate the
+    result from in-memory objects.
+
+    Callers should fall back to running the SQL query.
+    """
+    pass
+
+_token_re = re.compile(r"""
+    \s*(?:
+    (?P<string>'(?:[^']|'')*')|
+    (?P<number>\d+(?:\.\d+)?)(?![\w.])|
+    (?P<name>[A-Za-z_]\w*(?:\.[A-Za-z_]\w*)?)|
+    (?P<op>==|!=|<>|<=|>=|=|<|>|\(|\)|,|\?)
+    )""", re.VERBOSE)
+
+_KEYWORDS = frozenset(['and', 'or', 'not', 'is', 'null', 'in'])
+
+def _tokenize(sql):
+    tokens = []
+    pos = 0
+    sql = sql.rstrip()
+    while pos < len(sql):
+        m = _token_re.match(sql, pos)
+        if m is None or m.end() == pos:
+            raise CompileError("can't tokenize %r at %d" % (sql, pos))
+        pos = m.end()
+        kind = m.lastgroup
+        text = m.group(kind)
+        if kind == 'string':
+            tokens.append(('literal', text[1:-1].replace("''", "'")))
+        elif kind == 'number':
+            if '.' in text:
+                tokens.append(('literal', float(text)))
+            else:
+                tokens.append(('literal', int(text)))
+        elif kind == 'name' and text.lower() in _KEYWORDS:
+            tokens.append(('keyword', text.lower()))
+        else:
+            tokens.append((kind, text))
+    return tokens
+
+def _sql_truth(value):
+    """Convert a value to SQL's idea of true/false/NULL."""
+    if value is None:
+        return None
+    if isinstance(value, (bool, int, long, float)):
+        return value != 0
+    # SQLite converts text to a number here, don't try to copy that.
+    raise NotInMemory("can't use %r as a boolean" % (value,))
+
+def _sql_not(func):
+    def sql_not(ctx):
+        value = _sql_truth(func(ctx))
+        if value is None:
+            return None
+        return not value
+    return sql_not
+
+def _sql_and(funcs):
+    def sql_and(ctx):
+        rv = True
+        for func in funcs:
+            value = _sql_truth(func(ctx))
+            if value is False:
+                return False
+            elif value is None:
+                rv = None
+        return rv
+    return sql_and
+
+def _sql_or(funcs):
+    def sql_or(ctx):
+        rv = False
+        for func in funcs:
+            value = _sql_truth(func(ctx))
+            if value is True:
+                return True
+            elif value is None:
+                rv = None
+        return rv
+    return sql_or
+
+_comparisons = {
+    '=': lambda a, b: a == b,
+    '==': lambda a, b: a == b,
+    '!=': lambda a, b: a != b,
+    '<>': lambda a, b: a != b,
+    '<': lambda a, b: a < b,
+    '<=': lambda a, b: a <= b,
+    '>': lambda a, b: a > b,
+    '>=': lambda a, b: a >= b,
+}
+
+def _sql_compare(op, left, right):
+    compare = _comparisons[op]
+    def sql_compare(ctx):
+        a = left(ctx)
+        b = right(ctx)
+        if a is None or b is None:
+            return None
+        return compare(a, b)
+    return sql_compare
+
+def _sql_is_null(func, negate):
+    def sql_is_null(ctx):
+        return (func(ctx) is None) != negate
+    return sql_is_null
+
+def _sql_in(func, choices, negate):
+    def sql_in(ctx):
+        value = func(ctx)
+        if value is None:
+            return None
+        saw_null = False
+        for choice in choices:
+            choice_value = choice(ctx)
+            if choice_value is None:
+                saw_null = True
+            elif choice_value == value:
+                return not negate
+        if saw_null:
+            return None
+        return negate
+    return sql_in
+
+class _EvalContext(object):
+    """Holds the objects for a single evaluation of a predicate."""
+    def __init__(self, predicate, obj, values):
+        self.predicate = predicate
+        self.values = values
+        self.objects = {predicate.alias: obj}
+
+    def get_object(self, alias):
+        try:
+            return self.objects[alias]
+        except KeyError:
+            obj = self.predicate.fetch_joined(alias, self.objects)
+            self.objects[alias] = obj
+            return obj
+
+class _Parser(object):
+    def __init__(self, predicate, sql):
+        self.predicate = predicate
+        self.tokens = _tokenize(sql)
+        self.pos = 0
+        self.placeholder_count = 0
+
+    def peek(self):
+        try:
+            return self.tokens[self.pos]
+        except IndexError:
+            return (None, None)
+
+    def next(self):
+        token = self.peek()
+        if token[0] is None:
+            raise CompileError("unexpected end of clause")
+        self.pos += 1
+        return token
+
+    def accept(self, kind, text):
+        if self.peek() == (kind, text):
+            self.pos += 1
+            return True
+        return False
+
+    def expect(self, kind, text):
+        if not self.accept(kind, text):
+            raise CompileError("expected %r got %r" % (text, self.peek()))
+
+    def parse(self):
+        func = self.parse_or()
+        if self.pos != len(self.tokens):
+            raise CompileError("trailing tokens: %r" %
+                    (self.tokens[self.pos:],))
+        return func
+
+    def parse_or(self):
+        funcs = [self.parse_and()]
+        while self.accept('keyword', 'or'):
+            funcs.append(self.parse_and())
+        if len(funcs) == 1:
+            return funcs[0]
+        return _sql_or(funcs)
+
+    def parse_and(self):
+        funcs = [self.parse_not()]
+        while self.accept('keyword', 'and'):
+            funcs.append(self.parse_not())
+        if len(funcs) == 1:
+            return funcs[0]
+        return _sql_and(funcs)
+
+    def parse_not(self):
+        if self.accept('keyword', 'not'):
+            return _sql_not(self.parse_not())
+        return self.parse_comparison()
+
+    def parse_comparison(self):
+        left = self.parse_operand()
+        kind, text = self.peek()
+        if kind == 'op' and text in _comparisons:
+            self.pos += 1
+            return _sql_compare(text, left, self.parse_operand())
+        elif self.accept('keyword', 'is'):
+            negate = self.accept('keyword', 'not')
+            self.expect('keyword', 'null')
+            return _sql_is_null(left, negate)
+        elif (kind, text) == ('keyword', 'not'):
+            self.pos += 1
+            self.expect('keyword', 'in')
+            return self.parse_in_list(left, True)
+        elif self.accept('keyword', 'in'):
+            return self.parse_in_list(left, False)
+        return left
+
+    def parse_in_list(self, left, negate):
+        self.expect('op', '(')
+        choices = [self.parse_operand()]
+        while self.accept('op', ','):
+            choices.append(self.parse_operand())
+        self.expect('op', ')')
+        return _sql_in(left, choices, negate)
+
+    def parse_operand(self):
+        kind, text = self.next()
+        if (kind, text) == ('op', '('):
+            func = self.parse_or()
+            self.expect('op', ')')
+            return func
+        elif kind == 'literal':
+            return lambda ctx: text
+        elif (kind, text) == ('keyword', 'null'):
+            return lambda ctx: None
+        elif (kind, text) == ('op', '?'):
+            index = self.placeholder_count
+            self.placeholder_count += 1
+            return lambda ctx: ctx.values[index]
+        elif kind == 'name':
+            return self.predicate.compile_column(text)
+        raise CompileError("unexpected token: %r" % ((kind, text),))
+
+class ViewPredicate(object):
+    """Python version of a view's where clause and joins.
+
+    Member variables:
+
+    * ``table_name`` -- table that the view selects from
+    * ``columns`` -- set of (table_name, column_name) tuples for every
+      column that the where clause or the joins depend on.
+    """
+    def __init__(self, table_name, where, joins):
+        self.table_name = self.alias = table_name
+        self.columns = set()
+        # maps alias -> table name
+        self._tables = {table_name: table_name}
+        # maps alias -> column of the main table that holds the joined id
+        self._join_columns = {}
+        # maps table name -> {lowercase column name: column name}
+        self._column_maps = {}
+        if joins is not None:
+            for join_table, join_where in joins.items():
+                self._add_join(join_table, join_where)
+        if where is None:
+            self._func = lambda ctx: True
+        else:
+            self._func = _Parser(self, where).parse()
+
+    def _get_column_map(self, table_name):
+        try:
+            return self._column_maps[table_name]
+        except KeyError:
+            try:
+                columns = app.db.columns_for_table(table_name)
+            except KeyError:
+                raise CompileError("unknown table: %s" % table_name)
+            column_map = dict((c.lower(), c) for c in columns)
+            self._column_maps[table_name] = column_map
+            return column_map
+
+    def _add_join(self, join_table, join_where):
+        parts = join_table.split()
+        if len(parts) == 1:
+            table = alias = parts[0]
+        elif len(parts) == 2:
+            table, alias = parts
+        elif len(parts) == 3 and parts[1].lower() == 'as':
+            table, alias = parts[0], parts[2]
+        else:
+            raise CompileError("can't parse join: %s" % join_table)
+        self._tables[alias] = table
+
+        sides = [s.strip() for s in join_where.split('=')]
+        if len(sides) != 2 or not all('.' in s for s in sides):
+            raise CompileError("can't parse join: %s" % join_where)
+        refs = [s.split('.', 1) for s in sides]
+        refs.sort(key=lambda ref: ref[0] != alias)
+        (join_alias, join_column), (main_alias, main_column) = refs
+        if (join_alias != alias or main_alias != self.alias or
+                join_column.lower() != 'id'):
+            # we can only follow joins that reference the joined
+            # table's id column.
+            raise CompileError("unsupported join: %s" % join_where)
+        main_column = self._lookup_column(self.alias, main_column)
+        self._join_columns[alias] = main_column
+        self.columns.add((self.table_name, main_column))
+
+    def _lookup_column(self, alias, column):
+        column_map = self._get_column_map(self._tables[alias])
+        try:
+            return column_map[column.lower()]
+        except KeyError:
+            raise CompileError("unknown column: %s.%s" % (alias, column))
+
+    def compile_column(self, name):
+        if '.' in name:
+            alias, column = name.split('.', 1)
+            if alias not in self._tables:
+                raise CompileError("unknown table: %s" % alias)
+        else:
+            matches = [a for a in self._tables
+                    if name.lower() in self._get_column_map(self._tables[a])]
+            if len(matches) != 1:
+                raise CompileError("can't resolve column: %s" % name)
+            alias, column = matches[0], name
+        attr_name = self._lookup_column(alias, column)
+        self.columns.add((self._tables[alias], attr_name))
+        if alias == self.alias:
+            return lambda ctx: getattr(ctx.objects[alias], attr_name)
+        def get_joined_column(ctx):
+            obj = ctx.get_object(alias)
+            if obj is None:
+                return None
+            return getattr(obj, attr_name)
+        return get_joined_column
+
+    def fetch_joined(self, alias, objects):
+        """Get the object that a join points to.
+
+        Returns None if the join doesn't match any rows.  Raises
+        NotInMemory if the object isn't loaded.
+        """
+        id_ = getattr(objects[self.alias], self._join_columns[alias])
+        if id_ is None:
+            return None
+        try:
+            obj = app.db.get_obj_by_id(id_)
+        except KeyError:
+            raise NotInMemory("object %s not loaded" % id_)
+        if app.db.table_name(obj.__class__) != self._tables[alias]:
+            return None
+        return obj
+
+    def joined_ids(self, obj):
+        """Get the objects that obj joins to.
+
+        :returns: list of (table_name, id) tuples.  id will be None if the
+        join doesn't match anything.
+        """
+        return [(self._tables[alias], getattr(obj, column))
+                for alias, column in self._join_columns.items()]
+
+    def join_columns(self):
+        """Get the columns that we join on.
+
+        :returns: list of (joined table_name, column) tuples, where column
+        is the column in our table that refers to the joined table.
+        """
+        return [(self._tables[alias], column)
+                for alias, column in self._join_columns.items()]
+
+    def evaluate(self, obj, values):
+        """Check if obj matches the where clause.
+
+        :raises NotInMemory: the answer can only come from SQL
+        """
+        try:
+            return _sql_truth(self._func(_EvalContext(self, obj,
+                values))) is True
+        except AttributeError, e:
+            raise NotInMemory(str(e))
+
+def compile_predicate(table_name, where, joins):
+    """Compile a view into a ViewPredicate.
+
+    :returns: a ViewPredicate, or None if the view uses SQL that we can't
+    handle.
+    """
+    try:
+        return ViewPredicate(table_name, where, joins)
+    except CompileError:
+        return None